@@ -0,0 +1,91 @@
+"""
+Coût de la liste de blocage (policy.py) à 1 million d'entrées.
+
+Mesure la compilation de l'index depuis un fichier, sa taille mémoire, et le
+coût d'une recherche pour des noms bloqués et non bloqués de profondeurs
+variées (une recherche dans la table de hachage par label).
+
+    python3 -m benchmarks.blocklist_lookup [--entries 1000000] [--lookups 200000]
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+import policy
+
+
+def random_label(rng, length):
+    return "".join(rng.choices(string.ascii_lowercase + string.digits, k=length))
+
+
+def blocked_domains(count, seed=1):
+    rng = random.Random(seed)
+    tlds = ("com", "net", "org", "io", "ru", "xyz", "co.uk")
+    return [f"{random_label(rng, rng.randint(6, 14))}.{rng.choice(tlds)}" for _ in range(count)]
+
+
+def queries(domains, count, hit_ratio, seed=2):
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        depth = rng.randint(0, 3)
+        prefix = "".join(f"{random_label(rng, 8)}." for _ in range(depth))
+        if rng.random() < hit_ratio:
+            names.append(prefix + rng.choice(domains))
+        else:
+            names.append(prefix + f"{random_label(rng, 10)}.example.com")
+    return names
+
+
+def per_lookup_ns(function, names):
+    start = time.perf_counter_ns()
+    for name in names:
+        function(name)
+    return (time.perf_counter_ns() - start) / len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--entries", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+
+    domains = blocked_domains(args.entries)
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("\n".join(domains))
+        path = f.name
+    try:
+        start = time.perf_counter()
+        blocklist = policy.Blocklist(path, "nxdomain")
+        load_s = time.perf_counter() - start
+    finally:
+        os.unlink(path)
+
+    hits = queries(domains, args.lookups, hit_ratio=1.0)
+    misses = queries(domains, args.lookups, hit_ratio=0.0)
+    if not all(blocklist.index.match(name) for name in hits[:1000]):
+        sys.exit("Index lookup mismatch")
+    reference = set(domains)
+    report = {
+        "entries": len(blocklist.index),
+        "load_s": round(load_s, 2),
+        "index_mib": round(blocklist.index.table.itemsize * len(blocklist.index.table) / 2**20, 1),
+        "python_set_mib": round((sys.getsizeof(reference) + sum(map(sys.getsizeof, reference))) / 2**20, 1),
+        "lookup_ns": {
+            "blocked": round(per_lookup_ns(blocklist.match, hits)),
+            "not_blocked": round(per_lookup_ns(blocklist.match, misses)),
+        },
+        "false_positives": sum(1 for name in misses if blocklist.index.match(name)),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
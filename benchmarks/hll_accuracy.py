@@ -0,0 +1,105 @@
+"""
+Compare le comptage exact (set) et HyperLogLog des sous-domaines uniques par domaine parent.
+
+Entrée : un fichier de trafic enregistré, une requête par ligne, au format
+"qname" ou "client qname". Sans fichier, un trafic synthétique (domaines
+légitimes + tunnel à sous-domaines aléatoires) est généré.
+
+    python3 -m benchmarks.hll_accuracy --error 0.04 [--qnames trafic.txt]
+"""
+
+import argparse
+import json
+import random
+import string
+import sys
+from collections import defaultdict
+
+from detect import extract_parent_domain, extract_subdomain
+from sketch import HyperLogLog
+
+
+def synthetic_traffic(queries, seed=1):
+    rng = random.Random(seed)
+    popular = [f"site{i}.com" for i in range(200)]
+    for _ in range(queries):
+        if rng.random() < 0.3:
+            label = "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(20, 60)))
+            yield f"10.0.0.{rng.randint(1, 4)}", f"{label}.t.tunnel-example.net"
+        else:
+            yield f"10.0.1.{rng.randint(1, 50)}", f"{rng.choice(['www', 'api', 'cdn', 'img'])}{rng.randint(0, 30)}.{rng.choice(popular)}"
+
+
+def recorded_traffic(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 1:
+                yield "unknown", fields[0]
+            elif len(fields) >= 2:
+                yield fields[0], fields[1]
+
+
+def relative_errors(exact, sketches):
+    errors = []
+    for key, values in exact.items():
+        if values:
+            errors.append(abs(len(sketches[key]) - len(values)) / len(values))
+    errors.sort()
+    if not errors:
+        return {}
+    return {
+        "keys": len(errors),
+        "mean": sum(errors) / len(errors),
+        "p99": errors[int(0.99 * (len(errors) - 1))],
+        "max": errors[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--qnames", help="fichier de trafic enregistré (qname ou 'client qname' par ligne)")
+    parser.add_argument("--queries", type=int, default=200000, help="taille du trafic synthétique")
+    parser.add_argument("--error", type=float, default=0.04, help="erreur relative visée pour HyperLogLog")
+    args = parser.parse_args()
+
+    traffic = recorded_traffic(args.qnames) if args.qnames else synthetic_traffic(args.queries)
+
+    exact_domains = defaultdict(set)
+    exact_clients = defaultdict(set)
+    hll_domains = defaultdict(lambda: HyperLogLog(error=args.error))
+    hll_clients = defaultdict(lambda: HyperLogLog(error=args.error))
+
+    for client, qname in traffic:
+        qname = qname.rstrip(".").lower()
+        parent = extract_parent_domain(qname)
+        subdomain = extract_subdomain(qname)
+        if not parent:
+            continue
+        if subdomain:
+            exact_domains[parent].add(subdomain)
+            hll_domains[parent].add(subdomain)
+        exact_clients[client].add(qname)
+        hll_clients[client].add(qname)
+
+    # Seules les clés assez grosses pour que l'esquisse soit dense sont significatives
+    dense_domains = {k: v for k, v in exact_domains.items() if hll_domains[k].registers is not None}
+    report = {
+        "target_error": args.error,
+        "precision": HyperLogLog(error=args.error).precision,
+        "registers_bytes": HyperLogLog(error=args.error).size,
+        "parent_domains": relative_errors(exact_domains, hll_domains),
+        "parent_domains_dense": relative_errors(dense_domains, hll_domains),
+        "clients": relative_errors(exact_clients, hll_clients),
+        "largest_domain": max(
+            ((k, len(v), len(hll_domains[k])) for k, v in exact_domains.items()),
+            key=lambda item: item[1],
+            default=None,
+        ),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
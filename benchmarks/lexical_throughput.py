@@ -0,0 +1,75 @@
+"""
+Débit du score lexical (lexical.py) en fonction de la taille des micro-lots.
+
+Chaque taille de lot est mesurée sur le même mélange de sous-domaines
+ordinaires et de sous-domaines de tunnel (base32), en noms scorés par seconde.
+
+    python3 -m benchmarks.lexical_throughput [--names 50000] [--batch-sizes 1,8,32,128,512,2048]
+"""
+
+import argparse
+import base64
+import json
+import random
+import sys
+import time
+
+import lexical
+
+ORDINARY = [
+    "www", "mail", "images.cdn", "api", "login.secure", "static", "accounts", "news.sport",
+    "s3-eu-west-1", "video-edge-123", "autodiscover", "ns1", "fonts", "tracking", "m",
+]
+
+
+def workload(count, tunnel_ratio, seed=1):
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        if rng.random() < tunnel_ratio:
+            payload = base64.b32encode(rng.randbytes(rng.randint(20, 40))).decode().lower().rstrip("=")
+            names.append(".".join(payload[i:i + 63] for i in range(0, len(payload), 63)))
+        else:
+            names.append(rng.choice(ORDINARY))
+    return names
+
+
+def names_per_second(scorer, names, batch_size):
+    start = time.perf_counter()
+    for offset in range(0, len(names), batch_size):
+        scorer.score_names(names[offset:offset + batch_size])
+    return len(names) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--names", type=int, default=50000)
+    parser.add_argument("--batch-sizes", default="1,8,32,128,512,2048")
+    parser.add_argument("--tunnel-ratio", type=float, default=0.2, help="part de noms de tunnel")
+    args = parser.parse_args()
+
+    if lexical.np is None:
+        sys.exit("NumPy est nécessaire pour le score lexical")
+    start = time.perf_counter()
+    scorer = lexical.LexicalScorer()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    names = workload(args.names, args.tunnel_ratio)
+    sample = names[:2048]
+    scores, _features = scorer.score_names(sample)
+    ordinary = lexical.np.array([name in ORDINARY for name in sample])
+    report = {
+        "names": args.names,
+        "model_load_ms": round(load_ms, 1),
+        "mean_score_ordinary": round(float(scores[ordinary].mean()), 3) if ordinary.any() else None,
+        "mean_score_tunnel": round(float(scores[~ordinary].mean()), 3) if not ordinary.all() else None,
+        "names_per_second": {
+            size: round(names_per_second(scorer, names, size)) for size in map(int, args.batch_sizes.split(","))
+        },
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+Banc de charge de bout en bout du proxy DNS.
+
+Lance un résolveur amont factice (benchmarks.stub_resolver), un Elasticsearch
+factice (benchmarks.stub_es) et proxy.py, puis rejoue un mélange de requêtes à
+débit fixe depuis plusieurs processus clients :
+  - cacheable : un petit ensemble de noms populaires (type A)
+  - tunnel    : sous-domaines aléatoires sous un même domaine, façon iodine
+  - txt       : requêtes TXT sur des noms aléatoires
+  - tcp       : noms populaires demandés en TCP
+
+Le résultat (débit, percentiles de latence, pics de threads/RSS du proxy,
+taux de perte) est écrit en JSON pour être comparé d'une version à l'autre :
+
+    python3 -m benchmarks.loadtest --engine asyncio --rate 2000 --duration 20 \\
+        --mix cacheable=0.6,tunnel=0.2,txt=0.15,tcp=0.05 --output results.json \\
+        --baseline previous.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import string
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KINDS = ("cacheable", "tunnel", "txt", "tcp")
+POPULAR_NAMES = [f"www{i}.bench-example.com" for i in range(100)]
+UDP_SOCKETS_PER_CLIENT = 16
+
+
+def build_query(name, qtype, transaction_id):
+    query = struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0)
+    for label in name.split("."):
+        query += bytes([len(label)]) + label.encode()
+    return query + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+def random_label(rng, length):
+    return "".join(rng.choices(string.ascii_lowercase + string.digits, k=length))
+
+
+def next_query(kind, rng):
+    """Retourne (nom, type) pour une requête du type demandé."""
+    if kind == "tunnel":
+        return f"{random_label(rng, 32)}.t.tunnel-bench.net", 1
+    if kind == "txt":
+        return f"{random_label(rng, 12)}.txt-bench.net", 16
+    return rng.choice(POPULAR_NAMES), 1
+
+
+def parse_mix(value):
+    weights = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown query kind {kind!r}, expected one of {KINDS}")
+        weights[kind] = float(weight)
+    return weights
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, index, outstanding, results):
+        self.index = index
+        self.outstanding = outstanding
+        self.results = results
+
+    def datagram_received(self, data, addr):
+        entry = self.outstanding.pop((self.index, int.from_bytes(data[:2], "big")), None)
+        if entry is not None:
+            sent_at, kind = entry
+            self.results[kind]["latencies"].append((time.perf_counter() - sent_at) * 1000)
+
+
+async def run_client(target, rate, duration, mix, timeout, seed):
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    results = {kind: {"sent": 0, "latencies": [], "errors": 0} for kind in KINDS}
+    outstanding = {}
+    transports = []
+    for index in range(UDP_SOCKETS_PER_CLIENT):
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda index=index: ClientProtocol(index, outstanding, results), remote_addr=target
+        )
+        transports.append(transport)
+
+    async def tcp_query(query):
+        sent_at = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*target), timeout)
+            writer.write(len(query).to_bytes(2, "big") + query)
+            length = int.from_bytes(await asyncio.wait_for(reader.readexactly(2), timeout), "big")
+            await asyncio.wait_for(reader.readexactly(length), timeout)
+            writer.close()
+            results["tcp"]["latencies"].append((time.perf_counter() - sent_at) * 1000)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            results["tcp"]["errors"] += 1
+
+    tasks = set()
+    total = int(rate * duration)
+    start = time.perf_counter()
+    for number in range(total):
+        # Boucle ouverte : chaque requête part à son heure, que les précédentes aient répondu ou non
+        delay = start + number / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = rng.choices(kinds, weights)[0]
+        name, qtype = next_query(kind, rng)
+        results[kind]["sent"] += 1
+        if kind == "tcp":
+            task = asyncio.ensure_future(tcp_query(build_query(name, qtype, rng.getrandbits(16))))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            continue
+        index = number % len(transports)
+        transaction_id = rng.getrandbits(16)
+        while (index, transaction_id) in outstanding:
+            transaction_id = rng.getrandbits(16)
+        outstanding[(index, transaction_id)] = (time.perf_counter(), kind)
+        transports[index].sendto(build_query(name, qtype, transaction_id))
+    send_duration = time.perf_counter() - start
+
+    # Délai de grâce pour les dernières réponses
+    await asyncio.sleep(timeout)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for transport in transports:
+        transport.close()
+    return {"results": results, "send_duration": send_duration}
+
+
+def client_process(target, rate, duration, mix, timeout, seed, output):
+    output.put(asyncio.run(run_client(target, rate, duration, mix, timeout, seed)))
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child_pid in pids:
+        try:
+            with open(f"/proc/{child_pid}/task/{child_pid}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def sample_usage(pid):
+    """Retourne (threads, RSS en Mo) pour le processus et ses enfants (Linux)."""
+    threads = rss_kb = 0
+    for child_pid in process_tree(pid):
+        try:
+            with open(f"/proc/{child_pid}/status") as f:
+                for line in f:
+                    if line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+        except OSError:
+            pass
+    return threads, rss_kb / 1024
+
+
+class UsageSampler(threading.Thread):
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.threads_peak = 0
+        self.rss_peak_mb = 0.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            threads, rss_mb = sample_usage(self.pid)
+            self.threads_peak = max(self.threads_peak, threads)
+            self.rss_peak_mb = max(self.rss_peak_mb, rss_mb)
+            self.stopped.wait(self.interval)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+    return {
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(values[-1], 3),
+        "mean": round(sum(values) / len(values), 3),
+    }
+
+
+def wait_for_dns(target, deadline):
+    query = build_query("ready.bench-example.com", 1, 1)
+    while time.time() < deadline:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(0.5)
+            try:
+                sock.sendto(query, target)
+                sock.recvfrom(4096)
+                return True
+            except OSError:
+                time.sleep(0.2)
+    return False
+
+
+def start(command, env=None):
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def run_load(args, target, proxy_pid):
+    sampler = UsageSampler(proxy_pid) if proxy_pid else None
+    if sampler:
+        sampler.start()
+    context = multiprocessing.get_context("fork")
+    output = context.Queue()
+    rate_per_client = args.rate / args.clients
+    clients = [
+        context.Process(
+            target=client_process,
+            args=(target, rate_per_client, args.duration, args.mix, args.timeout, args.seed + index, output),
+        )
+        for index in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    reports = [output.get() for _ in clients]
+    for client in clients:
+        client.join()
+    if sampler:
+        sampler.stopped.set()
+        sampler.join()
+
+    per_kind = {}
+    all_latencies = []
+    sent = answered = 0
+    for kind in KINDS:
+        latencies = [value for report in reports for value in report["results"][kind]["latencies"]]
+        kind_sent = sum(report["results"][kind]["sent"] for report in reports)
+        if not kind_sent:
+            continue
+        sent += kind_sent
+        answered += len(latencies)
+        all_latencies.extend(latencies)
+        per_kind[kind] = {
+            "sent": kind_sent,
+            "answered": len(latencies),
+            "drop_rate": round(1 - len(latencies) / kind_sent, 5),
+            "latency_ms": percentiles(latencies),
+        }
+    send_duration = max(report["send_duration"] for report in reports)
+    return {
+        "target_qps": args.rate,
+        "offered_qps": round(sent / send_duration, 1) if send_duration else 0,
+        "answered_qps": round(answered / send_duration, 1) if send_duration else 0,
+        "sent": sent,
+        "answered": answered,
+        "drop_rate": round(1 - answered / sent, 5) if sent else 0,
+        "latency_ms": percentiles(all_latencies),
+        "per_kind": per_kind,
+        "proxy": {
+            "threads_peak": sampler.threads_peak if sampler else None,
+            "rss_peak_mb": round(sampler.rss_peak_mb, 1) if sampler else None,
+        },
+    }
+
+
+def compare(result, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    rows = [
+        ("answered_qps", lambda r: r["answered_qps"]),
+        ("drop_rate", lambda r: r["drop_rate"]),
+        ("p50_ms", lambda r: r["latency_ms"].get("p50")),
+        ("p99_ms", lambda r: r["latency_ms"].get("p99")),
+        ("threads_peak", lambda r: r["proxy"]["threads_peak"]),
+        ("rss_peak_mb", lambda r: r["proxy"]["rss_peak_mb"]),
+    ]
+    print(f"{'metric':<14}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, getter in rows:
+        old, new = getter(baseline), getter(result)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ""
+        print(f"{name:<14}{str(old):>12}{str(new):>12}{change:>10}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--proxy-args", default="", help="arguments supplémentaires pour proxy.py")
+    parser.add_argument("--rate", type=float, default=1000, help="requêtes par seconde visées")
+    parser.add_argument("--duration", type=float, default=10, help="durée de l'envoi en secondes")
+    parser.add_argument("--clients", type=int, default=2, help="processus clients")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("cacheable=0.6,tunnel=0.2,txt=0.15,tcp=0.05"))
+    parser.add_argument("--timeout", type=float, default=2.0, help="délai au-delà duquel une requête est perdue")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--proxy-port", type=int, default=15353)
+    parser.add_argument("--upstream-port", type=int, default=15300)
+    parser.add_argument("--upstream-delay-ms", type=float, default=0.0)
+    parser.add_argument("--es-port", type=int, default=19200)
+    parser.add_argument("--target", help="HOST:PORT d'un proxy déjà lancé (pas de stubs ni de proxy local)")
+    parser.add_argument("--output", default="loadtest_results.json")
+    parser.add_argument("--baseline", help="résultats précédents à comparer")
+    args = parser.parse_args()
+
+    processes = []
+    proxy = None
+    try:
+        if args.target:
+            host, _, port = args.target.rpartition(":")
+            target = (host, int(port))
+        else:
+            target = ("127.0.0.1", args.proxy_port)
+            processes.append(start([
+                sys.executable, "-m", "benchmarks.stub_resolver",
+                "--port", str(args.upstream_port), "--delay-ms", str(args.upstream_delay_ms),
+            ]))
+            processes.append(start([sys.executable, "-m", "benchmarks.stub_es", "--port", str(args.es_port)]))
+            env = dict(os.environ, ES_HOST=f"http://127.0.0.1:{args.es_port}/")
+            proxy = start(
+                [
+                    sys.executable, "proxy.py", "--engine", args.engine, "--host", "127.0.0.1",
+                    "--port", str(args.proxy_port), "--upstream", f"127.0.0.1:{args.upstream_port}",
+                ] + args.proxy_args.split(),
+                env=env,
+            )
+            processes.append(proxy)
+        if not wait_for_dns(target, time.time() + 15):
+            errors = proxy.stderr.read1().decode(errors="replace") if proxy and proxy.poll() is not None else ""
+            sys.exit(f"Proxy not answering on {target[0]}:{target[1]}\n{errors}")
+
+        results = run_load(args, target, proxy.pid if proxy else None)
+        if not args.target:
+            time.sleep(2)  # laisse le proxy vider sa file de logs
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{args.es_port}/_stats", timeout=2) as response:
+                    results["elasticsearch"] = json.load(response)
+            except OSError:
+                results["elasticsearch"] = None
+
+        report = {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "config": {
+                "engine": args.engine,
+                "proxy_args": args.proxy_args,
+                "rate": args.rate,
+                "duration": args.duration,
+                "clients": args.clients,
+                "mix": args.mix,
+                "upstream_delay_ms": args.upstream_delay_ms,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        if args.baseline:
+            compare(results, args.baseline)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Coût d'extraction du domaine enregistrable (psl.py) par requête.
+
+Mesure le chargement du trie, une recherche sans cache (trie seul) et une
+recherche via le cache LRU sur un mélange de noms fréquents et aléatoires.
+
+    python3 -m benchmarks.psl_lookup [--lookups 200000]
+"""
+
+import argparse
+import json
+import random
+import string
+import sys
+import time
+
+import psl
+
+NAMES = [
+    "www.google.com", "mail.google.com", "news.bbc.co.uk", "a.b.c.github.io", "user.github.io",
+    "bucket.s3.eu-west-1.amazonaws.com", "ec2-1-2-3-4.compute-1.amazonaws.com", "www.example.org",
+    "cdn.jsdelivr.net", "foo.bar.blogspot.com", "x.y.z.example.co.jp", "api.service.gov.uk",
+]
+
+
+def workload(count, random_ratio, seed=1):
+    rng = random.Random(seed)
+    names = []
+    for _ in range(count):
+        if rng.random() < random_ratio:
+            label = "".join(rng.choices(string.ascii_lowercase + string.digits, k=32))
+            names.append(f"{label}.t.tunnel-example.net")
+        else:
+            names.append(rng.choice(NAMES))
+    return names
+
+
+def per_lookup_ns(function, names):
+    start = time.perf_counter_ns()
+    for name in names:
+        function(name)
+    return (time.perf_counter_ns() - start) / len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lookups", type=int, default=200000)
+    parser.add_argument("--random-ratio", type=float, default=0.3, help="part de noms aléatoires (jamais en cache)")
+    args = parser.parse_args()
+
+    path = psl.default_psl_file()
+    if path is None:
+        sys.exit("Public Suffix List introuvable (PSL_FILE)")
+    start = time.perf_counter()
+    trie = psl.PublicSuffixTrie.from_file(path)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    names = workload(args.lookups, args.random_ratio)
+    psl.registrable_domain.cache_clear()
+    report = {
+        "psl_file": path,
+        "rules": trie.rules,
+        "load_ms": round(load_ms, 1),
+        "lookups": args.lookups,
+        "trie_ns_per_lookup": round(per_lookup_ns(trie.registrable_domain, names)),
+        "cached_ns_per_lookup": round(per_lookup_ns(psl.registrable_domain, names)),
+        "cache": psl.registrable_domain.cache_info()._asdict(),
+    }
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
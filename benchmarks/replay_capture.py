@@ -0,0 +1,231 @@
+"""
+Rejeu d'une capture de requêtes (capture.py) en respectant ses horaires.
+
+Les requêtes enregistrées par proxy.py --capture sont renvoyées vers un proxy
+à la vitesse d'origine (--speed 1), N fois plus vite (--speed N) ou au plus
+vite (--speed 0), depuis plusieurs processus et sockets UDP ; les requêtes
+reçues en TCP sont rejouées en TCP. Le rapport JSON compare le débit atteint
+au débit visé et donne le retard sur l'horaire, les pertes et les latences.
+
+    python3 -m benchmarks.replay_capture capture.qcap --speed 2 --target 127.0.0.1:5353
+
+Sans --target, un résolveur amont factice (benchmarks.stub_resolver), un
+Elasticsearch factice et proxy.py sont lancés localement, comme pour
+benchmarks.loadtest.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from benchmarks.loadtest import percentiles, start, wait_for_dns
+from capture import capture_files, read_capture
+from upstream import parse_address
+
+UDP_SOCKETS_PER_CLIENT = 16
+MAX_SPEED_BATCH = 256  # requêtes envoyées entre deux passages dans la boucle à vitesse maximale
+
+
+class ReplayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, index, outstanding, latencies):
+        self.index = index
+        self.outstanding = outstanding
+        self.latencies = latencies
+
+    def datagram_received(self, data, addr):
+        sent_at = self.outstanding.pop((self.index, int.from_bytes(data[:2], "big")), None)
+        if sent_at is not None:
+            self.latencies.append((time.perf_counter() - sent_at) * 1000)
+
+
+def capture_records(paths):
+    for path in paths:
+        yield from read_capture(path)
+
+
+async def run_client(target, paths, speed, start_at, client, clients, sockets, timeout, limit):
+    loop = asyncio.get_running_loop()
+    outstanding = {}
+    latencies = []
+    lateness = []
+    report = {"sent": 0, "sent_tcp": 0, "errors": 0, "first": None, "last": None}
+    transports = []
+    for index in range(sockets):
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda index=index: ReplayProtocol(index, outstanding, latencies), remote_addr=target
+        )
+        transports.append(transport)
+
+    async def tcp_query(query):
+        sent_at = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*target), timeout)
+            writer.write(len(query).to_bytes(2, "big") + query)
+            length = int.from_bytes(await asyncio.wait_for(reader.readexactly(2), timeout), "big")
+            await asyncio.wait_for(reader.readexactly(length), timeout)
+            writer.close()
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            report["errors"] += 1
+
+    tasks = set()
+    first = None
+    delay = start_at - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    start_time = time.perf_counter()
+    for number, (timestamp, _client_ip, tcp, query) in enumerate(capture_records(paths)):
+        if limit is not None and number >= limit:
+            break
+        if first is None:
+            first = report["first"] = timestamp  # même origine pour tous les processus
+        if number % clients != client:
+            continue
+        report["last"] = timestamp
+        if speed > 0:
+            # Boucle ouverte : chaque requête part à son heure, décalée de la même façon qu'à la capture
+            delay = start_time + (timestamp - first) / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lateness.append(-delay * 1000)
+        elif report["sent"] % MAX_SPEED_BATCH == 0:
+            await asyncio.sleep(0)
+        report["sent"] += 1
+        if tcp:
+            report["sent_tcp"] += 1
+            task = asyncio.ensure_future(tcp_query(query))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            continue
+        index = number % len(transports)
+        transaction_id = int.from_bytes(query[:2], "big")
+        if (index, transaction_id) in outstanding:
+            # Identifiant déjà en attente sur cette socket : on le remplace pour ne pas confondre les réponses
+            while (index, transaction_id) in outstanding:
+                transaction_id = (transaction_id + 1) & 0xFFFF
+            query = transaction_id.to_bytes(2, "big") + query[2:]
+        outstanding[(index, transaction_id)] = time.perf_counter()
+        transports[index].sendto(query)
+    send_duration = time.perf_counter() - start_time
+
+    # Délai de grâce pour les dernières réponses
+    await asyncio.sleep(timeout)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for transport in transports:
+        transport.close()
+    report.update(send_duration=send_duration, latencies=latencies, lateness=lateness)
+    return report
+
+
+def client_process(target, paths, speed, start_at, client, clients, sockets, timeout, limit, output):
+    output.put(asyncio.run(run_client(target, paths, speed, start_at, client, clients, sockets, timeout, limit)))
+
+
+def replay(args, target, paths):
+    context = multiprocessing.get_context("fork")
+    output = context.Queue()
+    start_at = time.time() + 0.5  # départ commun, après le lancement des processus
+    clients = [
+        context.Process(
+            target=client_process,
+            args=(target, paths, args.speed, start_at, index, args.clients, args.sockets, args.timeout, args.limit,
+                  output),
+        )
+        for index in range(args.clients)
+    ]
+    for client in clients:
+        client.start()
+    reports = [output.get() for _ in clients]
+    for client in clients:
+        client.join()
+
+    sent = sum(report["sent"] for report in reports)
+    answered = sum(len(report["latencies"]) for report in reports)
+    firsts = [report["first"] for report in reports if report["first"] is not None]
+    lasts = [report["last"] for report in reports if report["last"] is not None]
+    capture_duration = max(lasts) - min(firsts) if firsts else 0
+    send_duration = max(report["send_duration"] for report in reports)
+    lateness = [value for report in reports for value in report["lateness"]]
+    return {
+        "speed": args.speed or "max",
+        "capture_duration_s": round(capture_duration, 3),
+        "capture_qps": round(sent / capture_duration, 1) if capture_duration else None,
+        "target_qps": round(sent * args.speed / capture_duration, 1) if capture_duration and args.speed else None,
+        "achieved_qps": round(sent / send_duration, 1) if send_duration else 0,
+        "answered_qps": round(answered / send_duration, 1) if send_duration else 0,
+        "sent": sent,
+        "sent_tcp": sum(report["sent_tcp"] for report in reports),
+        "answered": answered,
+        "drop_rate": round(1 - answered / sent, 5) if sent else 0,
+        "behind_schedule": {
+            "queries": len(lateness),
+            "ms": percentiles(lateness),
+        },
+        "latency_ms": percentiles([value for report in reports for value in report["latencies"]]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("capture", nargs="+", help="fichiers de capture, ou chemin passé à --capture")
+    parser.add_argument("--speed", type=float, default=1.0, help="facteur de vitesse, 0 : au plus vite")
+    parser.add_argument("--clients", type=int, default=2, help="processus émetteurs")
+    parser.add_argument("--sockets", type=int, default=UDP_SOCKETS_PER_CLIENT, help="sockets UDP par processus")
+    parser.add_argument("--limit", type=int, help="nombre maximal de requêtes rejouées")
+    parser.add_argument("--timeout", type=float, default=2.0, help="délai au-delà duquel une requête est perdue")
+    parser.add_argument("--target", help="HOST:PORT d'un proxy déjà lancé (sinon stubs et proxy locaux)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--proxy-args", default="", help="arguments supplémentaires pour proxy.py")
+    parser.add_argument("--proxy-port", type=int, default=15353)
+    parser.add_argument("--upstream-port", type=int, default=15300)
+    parser.add_argument("--es-port", type=int, default=19200)
+    parser.add_argument("--output", help="fichier du rapport JSON (en plus de la sortie standard)")
+    args = parser.parse_args()
+
+    paths = [path for value in args.capture for path in capture_files(value)]
+    if not paths:
+        sys.exit(f"No capture files for {' '.join(args.capture)}")
+
+    processes = []
+    proxy = None
+    try:
+        if args.target:
+            target = parse_address(args.target)
+        else:
+            target = ("127.0.0.1", args.proxy_port)
+            processes.append(start([sys.executable, "-m", "benchmarks.stub_resolver", "--port", str(args.upstream_port)]))
+            processes.append(start([sys.executable, "-m", "benchmarks.stub_es", "--port", str(args.es_port)]))
+            env = dict(os.environ, ES_HOST=f"http://127.0.0.1:{args.es_port}/")
+            proxy = start(
+                [
+                    sys.executable, "proxy.py", "--engine", args.engine, "--host", "127.0.0.1",
+                    "--port", str(args.proxy_port), "--upstream", f"127.0.0.1:{args.upstream_port}",
+                ] + args.proxy_args.split(),
+                env=env,
+            )
+            processes.append(proxy)
+        if not wait_for_dns(target, time.time() + 15):
+            errors = proxy.stderr.read1().decode(errors="replace") if proxy and proxy.poll() is not None else ""
+            sys.exit(f"Proxy not answering on {target[0]}:{target[1]}\n{errors}")
+
+        results = replay(args, target, paths)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=5)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Elasticsearch factice pour les bancs de charge : accepte les requêtes index et
+_bulk, compte les documents et les jette. GET /_stats retourne les compteurs.
+
+    python3 -m benchmarks.stub_es --port 19200
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+counters = {"documents": 0, "bulk_requests": 0, "index_requests": 0, "bytes": 0}
+counters_lock = threading.Lock()
+
+
+class StubElasticsearchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        if self.path.startswith("/_stats"):
+            with counters_lock:
+                self.reply(200, dict(counters))
+            return
+        self.reply(200, {"name": "stub", "version": {"number": "8.0.0"}, "tagline": "You Know, for Search"})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.read_body()
+        path = self.path.split("?")[0]
+        if path.endswith("/_bulk"):
+            # NDJSON : une ligne d'action suivie d'une ligne de document
+            documents = sum(1 for line in body.splitlines() if line.strip()) // 2
+            with counters_lock:
+                counters["documents"] += documents
+                counters["bulk_requests"] += 1
+                counters["bytes"] += len(body)
+            items = [{"index": {"status": 201, "result": "created"}}] * documents
+            self.reply(200, {"took": 1, "errors": False, "items": items})
+            return
+        with counters_lock:
+            counters["documents"] += 1
+            counters["index_requests"] += 1
+            counters["bytes"] += len(body)
+        self.reply(201, {"result": "created", "_id": "stub"})
+
+    do_PUT = do_POST
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=19200)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), StubElasticsearchHandler)
+    print(f"Stub Elasticsearch listening on {args.host}:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
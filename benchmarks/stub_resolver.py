@@ -0,0 +1,132 @@
+"""
+Résolveur amont factice (UDP et TCP) pour les bancs de charge.
+
+Répond à toute question sans aller sur Internet :
+  - A / AAAA : une adresse de documentation (192.0.2.x / 2001:db8::x), TTL 300
+  - TXT : un enregistrement d'environ 200 octets, TTL 60
+  - noms commençant par "nx-" : NXDOMAIN avec un SOA dans l'autorité
+  - autres types : réponse vide (NODATA) avec SOA
+
+    python3 -m benchmarks.stub_resolver --port 15300 [--delay-ms 2]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import struct
+
+from decoder import DNSMessage
+
+TXT_PAYLOAD = b"v=stub " + b"x" * 190
+SOA_RDATA = (
+    b"\x02ns\x04stub\x00\x0ahostmaster\x04stub\x00" + struct.pack("!5I", 1, 3600, 600, 86400, 60)
+)
+
+
+def build_answer(query):
+    """Construit la réponse binaire à une requête."""
+    message = DNSMessage(query)
+    question = query[12 : message.question_end]
+    qname = message.qname.lower()
+    qtype = message.qtype
+    digest = hashlib.blake2b(qname.encode(), digest_size=2).digest()
+
+    rcode = 0
+    answers = b""
+    an_count = ns_count = 0
+    if qname.startswith("nx-"):
+        rcode = 3
+    elif qtype == 1:
+        answers = b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + bytes([192, 0, 2, digest[0]])
+        an_count = 1
+    elif qtype == 28:
+        address = bytes.fromhex("20010db8") + bytes(10) + digest
+        answers = b"\xc0\x0c" + struct.pack("!HHIH", 28, 1, 300, 16) + address
+        an_count = 1
+    elif qtype == 16:
+        rdata = bytes([len(TXT_PAYLOAD)]) + TXT_PAYLOAD
+        answers = b"\xc0\x0c" + struct.pack("!HHIH", 16, 1, 60, len(rdata)) + rdata
+        an_count = 1
+
+    authority = b""
+    if an_count == 0:
+        authority = b"\x00" + struct.pack("!HHIH", 6, 1, 60, len(SOA_RDATA)) + SOA_RDATA
+        ns_count = 1
+
+    # QR, AA, RD (recopié), RA
+    flags = 0x8480 | (message.flags & 0x0100) | rcode
+    header = struct.pack("!6H", message.id, flags, 1, an_count, ns_count, 0)
+    return header + question + answers + authority
+
+
+class StubResolver:
+    def __init__(self, delay):
+        self.delay = delay
+        self.queries = 0
+
+    async def answer(self, query):
+        self.queries += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return build_answer(query)
+
+
+class StubDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.resolver.delay:
+            asyncio.ensure_future(self._reply(data, addr))
+        else:
+            try:
+                self.transport.sendto(build_answer(data), addr)
+                self.resolver.queries += 1
+            except Exception as e:
+                print(f"Stub resolver error : {e}")
+
+    async def _reply(self, data, addr):
+        try:
+            self.transport.sendto(await self.resolver.answer(data), addr)
+        except Exception as e:
+            print(f"Stub resolver error : {e}")
+
+
+async def serve(host, port, delay):
+    resolver = StubResolver(delay)
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(lambda: StubDatagramProtocol(resolver), local_addr=(host, port))
+
+    async def handle_tcp(reader, writer):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), "big")
+                response = await resolver.answer(await reader.readexactly(length))
+                writer.write(len(response).to_bytes(2, "big") + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_tcp, host, port, reuse_address=True)
+    print(f"Stub resolver listening on {host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=15300)
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="latence simulée de l'amont")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.delay_ms / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,437 @@
+"""
+Cache des réponses DNS placé devant le résolveur amont.
+
+Les réponses sont conservées au format binaire, indexées par
+(qname, qtype, qclass, bit DO, taille UDP EDNS). La taille est celle annoncée
+par l'enregistrement OPT du client (bornée à 512..4096), ou 0 sans EDNS : une
+réponse obtenue pour un client EDNS, qui peut porter un OPT et dépasser 512
+octets, n'est jamais servie à un client sans EDNS (RFC 6891). À la sortie du cache on réécrit l'identifiant
+de transaction et la question du client, puis on décrémente les TTL du temps
+passé dans le cache. Les NXDOMAIN et réponses vides (NODATA) sont mis en cache
+négatif selon la RFC 2308, avec le TTL du SOA de la section autorité.
+
+Le cache peut aussi :
+  - être sauvegardé périodiquement dans un fichier compact (CACHE_SNAPSHOT) et
+    rechargé au démarrage, les TTL étant diminués du temps écoulé entre-temps ;
+  - rafraîchir en arrière-plan les noms populaires peu avant l'expiration de
+    leur TTL (prefetch), pour que leurs clients ne voient jamais d'échec de cache ;
+  - servir une réponse expirée quand le résolveur amont ne répond pas
+    (serve-stale, RFC 8767), avec un TTL de 30 secondes.
+"""
+
+import atexit
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from decoder import DNSMessage, ANSWER, AUTHORITY, ADDITIONAL, OPT_TYPE
+
+CACHE_SIZE = 10000  # nombre maximal d'entrées (LRU)
+MAX_TTL = 86400  # plafond pour les réponses positives
+NEGATIVE_MAX_TTL = 10800  # plafond pour le cache négatif (RFC 2308, section 5)
+
+SOA_TYPE = 6
+DNS_UDP_SIZE = 512  # taille maximale d'une réponse UDP sans EDNS (RFC 1035)
+EDNS_MAX_UDP_SIZE = 4096
+
+# Sauvegarde du cache (chemin vide : désactivée)
+CACHE_SNAPSHOT = os.getenv("CACHE_SNAPSHOT", "")
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "60"))
+# Rafraîchissement des noms populaires : au moins CACHE_PREFETCH_HITS réponses servies
+# depuis la mise en cache, dans les derniers 10 % du TTL (0 : désactivé)
+CACHE_PREFETCH_HITS = int(os.getenv("CACHE_PREFETCH_HITS", "2"))
+PREFETCH_FRACTION = 0.1
+PREFETCH_INTERVAL = 1.0
+# Serve-stale (RFC 8767) : durée maximale de conservation après expiration (0 : désactivé)
+CACHE_STALE_MAX = float(os.getenv("CACHE_STALE_MAX", "86400"))
+STALE_ANSWER_TTL = 30  # TTL des réponses expirées servies (RFC 8767, section 4)
+STALE_REFRESH_TIME = (
+    30  # après un échec, réponses expirées servies sans interroger l'amont (section 5)
+)
+
+SNAPSHOT_MAGIC = b"DNSCACHE"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct(
+    "!8sHdI"
+)  # magic, version, heure de sauvegarde, nombre d'entrées
+# longueur du qname, qtype, qclass, bit DO, taille EDNS, heure de mise en cache, TTL, hits, longueur de la réponse
+SNAPSHOT_ENTRY = struct.Struct("!BHHBHdfIH")
+
+
+def parse_question(data):
+    """
+    Retourne (clé de cache, fin de la question) pour une requête, ou (None, None)
+    si la requête n'est pas cachable.
+    """
+    try:
+        message = DNSMessage(data)
+        if message.qd_count != 1:
+            return None, None
+        qname = bytes(message.view[12 : message.question_end - 4]).lower()
+
+        # Bit DO et taille UDP de l'enregistrement OPT (EDNS0), s'il est présent
+        do_bit = 0
+        udp_size = 0
+        for record in message.records((ADDITIONAL,)):
+            if record.rtype == OPT_TYPE:
+                do_bit = (record.ttl >> 15) & 1
+                udp_size = min(max(record.rclass, DNS_UDP_SIZE), EDNS_MAX_UDP_SIZE)
+    except (IndexError, ValueError, struct.error):
+        return None, None
+    return (
+        qname,
+        message.qtype,
+        message.qclass,
+        do_bit,
+        udp_size,
+    ), message.question_end
+
+
+def scan_response(data):
+    """
+    Parcourt les enregistrements d'une réponse sans décoder les noms.
+    Retourne (liste des (offset, ttl) à réécrire, TTL de cache) ; TTL None = non cachable.
+    """
+    message = DNSMessage(data)
+    if message.truncated:  # TC : réponse tronquée, jamais mise en cache
+        return [], None
+
+    ttl_fields = message.ttl_fields()
+    rcode = message.rcode
+    if rcode == 0 and message.an_count > 0:
+        return ttl_fields, min(message.min_ttl(), MAX_TTL)
+    if rcode == 3 or (rcode == 0 and message.an_count == 0):
+        # Cache négatif : TTL du SOA de l'autorité ; sans SOA, on ne cache pas (RFC 2308, section 5)
+        for record in message.records((ANSWER, AUTHORITY)):
+            if (
+                record.section == AUTHORITY
+                and record.rtype == SOA_TYPE
+                and record.rdlength >= 20
+            ):
+                end = record.rdata_offset + record.rdlength
+                minimum = struct.unpack("!I", data[end - 4 : end])[0]
+                return ttl_fields, min(record.ttl, minimum, NEGATIVE_MAX_TTL)
+    return ttl_fields, None
+
+
+def build_query(key):
+    """Requête minimale correspondant à une clé de cache (pour le prefetch)."""
+    qname, qtype, qclass, do_bit, udp_size = key
+    flags = 0x0100  # RD
+    additional = b""
+    if udp_size:
+        # Même OPT que le client d'origine : sans lui, une grande réponse reviendrait tronquée
+        additional = b"\x00" + struct.pack(
+            "!HHIH", OPT_TYPE, udp_size, 0x8000 if do_bit else 0, 0
+        )
+    header = struct.pack("!6H", 0, flags, 1, 0, 0, 1 if udp_size else 0)
+    return header + qname + struct.pack("!HH", qtype, qclass) + additional
+
+
+class CacheEntry:
+    __slots__ = (
+        "response",
+        "ttl_fields",
+        "stored_at",
+        "expires_at",
+        "hits",
+        "prefetching",
+        "stale_until",
+    )
+
+    def __init__(self, response, ttl_fields, stored_at, ttl):
+        self.response = response
+        self.ttl_fields = ttl_fields
+        self.stored_at = stored_at
+        self.expires_at = stored_at + ttl
+        self.hits = 0
+        self.prefetching = False
+        self.stale_until = (
+            0.0  # réponses expirées servies directement jusqu'à cette heure
+        )
+
+
+class DNSCache:
+    """Cache LRU borné, respectant les TTL, pour les réponses binaires du résolveur."""
+
+    def __init__(
+        self,
+        max_entries=CACHE_SIZE,
+        stale_max=CACHE_STALE_MAX,
+        prefetch_hits=CACHE_PREFETCH_HITS,
+    ):
+        self.max_entries = max_entries
+        self.stale_max = stale_max
+        self.prefetch_hits = prefetch_hits
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.stale_answers = 0
+        self.prefetches = 0
+        self.loaded = 0
+        self.snapshots = 0
+
+    def get(self, query):
+        """Retourne une réponse prête à envoyer pour cette requête, ou None."""
+        key, qend = parse_question(query)
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            stale = entry is not None and entry.expires_at <= now
+            if stale and now < entry.stale_until:
+                # Amont en échec récemment : la réponse expirée est servie sans nouvel essai
+                self.stale_answers += 1
+            elif entry is None or stale:
+                if stale and entry.expires_at + self.stale_max <= now:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            else:
+                entry.hits += 1
+                self.hits += 1
+                if entry.response[3] & 0x0F == 3:
+                    self.negative_hits += 1
+            self.entries.move_to_end(key)
+        return self._answer(entry, query, qend, now, stale)
+
+    def get_stale(self, query):
+        """
+        Réponse expirée pour cette requête quand le résolveur amont a échoué (RFC 8767),
+        ou None. Les requêtes suivantes la reçoivent directement pendant STALE_REFRESH_TIME.
+        """
+        key, qend = parse_question(query)
+        if key is None or not self.stale_max:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expires_at + self.stale_max <= now:
+                return None
+            entry.stale_until = now + STALE_REFRESH_TIME
+            self.stale_answers += 1
+        return self._answer(entry, query, qend, now, stale=entry.expires_at <= now)
+
+    @staticmethod
+    def _answer(entry, query, qend, now, stale=False):
+        response = bytearray(entry.response)
+        response[0:2] = query[0:2]  # identifiant de transaction du client
+        response[12:qend] = query[12:qend]  # casse de la question du client
+        elapsed = int(now - entry.stored_at)
+        for offset, ttl in entry.ttl_fields:
+            struct.pack_into(
+                "!I",
+                response,
+                offset,
+                STALE_ANSWER_TTL if stale else max(0, ttl - elapsed),
+            )
+        return bytes(response)
+
+    def put(self, query, response):
+        """Met en cache la réponse du résolveur si elle est cachable."""
+        key, _qend = parse_question(query)
+        if (
+            key is None
+            or len(response) < 12
+            or len(response) > (key[4] or DNS_UDP_SIZE)
+        ):
+            return
+        try:
+            ttl_fields, ttl = scan_response(response)
+        except (IndexError, ValueError, struct.error):
+            return
+        if not ttl:
+            return
+        entry = CacheEntry(bytes(response), ttl_fields, time.monotonic(), ttl)
+        with self.lock:
+            self._insert(key, entry)
+
+    def _insert(self, key, entry):
+        # Appelé sous self.lock
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.inserts += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Prefetch des noms populaires
+
+    def start_prefetch(self, refresh):
+        """
+        Lance le thread de prefetch. refresh(query) doit envoyer la requête à l'amont
+        sans bloquer et appeler put() avec la réponse.
+        """
+        if self.prefetch_hits > 0:
+            threading.Thread(
+                target=self._prefetch_loop,
+                args=(refresh,),
+                daemon=True,
+                name="cache-prefetch",
+            ).start()
+
+    def _prefetch_loop(self, refresh):
+        while True:
+            time.sleep(PREFETCH_INTERVAL)
+            for key in self.prefetch_candidates():
+                self.prefetches += 1
+                try:
+                    refresh(build_query(key))
+                except Exception as e:
+                    print(f"Cache prefetch error : {e}")
+
+    def prefetch_candidates(self, now=None):
+        """Clés populaires dont le TTL expire bientôt et qui ne sont pas déjà en cours de rafraîchissement."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entries = list(self.entries.items())
+        candidates = []
+        for key, entry in entries:
+            if entry.prefetching or entry.hits < self.prefetch_hits:
+                continue
+            remaining = entry.expires_at - now
+            if (
+                0
+                < remaining
+                <= max(
+                    (entry.expires_at - entry.stored_at) * PREFETCH_FRACTION,
+                    2 * PREFETCH_INTERVAL,
+                )
+            ):
+                entry.prefetching = True  # la nouvelle entrée remplacera celle-ci
+                candidates.append(key)
+        return candidates
+
+    # Sauvegarde et rechargement
+
+    def save(self, path):
+        """Écrit l'état du cache (réponses, TTL restants, hits) dans path, de façon atomique."""
+        now, wall = time.monotonic(), time.time()
+        with self.lock:
+            entries = list(self.entries.items())
+        body = bytearray()
+        count = 0
+        for (qname, qtype, qclass, do_bit, udp_size), entry in entries:
+            if entry.expires_at + self.stale_max <= now:
+                continue
+            body += SNAPSHOT_ENTRY.pack(
+                len(qname),
+                qtype,
+                qclass,
+                do_bit,
+                udp_size,
+                wall - (now - entry.stored_at),
+                entry.expires_at - entry.stored_at,
+                min(entry.hits, 0xFFFFFFFF),
+                len(entry.response),
+            )
+            body += qname
+            body += entry.response
+            count += 1
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, wall, count))
+            f.write(zlib.compress(bytes(body), 1))
+        os.replace(temporary, path)
+        self.snapshots += 1
+        return count
+
+    def load(self, path):
+        """Recharge une sauvegarde ; les entrées expirées (au-delà de la période serve-stale) sont ignorées."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, version, _saved_at, count = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError("unknown snapshot format")
+            body = zlib.decompress(data[SNAPSHOT_HEADER.size :])
+            # Tout est lu et vérifié avant d'insérer : une sauvegarde abîmée est ignorée en entier
+            records = []
+            offset = 0
+            for _ in range(count):
+                fields = SNAPSHOT_ENTRY.unpack_from(body, offset)
+                offset += SNAPSHOT_ENTRY.size
+                qname_length, length = fields[0], fields[-1]
+                end = offset + qname_length + length
+                if end > len(body):
+                    raise ValueError("truncated entry")
+                qname = body[offset : offset + qname_length]
+                records.append((qname, fields, body[offset + qname_length : end]))
+                offset = end
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError, struct.error, zlib.error) as e:
+            print(f"Cache snapshot {path} ignored : {e}")
+            return 0
+        now, wall = time.monotonic(), time.time()
+        loaded = 0
+        with self.lock:
+            for qname, fields, response in records:
+                (
+                    _qname_length,
+                    qtype,
+                    qclass,
+                    do_bit,
+                    udp_size,
+                    stored_wall,
+                    ttl,
+                    hits,
+                    _length,
+                ) = fields
+                # Les heures monotonic ne survivent pas au redémarrage : on repart de l'heure murale
+                stored_at = now - max(0.0, wall - stored_wall)
+                if stored_at + ttl + self.stale_max <= now:
+                    continue
+                try:
+                    ttl_fields, _ttl = scan_response(response)
+                except (IndexError, ValueError, struct.error):
+                    continue
+                entry = CacheEntry(response, ttl_fields, stored_at, ttl)
+                entry.hits = hits
+                self._insert((qname, qtype, qclass, do_bit, udp_size), entry)
+                loaded += 1
+            self.loaded += loaded
+        return loaded
+
+    def start_snapshots(self, path, interval=CACHE_SNAPSHOT_INTERVAL):
+        """Recharge path puis le réécrit toutes les interval secondes et à l'arrêt du processus."""
+        loaded = self.load(path)
+        if loaded:
+            print(f"Cache snapshot {path} : {loaded} entries loaded")
+
+        def save_safely():
+            try:
+                self.save(path)
+            except OSError as e:
+                print(f"Cache snapshot error : {e}")
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                save_safely()
+
+        threading.Thread(target=loop, daemon=True, name="cache-snapshot").start()
+        atexit.register(save_safely)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "inserts": self.inserts,
+                "evictions": self.evictions,
+                "stale_answers": self.stale_answers,
+                "prefetches": self.prefetches,
+                "loaded": self.loaded,
+                "snapshots": self.snapshots,
+            }
@@ -0,0 +1,242 @@
+"""
+Enregistrement des requêtes brutes reçues par le proxy, pour rejouer la forme
+du trafic de production ailleurs (benchmarks/replay_capture.py).
+
+Un fichier de capture commence par MAGIC, suivi d'enregistrements :
+
+    horodatage   float64, secondes depuis l'epoch
+    longueur     uint16, taille de la requête
+    drapeaux     uint8, bit 0 : reçue en TCP, bit 1 : client IPv6
+    client       4 ou 16 octets (adresse IP)
+    requête      message DNS tel que reçu
+
+soit 15 octets plus la requête pour un client IPv4, en petit-boutiste.
+
+Le chemin de la requête ne fait qu'encoder l'enregistrement et l'ajouter à une
+file en mémoire (au plus QUERY_CAPTURE_QUEUE_SIZE enregistrements, les suivants
+sont ignorés et comptés) : un thread l'écrit dans le fichier, par un tampon de
+QUERY_CAPTURE_BUFFER_KB Kio, et le vide toutes les QUERY_CAPTURE_FLUSH_INTERVAL
+secondes. Un arrêt brutal perd au plus la file et ce tampon, et le lecteur
+ignore un dernier enregistrement incomplet.
+
+Les fichiers tournent tous les QUERY_CAPTURE_SEGMENT_MB Mio
+(capture.qcap.000001, capture.qcap.000002...) et seuls les
+QUERY_CAPTURE_KEEP derniers sont gardés.
+"""
+
+import atexit
+import glob
+import os
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+QUERY_CAPTURE = os.getenv("QUERY_CAPTURE", "")  # vide : pas de capture
+QUERY_CAPTURE_SEGMENT_SIZE = (
+    int(os.getenv("QUERY_CAPTURE_SEGMENT_MB", "64")) * 1024 * 1024
+)
+QUERY_CAPTURE_KEEP = int(
+    os.getenv("QUERY_CAPTURE_KEEP", "16")
+)  # fichiers gardés, 0 : tous
+QUERY_CAPTURE_BUFFER_SIZE = int(os.getenv("QUERY_CAPTURE_BUFFER_KB", "256")) * 1024
+QUERY_CAPTURE_FLUSH_INTERVAL = float(os.getenv("QUERY_CAPTURE_FLUSH_INTERVAL", "1.0"))
+QUERY_CAPTURE_QUEUE_SIZE = int(
+    os.getenv("QUERY_CAPTURE_QUEUE_SIZE", "100000")
+)  # enregistrements en attente
+
+MAGIC = b"DNSQCAP1"
+RECORD_HEADER = struct.Struct("<dHB")
+FLAG_TCP = 0x01
+FLAG_IPV6 = 0x02
+
+
+def encode_record(data, client_ip, tcp=False, timestamp=None):
+    flags = FLAG_TCP if tcp else 0
+    try:
+        if ":" in client_ip:
+            address = socket.inet_pton(socket.AF_INET6, client_ip)
+            flags |= FLAG_IPV6
+        else:
+            address = socket.inet_pton(socket.AF_INET, client_ip)
+    except (OSError, TypeError):
+        address = bytes(4)
+    return (
+        RECORD_HEADER.pack(timestamp or time.time(), len(data), flags) + address + data
+    )
+
+
+def capture_files(path):
+    """Fichiers d'une capture, dans l'ordre : path lui-même ou ses fichiers numérotés."""
+    if os.path.isfile(path):
+        return [path]
+    return sorted(glob.glob(glob.escape(path) + ".[0-9][0-9][0-9][0-9][0-9][0-9]"))
+
+
+def read_capture(path):
+    """Parcourt un fichier de capture : (horodatage, client, tcp, requête)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a query capture")
+    offset = len(MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        timestamp, length, flags = RECORD_HEADER.unpack_from(data, offset)
+        address_size = 16 if flags & FLAG_IPV6 else 4
+        start = offset + RECORD_HEADER.size + address_size
+        end = start + length
+        if end > len(data):
+            break  # dernier enregistrement incomplet (arrêt brutal)
+        family = socket.AF_INET6 if flags & FLAG_IPV6 else socket.AF_INET
+        client = socket.inet_ntop(family, data[start - address_size : start])
+        yield timestamp, client, bool(flags & FLAG_TCP), data[start:end]
+        offset = end
+
+
+class QueryCapture:
+    """
+    Écriture des requêtes capturées. record() est appelé depuis les threads de
+    service ou la boucle asyncio et ne fait aucune entrée/sortie : append et
+    popleft d'un deque sont atomiques, seul le thread d'écriture touche aux fichiers.
+    """
+
+    def __init__(
+        self,
+        path,
+        segment_size=QUERY_CAPTURE_SEGMENT_SIZE,
+        keep=QUERY_CAPTURE_KEEP,
+        buffer_size=QUERY_CAPTURE_BUFFER_SIZE,
+        flush_interval=QUERY_CAPTURE_FLUSH_INTERVAL,
+        max_queue=QUERY_CAPTURE_QUEUE_SIZE,
+    ):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.keep = keep
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.wakeup = threading.Event()
+        self.lock = (
+            threading.Lock()
+        )  # fichier courant, entre le thread d'écriture et close()
+        self.file = None
+        self.size = 0
+        existing = capture_files(path)
+        self.number = (
+            int(existing[-1].rsplit(".", 1)[1])
+            if existing and existing[-1] != path
+            else 0
+        )
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        # Compteurs
+        self.recorded = 0
+        self.bytes = 0
+        self.rotations = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def record(self, data, client_ip, tcp=False):
+        """Met une requête reçue en file ; ne lève jamais d'exception vers le chemin de la requête."""
+        if self.thread is None:
+            self._start()
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1  # écriture en retard : on ne bloque pas le service
+            return
+        self.queue.append(encode_record(data, client_ip, tcp))
+        if len(self.queue) >= self.max_queue // 2 and not self.wakeup.is_set():
+            self.wakeup.set()  # vidage anticipé avant que la file ne déborde
+
+    def write_pending(self):
+        """Écrit les enregistrements en file (thread d'écriture, ou close())."""
+        queue = self.queue
+        with self.lock:
+            while True:
+                try:
+                    record = queue.popleft()
+                except IndexError:
+                    return
+                try:
+                    if self.file is None or self.size + len(record) > self.segment_size:
+                        self._rotate()
+                    self.file.write(record)
+                    self.size += len(record)
+                    self.recorded += 1
+                    self.bytes += len(record)
+                except (OSError, ValueError) as e:
+                    self.errors += 1
+                    if self.errors == 1:
+                        print(f"Query capture error : {e}")
+
+    def _rotate(self):
+        # Appelé sous self.lock, par le thread d'écriture
+        if self.file is not None:
+            self.file.close()
+            self.rotations += 1
+        self.number += 1
+        self.file = open(
+            f"{self.path}.{self.number:06d}", "wb", buffering=self.buffer_size
+        )
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+        if self.keep:
+            for old in capture_files(self.path)[: -self.keep]:
+                os.unlink(old)
+
+    def _start(self):
+        with self.thread_lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self._run, daemon=True, name="query-capture"
+            )
+        self.thread.start()
+
+    def _run(self):
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            self.wakeup.wait(max(0.0, deadline - time.monotonic()))
+            self.wakeup.clear()
+            self.write_pending()
+            if time.monotonic() >= deadline:
+                self.flush()
+                deadline = time.monotonic() + self.flush_interval
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                try:
+                    self.file.flush()
+                except OSError:
+                    self.errors += 1
+
+    def close(self):
+        self.write_pending()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "recorded": self.recorded,
+            "bytes": self.bytes,
+            "rotations": self.rotations,
+            "errors": self.errors,
+            "dropped": self.dropped,
+        }
+
+
+def create_query_capture(path=QUERY_CAPTURE):
+    """QueryCapture écrivant dans path (fermée à la sortie), ou None si path est vide."""
+    if not path:
+        return None
+    capture = QueryCapture(path)
+    atexit.register(capture.close)
+    return capture
@@ -24,6 +24,15 @@ from xdrlib import Unpacker
 LISTEN_PORT = 53
 DNS_SERVER = "8.8.8.8"
 
+HEADER = struct.Struct("!6H")
+QUESTION_TAIL = struct.Struct("!HH")
+RECORD_HEADER = struct.Struct("!HHIH")
+OPT_TYPE = 41
+# Un nom fait au plus 255 octets, soit 127 labels : au-delà, les pointeurs sont forgés
+MAX_POINTER_HOPS = 127
+
+ANSWER, AUTHORITY, ADDITIONAL = "answer", "authority", "additional"
+
 
 def query_type_to_string(qtype):
     """Maps a DNS query type number to its corresponding string representation."""
@@ -52,37 +61,290 @@ def query_type_to_string(qtype):
     return query_type_map.get(qtype, f"{qtype}")
 
 
-def decode_dns_query(data):
-    """Decodes DNS query."""
-    header = struct.unpack("!6H", data[:12])  # Les 12 bits du header
-    # On extrait une par une les informations
-    transaction_id = header[0]
-    _flags = header[1]
-    qd_count = header[2]  # Nombre de questions
-    an_count = header[3]  # Nombre de réponses
-    _ns_count = header[4]  # Nombre d'autorités
-    _ar_count = header[5]  # Nombre d'additionnels
-
-    index = 12
-    qname = []
-
-    # Query part
+def skip_domain_name(data, index):
+    """Returns the index following an encoded name, without decoding it."""
     while True:
         length = data[index]
+        if length & 0xC0 == 0xC0:
+            return index + 2
         if length == 0:
-            break
-        try:
-             qname.append(data[index + 1: index + 1 + length].decode("utf-8", errors="replace"))
-        except UnicodeDecodeError:
-            print(f"Invalid domain name character: {data[index + 1 : index + 1 + length]}")
-            qname.append("error")
+            return index + 1
         index += length + 1
 
-    qname = ".".join(qname)
-    index += 1  # Skip the null byte at the end of the qname
 
-    qtype, qclass = struct.unpack("!HH", data[index : index + 4])
-    index += 4
+class DNSMessage:
+    """
+    Lazy, zero-copy view over a DNS message.
+
+    Only the header and the question are parsed up front. Names are decoded on
+    demand through a memoryview, and compression-pointer targets are memoized
+    per message so that shared suffixes are decoded only once.
+    """
+
+    __slots__ = (
+        "data",
+        "view",
+        "id",
+        "flags",
+        "qd_count",
+        "an_count",
+        "ns_count",
+        "ar_count",
+        "question_end",
+        "qtype",
+        "qclass",
+        "_names",
+    )
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        (
+            self.id,
+            self.flags,
+            self.qd_count,
+            self.an_count,
+            self.ns_count,
+            self.ar_count,
+        ) = HEADER.unpack_from(data, 0)
+        self._names = {}  # offset -> (nom décodé, index suivant)
+        self.qtype = self.qclass = None
+        index = 12
+        if self.qd_count:
+            index = skip_domain_name(data, index)
+            self.qtype, self.qclass = QUESTION_TAIL.unpack_from(data, index)
+            index += 4
+            for _ in range(self.qd_count - 1):
+                index = skip_domain_name(data, index) + 4
+        self.question_end = index
+
+    @property
+    def rcode(self):
+        return self.flags & 0x0F
+
+    @property
+    def truncated(self):
+        return (self.flags & 0x0200) >> 9
+
+    @property
+    def qname(self):
+        return self.read_name(12)[0] if self.qd_count else ""
+
+    def read_name(self, index):
+        """Decodes the name at `index` and returns (name, index after the name)."""
+        cached = self._names.get(index)
+        if cached is not None:
+            return cached
+        data = self.data
+        start = index
+        labels = []
+        suffix = ""
+        # (début, labels lus avant lui, index suivant) de chaque morceau parcouru, mémorisés à la fin
+        segments = []
+        before = 0
+        while True:
+            if index >= len(data):
+                raise IndexError("Index out of range for data length")
+            length = data[index]
+            # Pointeur compressé (2 octets) : suivi dans la boucle, sans récursion
+            if length & 0xC0 == 0xC0:
+                if index + 1 >= len(data):
+                    raise IndexError("Pointer index out of range")
+                pointer = ((length & 0x3F) << 8) | data[index + 1]
+                # Un pointeur doit viser un nom antérieur : cela exclut les boucles
+                if pointer >= start:
+                    raise ValueError("Infinite loop detected in pointer")
+                if len(segments) >= MAX_POINTER_HOPS:
+                    raise ValueError("Too many compression pointers")
+                segments.append((start, before, index + 2))
+                cached = self._names.get(pointer)
+                if cached is not None:
+                    suffix = cached[0]
+                    break
+                start = index = pointer
+                before = len(labels)
+                continue
+            # Fin du nom de domaine
+            if length == 0:
+                segments.append((start, before, index + 1))
+                break
+            # Longueur invalide (au-delà de 63 octets)
+            if length > 63:
+                raise ValueError("Invalid label length")
+            index += 1
+            if index + length > len(data):
+                raise IndexError("Label length out of range")
+            labels.append(str(self.view[index : index + length], "utf-8", "replace"))
+            index += length
+        if suffix:
+            labels.append(suffix)
+        for segment_start, first, end in segments:
+            self._names[segment_start] = (".".join(labels[first:]), end)
+        return self._names[segments[0][0]]
+
+    def records(self, sections=(ANSWER,)):
+        """Yields a lazy RecordView for each resource record of the requested sections."""
+        data = self.data
+        index = self.question_end
+        counts = (
+            (ANSWER, self.an_count),
+            (AUTHORITY, self.ns_count),
+            (ADDITIONAL, self.ar_count),
+        )
+        for section, count in counts:
+            wanted = section in sections
+            for _ in range(count):
+                name_offset = index
+                index = skip_domain_name(data, index)
+                rtype, rclass, ttl, rdlength = RECORD_HEADER.unpack_from(data, index)
+                index += 10
+                if index + rdlength > len(data):
+                    raise IndexError("Record data out of range")
+                if wanted:
+                    yield RecordView(
+                        self, section, name_offset, rtype, rclass, ttl, index, rdlength
+                    )
+                index += rdlength
+            if section == sections[-1]:
+                return
+
+    def ttl_fields(self):
+        """Returns [(offset of the TTL field, ttl)] for every record except OPT."""
+        return [
+            (record.rdata_offset - 6, record.ttl)
+            for record in self.records((ANSWER, AUTHORITY, ADDITIONAL))
+            if record.rtype != OPT_TYPE
+        ]
+
+    def min_ttl(self):
+        """Minimum TTL over all records except OPT (None if there is none)."""
+        ttls = [ttl for _offset, ttl in self.ttl_fields()]
+        return min(ttls) if ttls else None
+
+    def to_response_data(self, query_data):
+        """Full decoding, in the format returned by decode_dns_response."""
+        return {
+            "answer": self.an_count,
+            "records": [record.to_dict() for record in self.records()],
+            "query": query_data,
+            "rcode": self.rcode,
+            "edns0": self.ar_count,
+            "truncated": self.truncated,
+        }
+
+
+class RecordView:
+    """Resource record whose owner name and data are decoded only when accessed."""
+
+    __slots__ = (
+        "message",
+        "section",
+        "name_offset",
+        "rtype",
+        "rclass",
+        "ttl",
+        "rdata_offset",
+        "rdlength",
+    )
+
+    def __init__(
+        self, message, section, name_offset, rtype, rclass, ttl, rdata_offset, rdlength
+    ):
+        self.message = message
+        self.section = section
+        self.name_offset = name_offset
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdata_offset = rdata_offset
+        self.rdlength = rdlength
+
+    @property
+    def qname(self):
+        return self.message.read_name(self.name_offset)[0]
+
+    @property
+    def type(self):
+        return query_type_to_string(self.rtype)
+
+    @property
+    def data(self):
+        return decode_rdata(self.message, self.rtype, self.rdata_offset, self.rdlength)
+
+    def to_dict(self):
+        return {
+            "qname": self.qname,
+            "class": self.rclass,
+            "type": self.type,
+            "ttl": self.ttl,
+            "data": self.data,
+        }
+
+
+def decode_rdata(message, rtype, index, rdlength):
+    """Decodes the data of one record, in the textual format used in the logs."""
+    data = message.data
+    view = message.view
+    if rtype == 1:  # Enregistrement A (IPv4)
+        return socket.inet_ntoa(view[index : index + 4])
+    if rtype == 28:  # Enregistrement AAAA (IPv6)
+        return socket.inet_ntop(socket.AF_INET6, view[index : index + 16])
+    if rtype == 15:  # Enregistrement MX
+        preference = struct.unpack_from("!H", data, index)[0]
+        exchange = message.read_name(index + 2)[0]
+        return f"Préférence={preference}, Échange={exchange}"
+    if rtype == 6:  # Enregistrement SOA
+        mname, index = message.read_name(index)
+        rname, index = message.read_name(index)
+        return f"Primary NS={mname}, Responsible NS={rname}"
+    if rtype in (2, 5, 12):  # NS, CNAME, PTR
+        return message.read_name(index)[0]
+    if rtype == 33:  # Enregistrement SRV (Localisateur de service)
+        priority, weight, port = struct.unpack_from("!HHH", data, index)
+        target = message.read_name(index + 6)[0]
+        return f"Priority={priority}, Weight={weight}, Port={port}, Target={target}"
+    if rtype == 65:  # Enregistrement HTTPS spécifique
+        return None
+    if rtype == 16:  # Enregistrement TXT
+        txt_data = []
+        end = index + rdlength  # Délimite la fin des données TXT
+        while index < end:
+            txt_length = data[index]
+            index += 1
+            txt_data.append(str(view[index : index + txt_length], "utf-8", "replace"))
+            index += txt_length
+        return " ".join(txt_data)
+    if rtype == 64:  # Enregistrement SVCB (Service Binding)
+        return message.read_name(index + 2)[0]
+    if rtype == 256:  # Enregistrement URI
+        return str(view[index + 4 : index + rdlength], "utf-8", "replace")
+    if rtype == 13:  # Enregistrement HINFO
+        cpu_length = data[index]
+        cpu_info = str(view[index + 1 : index + 1 + cpu_length], "utf-8", "replace")
+        index += 1 + cpu_length
+        os_length = data[index]
+        os_info = str(view[index + 1 : index + 1 + os_length], "utf-8", "replace")
+        return f"CPU={cpu_info}, OS={os_info}"
+    # Gestion des enregistrements inconnus
+    return (
+        f"Type inconnu (Code {rtype}) - Données brutes: {data[index:index + rdlength]}"
+    )
+
+
+def parse_dns_message(data):
+    """Returns a lazy DNSMessage view over a raw DNS message."""
+    return DNSMessage(data)
+
+
+def decode_dns_query(data):
+    """Decodes DNS query."""
+    message = DNSMessage(data)
+    transaction_id = message.id
+    qd_count = message.qd_count  # Nombre de questions
+    an_count = message.an_count  # Nombre de réponses
+    qname = message.qname
+    qtype, qclass = message.qtype, message.qclass
+    index = message.question_end
     error = False
     if qclass != 1: error = f"Expected class 1, got {qclass}"
     if qd_count != 1: error = f"Expected 1 question, got {qd_count}"
@@ -97,158 +359,8 @@ def decode_dns_query(data):
 # Décode une réponse DNS et retourne un dictionnaire structuré
 def decode_dns_response(data, index, query_data, raw_query_data=None):
     """Décode la réponse DNS et retourne un dictionnaire structuré."""
-    header = struct.unpack("!6H", data[:12])  # 12 premiers octets de l'en-tête
-    an_count = header[3]  # Nombre d'enregistrements de réponse
-    ar_count = header[5] # Nombre d'enregistrements additionnels
-    rcode = header[1] & 0x0F
+    message = data if isinstance(data, DNSMessage) else DNSMessage(data)
+    an_count = message.an_count  # Nombre d'enregistrements de réponse
     assert an_count > 0, f"Expected at least 1 answer, got {an_count}"
+    return message.to_response_data(query_data)
 
-
-    flags = header[1]
-    tc_bit = (flags & 0b00000010) >> 1
-
-    return_list = {
-        "answer": an_count,
-        "records": [],  # Liste contenant tous les enregistrements
-        "query": query_data,  # Les données de la requête
-        "rcode": rcode,
-        "edns0": ar_count,
-        "truncated": tc_bit,
-    }
-
-    for _ in range(an_count):
-        qname, index = decode_domain_name(data, index)
-        # rtype, rclass, ttl, rdlength
-        rtype, rclass, ttl, rdlength = struct.unpack("!HHIH", data[index : index + 10])
-        index += 10
-        # Création de la structure pour chaque enregistrement
-        record = {
-            "qname": qname,
-            "class": rclass,
-            "type": query_type_to_string(rtype),
-            "ttl": ttl,
-            "data": None,  # Ce sera rempli selon le type d'enregistrement
-        }
-
-        # Gestion des différents types d'enregistrements
-        if rtype == 1:  # Enregistrement A (IPv4)
-            record["data"] = socket.inet_ntoa(data[index : index + 4])
-            index += 4
-        elif rtype == 28:  # Enregistrement AAAA (IPv6)
-            record["data"] = socket.inet_ntop(socket.AF_INET6, data[index : index + 16])
-            index += 16
-        elif rtype == 15:  # Enregistrement MX
-            preference = struct.unpack("!H", data[index : index + 2])[0]
-            index += 2
-            exchange = decode_domain_name(data, index)
-            record["data"] = f"Préférence={preference}, Échange={exchange}"
-            index += rdlength - 2
-        elif rtype == 6:  # Enregistrement SOA
-            mname, index = decode_domain_name(data, index)
-            rname, index = decode_domain_name(data, index)
-            record["data"] = f"Primary NS={mname}, Responsible NS={rname}"
-            index += 20
-        elif rtype == 2:  # Enregistrement NS (Serveur de noms)
-            nameserver = decode_domain_name(data, index)
-            record["data"] = nameserver
-            index += rdlength
-        elif rtype == 5:  # Enregistrement CNAME (Nom canonique)
-            cname = decode_domain_name(data, index)
-            record["data"] = cname[0]
-            index += rdlength
-        elif rtype == 12:  # Enregistrement PTR (Pointeur)
-            ptr = decode_domain_name(data, index)
-            record["data"] = ptr[0]
-            index += rdlength
-        elif rtype == 33:  # Enregistrement SRV (Localisateur de service)
-            priority, weight, port = struct.unpack("!HHH", data[index : index + 6])
-            index += 6
-            target = decode_domain_name(data, index)
-            record["data"] = (
-                f"Priority={priority}, Weight={weight}, Port={port}, Target={target}"
-            )
-            index += rdlength - 6
-        elif rtype == 65:  # Enregistrement HTTPS spécifique
-            index += rdlength
-        elif rtype == 16:  # Enregistrement TXT
-            txt_data = []
-            end = index + rdlength  # Délimite la fin des données TXT
-            while index < end:
-                # Récupère la longueur du segment TXT
-                txt_length = data[index]
-                index += 1  # Avance d'un octet (longueur)
-                # Extrait le segment de texte
-                txt_data.append(data[index: index + txt_length].decode('utf-8', errors='replace'))
-                index += txt_length  # Avance selon la longueur du segment
-            # Concatène tous les segments dans le champ "data"
-            record["data"] = " ".join(txt_data)
-        elif rtype == 64:  # Enregistrement SVCB (Service Binding)
-            index += 2
-            target_name, index = decode_domain_name(data, index)
-            record["data"] = target_name
-        elif rtype == 256:  # Enregistrement URI
-            index += 4
-            target = data[index:index + rdlength - 4].decode("utf-8", errors="replace")
-            index += len(target)
-            record["data"] = target
-        elif rtype == 13:  # Enregistrement HINFO
-            cpu_length = data[index]
-            index += 1
-            cpu_info = data[index: index + cpu_length].decode("utf-8", errors="replace")
-            index += cpu_length
-            os_length = data[index]
-            index += 1
-            os_info = data[index: index + os_length].decode("utf-8", errors="replace")
-            index += os_length
-            record["data"] = f"CPU={cpu_info}, OS={os_info}"
-        else:
-            # Gestion des enregistrements inconnus
-            record["data"] = (
-                f"Type inconnu (Code {rtype}) - Données brutes: {data[index:index + rdlength]}"
-            )
-            index += rdlength
-
-            # Ajouter l'enregistrement à la liste
-        return_list["records"].append(record)
-    return return_list
-
-
-
-def decode_domain_name(data, index):
-    labels = []
-    visited_offsets = set()  # Pour détecter les boucles infinies
-
-    while True:
-        if index >= len(data):
-            raise IndexError(f"Index out of range for data length")
-
-        length = data[index]
-
-        # Pointeur compressé (2 octets)
-        if length & 0xC0 == 0xC0:
-            if index + 1 >= len(data):
-                raise IndexError(f"Pointer index out of range")
-            pointer = ((length & 0x3F) << 8) | data[index + 1]
-            if pointer in visited_offsets:
-                raise ValueError(f"Infinite loop detected in pointer")
-            visited_offsets.add(pointer)
-            labels.append(decode_domain_name(data, pointer)[0])
-            return ".".join(labels), index + 2
-
-        # Fin du nom de domaine
-        if length == 0:
-            return ".".join(labels), index + 1
-
-        # Longueur invalide (au-delà de 63 octets)
-        if length > 63:
-            raise ValueError(f"Invalid label length")
-
-        # Lire le label
-        index += 1
-        if index + length > len(data):
-            raise IndexError(f"Label length out of range")
-        try:
-            labels.append(data[index:index + length].decode("utf-8"))
-        except:
-            labels.append(data[index:index + length].decode("utf-8", errors="replace"))
-        index += length
\ No newline at end of file
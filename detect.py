@@ -1,13 +1,52 @@
-from collections import defaultdict
+from collections import OrderedDict, deque
+import os
+import queue
+import threading
 import time
 from logger import log_suspicious_activity
+from psl import registrable_domain
+from sketch import HyperLogLog
+from lexical import create_scorer
+from topk import create_heavy_hitters, endpoint as topk_endpoint
+from metrics import register_endpoint, register, observe
+from decoder import query_type_to_string
 
 # Fenêtre de temps en secondes
 WINDOW_SIZE = 60
-last_logged_subdomains = {}  # Stocke le dernier seuil enregistré pour chaque domaine
+# Nombre de fenêtres conservées dans l'anneau (fenêtre courante + précédente pour les requêtes en retard)
+WHEEL_SLOTS = 2
+# Nombre de shards (un verrou par shard, choisi par hash du domaine parent)
+SHARD_COUNT = 16
+# Limites mémoire : domaines parents suivis par fenêtre, sous-domaines uniques par domaine
+MAX_TRACKED_DOMAINS = 100000
+MAX_UNIQUE_SUBDOMAINS = 100000
+# Noms uniques par client et par fenêtre gardés exacts avant le passage en HyperLogLog
+MAX_CLIENT_UNIQUE_NAMES = 10000
+# Budget global des noms gardés dans des ensembles exacts (domaines et clients, toutes
+# fenêtres confondues). Un ensemble qui atteint MAX_UNIQUE_SUBDOMAINS, ou qui grandit
+# alors que le budget est épuisé, est converti en HyperLogLog (mémoire fixe).
+MAX_TRACKED_NAMES = int(os.getenv("DETECT_MAX_NAMES", "1000000"))
+# Comptage des sous-domaines uniques : "exact" (set) ou "hll" (HyperLogLog, mémoire fixe)
+UNIQUE_COUNTING = os.getenv("DETECT_UNIQUE_COUNTING", "exact")
+HLL_ERROR = float(
+    os.getenv("DETECT_HLL_ERROR", "0.04")
+)  # erreur relative typique en mode hll
+# File de détection : les requêtes sont analysées par un thread dédié, hors du chemin de la réponse.
+# Au-delà de DETECT_QUEUE_SIZE requêtes en attente (environ 100 octets chacune), la politique
+# DETECT_QUEUE_POLICY s'applique : "drop-new" ignore les nouvelles requêtes, "drop-oldest" les plus anciennes.
+DETECT_QUEUE_SIZE = int(os.getenv("DETECT_QUEUE_SIZE", "50000"))
+DETECT_QUEUE_POLICY = os.getenv("DETECT_QUEUE_POLICY", "drop-new")
+DETECT_BATCH_SIZE = int(os.getenv("DETECT_BATCH_SIZE", "512"))
+# Mode multi-processus : intervalle d'envoi des compteurs locaux vers l'agrégateur (secondes)
+AGGREGATION_INTERVAL = 1.0
 
-# Stockage des statistiques par domaine parent
-dns_stats = defaultdict(lambda: {"count": 0, "unique_subdomains": set(), "timestamp": 0})
+# Critères pour lever une alerte
+UNIQUE_SUBDOMAIN_THRESHOLD = 50  # Seuil initial de sous-domaines uniques
+ALERT_INTERVAL = 50  # Intervalle d'alerte pour les sous-domaines uniques
+SUSPICIOUS_QUERY_THRESHOLD = 100  # Volume de requêtes pour les types suspects
+SUSPICIOUS_QUERY_TYPES = frozenset(
+    {16, 5}
+)  # TXT, CNAME : qtype numérique, comme dans decode_dns_query
 
 
 def validate_domain(domain):
@@ -19,55 +58,553 @@ def validate_domain(domain):
 
 def extract_parent_domain(domain):
     """
-    Extrait le domaine parent (par exemple, tunnel.bonnivard.net) d'un domaine complet.
+    Extrait le domaine parent enregistrable (par exemple, bonnivard.net ou bbc.co.uk)
+    d'un domaine complet, d'après la Public Suffix List.
     """
     if not validate_domain(domain):
         return None
 
-    parts = domain.split(".")
-    if len(parts) < 2:
-        return None
-    return ".".join(parts[-2:])  # Dernier et avant-dernier segments
+    return registrable_domain(domain.lower().rstrip("."))
 
 
 def extract_subdomain(domain):
     """
     Extrait le sous-domaine d'un domaine complet (tout ce qui précède le domaine parent).
     """
-    if not validate_domain(domain):
+    parent_domain = extract_parent_domain(domain)
+    if not parent_domain:
         return None
 
-    parts = domain.split(".")
-    if len(parts) < 3:
+    domain = domain.lower().rstrip(".")
+    if len(domain) <= len(parent_domain):
         return None  # Pas de sous-domaine
-    return ".".join(parts[:-2])  # Tout sauf les deux derniers segments
+    return domain[: -len(parent_domain) - 1]
+
+
+def new_unique_counter():
+    """Ensemble exact ou esquisse HyperLogLog selon UNIQUE_COUNTING."""
+    if UNIQUE_COUNTING == "hll":
+        return HyperLogLog(error=HLL_ERROR)
+    return set()
+
+
+def sketch_of(names):
+    """HyperLogLog reprenant les noms d'un ensemble exact."""
+    sketch = HyperLogLog(error=HLL_ERROR)
+    for name in names:
+        sketch.add(name)
+    return sketch
+
+
+def add_capped(unique, name, cap):
+    """Ajoute name ; un ensemble exact qui dépasserait cap devient un HyperLogLog. Retourne le compteur."""
+    if isinstance(unique, set) and len(unique) >= cap and name not in unique:
+        unique = sketch_of(unique)
+    unique.add(name)
+    return unique
+
+
+class NameBudget:
+    """Nombre de noms gardés dans des ensembles exacts, partagé par tous les shards."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
+
+    def release(self, count):
+        if count:
+            with self.lock:
+                self.used -= count
+
+
+class WindowStats:
+    """Statistiques d'un domaine parent (ou d'un client) pour une fenêtre."""
+
+    __slots__ = ("count", "unique_subdomains")
+
+    def __init__(self):
+        self.count = 0
+        self.unique_subdomains = new_unique_counter()
+
+
+class Window:
+    """Une fenêtre de l'anneau : statistiques par clé et noms exacts qu'elles retiennent."""
+
+    __slots__ = ("number", "stats", "names")
+
+    def __init__(self, number):
+        self.number = number
+        self.stats = OrderedDict()  # clé (domaine parent ou client) -> WindowStats
+        self.names = 0  # noms comptés dans le budget global
+
+
+class AlertState:
+    """État d'alerte d'un domaine, gardé d'une fenêtre à l'autre."""
+
+    __slots__ = ("last_logged",)
+
+    def __init__(self):
+        self.last_logged = 0  # Dernier seuil de sous-domaines uniques enregistré
+
+
+def check_alerts(stats, alert_state, query_type, unique=True, suspicious_queries=1):
+    """
+    Critères pour lever une alerte sur les statistiques d'une fenêtre (appelé sous le verrou).
+    Retourne la liste des alertes (paramètres de log_suspicious_activity, sans client_address).
+    """
+    alerts = []
+    unique_subdomain_count = len(stats.unique_subdomains)
+
+    # Alerte basée sur le nombre élevé de sous-domaines uniques
+    if unique and unique_subdomain_count > UNIQUE_SUBDOMAIN_THRESHOLD:
+        # Vérifier si un nouveau seuil est atteint
+        if unique_subdomain_count >= alert_state.last_logged + ALERT_INTERVAL:
+            alerts.append(
+                {
+                    "unique_count": unique_subdomain_count,
+                    "alert_level": "high",
+                    "additional_info": {
+                        "alert_reason": "High number of unique subdomains",
+                        "query_count": stats.count,
+                        "query_type": query_type,
+                    },
+                }
+            )
+            # Mettre à jour le dernier seuil logué
+            alert_state.last_logged = unique_subdomain_count
+
+    # Alerte basée sur un volume élevé de requêtes avec un type suspect
+    if (
+        stats.count > SUSPICIOUS_QUERY_THRESHOLD
+        and query_type in SUSPICIOUS_QUERY_TYPES
+    ):
+        additional_info = {
+            "alert_reason": f"High query volume for type {query_type_to_string(query_type)}",
+            "query_count": stats.count,
+            "unique_subdomains_count": unique_subdomain_count,
+            "query_type": query_type,
+        }
+        if suspicious_queries > 1:
+            additional_info["suspicious_queries"] = suspicious_queries
+        alerts.append(
+            {
+                "unique_count": unique_subdomain_count,
+                "alert_level": "medium",
+                "additional_info": additional_info,
+            }
+        )
+    return alerts
+
+
+class DetectorShard:
+    """
+    Roue temporelle (anneau de WHEEL_SLOTS fenêtres) pour une partie des domaines.
+    Une fenêtre expirée est remplacée d'un bloc quand l'anneau revient sur son
+    emplacement : l'expiration ne parcourt jamais les domaines.
+    """
+
+    def __init__(self, max_domains, budget, max_names=MAX_UNIQUE_SUBDOMAINS):
+        self.lock = threading.Lock()
+        self.max_domains = max_domains
+        self.budget = budget
+        self.max_names = max_names
+        self.slots = [None] * WHEEL_SLOTS  # Window par emplacement de l'anneau
+        self.alert_states = OrderedDict()  # domaine -> AlertState, au plus max_domains
+        self.evictions = 0
+        self.sketches = 0  # ensembles exacts convertis en HyperLogLog
+
+    def window(self, window_number):
+        """Retourne la fenêtre (None si elle est déjà sortie de l'anneau)."""
+        slot = window_number % WHEEL_SLOTS
+        window = self.slots[slot]
+        if window is None or window.number < window_number:
+            if window is not None:
+                self.budget.release(window.names)
+            window = Window(window_number)
+            self.slots[slot] = window
+        elif window.number > window_number:
+            return None
+        return window
+
+    def stats_for(self, window_number, key):
+        """Retourne (fenêtre, statistiques de key), ou (None, None) pour une fenêtre trop ancienne."""
+        window = self.window(window_number)
+        if window is None:
+            return None, None
+        domains = window.stats
+        stats = domains.get(key)
+        if stats is None:
+            # Plafond mémoire : on évince le domaine le moins récemment vu
+            if len(domains) >= self.max_domains:
+                _key, evicted = domains.popitem(last=False)
+                self._release(window, evicted)
+                self.evictions += 1
+            stats = WindowStats()
+            domains[key] = stats
+        else:
+            domains.move_to_end(key)
+        return window, stats
+
+    def _release(self, window, stats):
+        if isinstance(stats.unique_subdomains, set):
+            window.names -= len(stats.unique_subdomains)
+            self.budget.release(len(stats.unique_subdomains))
+
+    def _to_sketch(self, window, stats):
+        sketch = sketch_of(stats.unique_subdomains)
+        self._release(window, stats)
+        stats.unique_subdomains = sketch
+        self.sketches += 1
+        return sketch
+
+    def add_name(self, window, stats, name):
+        """Ajoute un nom unique ; l'ensemble exact passe en HyperLogLog au plafond ou sans budget."""
+        unique = stats.unique_subdomains
+        if isinstance(unique, set):
+            if name in unique:
+                return
+            if len(unique) < self.max_names and self.budget.take():
+                unique.add(name)
+                window.names += 1
+                return
+            unique = self._to_sketch(window, stats)
+        unique.add(name)
+
+    def merge_names(self, window, stats, names):
+        """Union avec les noms d'un delta de worker (ensemble ou esquisse)."""
+        if isinstance(names, set):
+            for name in names:
+                self.add_name(window, stats, name)
+            return
+        unique = stats.unique_subdomains
+        if isinstance(unique, set):
+            unique = self._to_sketch(window, stats)
+        unique.merge(names)
+
+    def alert_state(self, key):
+        state = self.alert_states.get(key)
+        if state is None:
+            if len(self.alert_states) >= self.max_domains:
+                self.alert_states.popitem(last=False)
+            state = self.alert_states[key] = AlertState()
+        else:
+            self.alert_states.move_to_end(key)
+        return state
+
+    def tracked_domains(self):
+        with self.lock:
+            return sum(len(window.stats) for window in self.slots if window is not None)
+
+
+class DetectorState:
+    """Statistiques glissantes par domaine parent, réparties sur des shards verrouillés."""
+
+    def __init__(
+        self,
+        shard_count=SHARD_COUNT,
+        max_domains=MAX_TRACKED_DOMAINS,
+        max_names=MAX_TRACKED_NAMES,
+        max_unique=MAX_UNIQUE_SUBDOMAINS,
+        max_client_unique=MAX_CLIENT_UNIQUE_NAMES,
+    ):
+        self.budget = NameBudget(max_names)
+        per_shard = max(1, max_domains // shard_count)
+        self.shards = [
+            DetectorShard(per_shard, self.budget, max_unique)
+            for _ in range(shard_count)
+        ]
+        # Noms uniques demandés par chaque client, tous domaines confondus
+        self.client_shards = [
+            DetectorShard(per_shard, self.budget, max_client_unique)
+            for _ in range(shard_count)
+        ]
+
+    def shard(self, parent_domain):
+        return self.shards[hash(parent_domain) % len(self.shards)]
+
+    def record_client(self, client_address, domain, timestamp):
+        """Compte les noms uniques demandés par un client et retourne ce nombre."""
+        window_number = int(timestamp // WINDOW_SIZE)
+        shard = self.client_shards[hash(client_address) % len(self.client_shards)]
+        with shard.lock:
+            window, stats = shard.stats_for(window_number, client_address)
+            if stats is None:
+                return 0
+            shard.add_name(window, stats, domain)
+            stats.count += 1
+            return len(stats.unique_subdomains)
+
+    def record(self, parent_domain, subdomain, query_type, timestamp):
+        """
+        Met à jour la fenêtre courante du domaine et retourne la liste des alertes à lever
+        (paramètres de log_suspicious_activity, sans client_address).
+        """
+        window_number = int(timestamp // WINDOW_SIZE)
+        shard = self.shard(parent_domain)
+        alerts = []
+        with shard.lock:
+            window, stats = shard.stats_for(window_number, parent_domain)
+            if stats is None:
+                return alerts
+
+            # Mettre à jour les statistiques
+            if subdomain:  # Ne pas ajouter None
+                shard.add_name(window, stats, subdomain)
+            stats.count += 1
+            return check_alerts(stats, shard.alert_state(parent_domain), query_type)
+
+    def merge(self, window_number, parent_domain, delta):
+        """
+        Fusionne le delta d'un worker (mode --workers) dans la vue globale et
+        retourne les alertes à lever, comme record().
+        """
+        shard = self.shard(parent_domain)
+        alerts = []
+        with shard.lock:
+            window, stats = shard.stats_for(window_number, parent_domain)
+            if stats is None:
+                return alerts
+            shard.merge_names(window, stats, delta.unique_subdomains)
+            stats.count += delta.count
+            # Le seuil de sous-domaines uniques est vérifié une fois par fusion ; pour les
+            # types suspects, on compte les requêtes du delta passées au-delà du seuil.
+            alert_state = shard.alert_state(parent_domain)
+            alerts = check_alerts(stats, alert_state, None)
+            for query_type, queries in delta.suspicious.items():
+                over = min(queries, stats.count - SUSPICIOUS_QUERY_THRESHOLD)
+                if over > 0:
+                    alerts.extend(
+                        check_alerts(
+                            stats,
+                            alert_state,
+                            query_type,
+                            unique=False,
+                            suspicious_queries=over,
+                        )
+                    )
+        return alerts
+
+    def merge_client(self, window_number, client_address, names):
+        """Fusionne les noms demandés par un client dans un worker ; retourne le nombre de noms uniques."""
+        shard = self.client_shards[hash(client_address) % len(self.client_shards)]
+        with shard.lock:
+            window, stats = shard.stats_for(window_number, client_address)
+            if stats is None:
+                return 0
+            shard.merge_names(window, stats, names)
+            return len(stats.unique_subdomains)
+
+    def client_unique_count(self, window_number, client_address):
+        shard = self.client_shards[hash(client_address) % len(self.client_shards)]
+        with shard.lock:
+            window = shard.window(window_number)
+            stats = window.stats.get(client_address) if window is not None else None
+            return len(stats.unique_subdomains) if stats is not None else 0
 
+    def tracked_domains(self):
+        return sum(shard.tracked_domains() for shard in self.shards)
 
-def cleanup_expired_windows():
+    def stats(self):
+        shards = self.shards + self.client_shards
+        return {
+            "domains": self.tracked_domains(),
+            "names": self.budget.used,
+            "sketches": sum(shard.sketches for shard in shards),
+            "evictions": sum(shard.evictions for shard in shards),
+        }
+
+
+detector_state = DetectorState()
+
+
+class WindowDelta:
+    """Compteurs accumulés localement par un worker entre deux envois à l'agrégateur."""
+
+    __slots__ = ("count", "unique_subdomains", "suspicious", "client_address")
+
+    def __init__(self):
+        self.count = 0
+        self.unique_subdomains = new_unique_counter()
+        self.suspicious = {}  # type de requête suspect -> nombre de requêtes
+        self.client_address = None  # dernier client vu, utilisé pour les alertes
+
+
+class DeltaRecorder:
     """
-    Supprime les données des fenêtres temporelles expirées.
+    Remplace la détection locale dans un worker : les compteurs sont accumulés
+    puis envoyés périodiquement à l'agrégateur, qui lève les alertes sur la vue
+    fusionnée de tous les workers.
     """
-    current_time = time.time()
-    expired_keys = [key for key, value in dns_stats.items() if current_time - value["timestamp"] > WINDOW_SIZE]
-    for key in expired_keys:
-        del dns_stats[key]
 
+    def __init__(self, aggregation_queue, interval=AGGREGATION_INTERVAL):
+        self.queue = aggregation_queue
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.domains = {}  # (numéro de fenêtre, domaine parent) -> WindowDelta
+        self.clients = {}  # (numéro de fenêtre, client) -> noms uniques
+        self.dropped_batches = 0
+        threading.Thread(
+            target=self._flush_loop, daemon=True, name="detect-aggregation"
+        ).start()
+
+    def record(
+        self, parent_domain, subdomain, domain, query_type, client_address, timestamp
+    ):
+        window_number = int(timestamp // WINDOW_SIZE)
+        with self.lock:
+            delta = self.domains.get((window_number, parent_domain))
+            if delta is None:
+                delta = self.domains[(window_number, parent_domain)] = WindowDelta()
+            delta.count += 1
+            if subdomain:
+                delta.unique_subdomains = add_capped(
+                    delta.unique_subdomains, subdomain, MAX_UNIQUE_SUBDOMAINS
+                )
+            if query_type in SUSPICIOUS_QUERY_TYPES:
+                delta.suspicious[query_type] = delta.suspicious.get(query_type, 0) + 1
+            delta.client_address = client_address
+
+            # Mêmes plafonds que dans l'agrégateur : un client très actif ne garde pas un ensemble exact entre deux envois
+            key = (window_number, client_address)
+            names = self.clients.get(key)
+            if names is None:
+                names = new_unique_counter()
+            self.clients[key] = add_capped(names, domain, MAX_CLIENT_UNIQUE_NAMES)
+
+    def flush(self):
+        lexical = {}
+        if lexical_scorer is not None:
+            lexical_scorer.flush()
+            lexical = lexical_scorer.take_exported()
+        with self.lock:
+            domains, self.domains = self.domains, {}
+            clients, self.clients = self.clients, {}
+        if not domains and not clients and not lexical:
+            return
+        try:
+            self.queue.put_nowait((domains, clients, lexical))
+        except queue.Full:
+            self.dropped_batches += 1
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+delta_recorder = None
+# Destination des alertes (Elasticsearch par défaut, remplaçable pour l'analyse hors ligne)
+alert_handler = log_suspicious_activity
+# Score lexical des noms (None si désactivé ou sans NumPy)
+lexical_scorer = create_scorer(WINDOW_SIZE)
+# Tables top-k des noms, domaines, clients et (client, type) les plus actifs (None si désactivées)
+heavy_hitters = create_heavy_hitters()
+register_endpoint("/topk", topk_endpoint(heavy_hitters))
+
+
+def enable_aggregation(aggregation_queue):
+    """Active le mode worker : detect_anomalies n'envoie plus que des deltas à l'agrégateur."""
+    global delta_recorder
+    if lexical_scorer is not None:
+        lexical_scorer.enable_export()
+    delta_recorder = DeltaRecorder(aggregation_queue)
 
-def get_window_key(domain):
+
+def set_alert_handler(handler):
+    """Remplace l'envoi des alertes à Elasticsearch (handler reçoit les paramètres de log_suspicious_activity)."""
+    global alert_handler
+    alert_handler = handler
+
+
+def attach_lexical_summary(alert, parent_domain):
+    if lexical_scorer is not None:
+        summary = lexical_scorer.summary(parent_domain)
+        if summary is not None:
+            alert["additional_info"]["lexical"] = summary
+
+
+def merge_deltas(domains, clients, lexical):
+    """Fusionne un lot de deltas envoyé par un worker et lève les alertes."""
+    for (window_number, client_address), names in clients.items():
+        detector_state.merge_client(window_number, client_address, names)
+    if lexical_scorer is not None:
+        for parent_domain, (
+            names,
+            total,
+            high,
+            max_score,
+            client_address,
+            window_number,
+        ) in lexical.items():
+            alert = lexical_scorer.merge(
+                parent_domain, names, total, high, max_score, window_number
+            )
+            if alert is not None:
+                alert_handler(
+                    public_suffix=parent_domain, client_address=client_address, **alert
+                )
+    # Fenêtres dans l'ordre chronologique : l'anneau ne garde que les plus récentes
+    for (window_number, parent_domain), delta in sorted(
+        domains.items(), key=lambda item: item[0][0]
+    ):
+        for alert in detector_state.merge(window_number, parent_domain, delta):
+            alert["additional_info"]["client_unique_names"] = (
+                detector_state.client_unique_count(window_number, delta.client_address)
+            )
+            attach_lexical_summary(alert, parent_domain)
+            alert_handler(
+                public_suffix=parent_domain,
+                client_address=delta.client_address,
+                **alert,
+            )
+
+
+def broadcast_alerts(worker_queues):
     """
-    Génère une clé unique pour une fenêtre temporelle donnée.
+    Agrégateur : chaque alerte levée est aussi envoyée aux workers (receive_alerts),
+    qui ne voient pas les alertes de la vue fusionnée.
     """
-    current_time = time.time()
-    window_start = int(current_time // WINDOW_SIZE) * WINDOW_SIZE
-    return (domain, window_start)
+    handler = alert_handler
+
+    def broadcast(public_suffix, **kwargs):
+        handler(public_suffix=public_suffix, **kwargs)
+        for worker_queue in worker_queues:
+            try:
+                worker_queue.put_nowait(public_suffix)
+            except queue.Full:
+                pass  # worker arrêté ou en retard : l'alerte est perdue pour lui
+
+    set_alert_handler(broadcast)
+
+
+def receive_alerts(alert_queue, handler):
+    """Worker : appelle handler(domaine) pour chaque alerte diffusée par l'agrégateur."""
+
+    def loop():
+        while True:
+            handler(alert_queue.get())
 
+    threading.Thread(target=loop, daemon=True, name="detect-alerts").start()
 
-def detect_anomalies(domain, query_type, client_address):
+
+def run_aggregator(aggregation_queue):
+    """Boucle de l'agrégateur : fusionne les deltas des workers et lève les alertes."""
+    while True:
+        merge_deltas(*aggregation_queue.get())
+
+
+def detect_anomalies(domain, query_type, client_address, timestamp=None):
     """
     Détecte les anomalies DNS basées sur les statistiques globales regroupées par domaine parent.
     """
-    global dns_stats
-
     if isinstance(domain, bytes):
         domain = domain.decode("utf-8")
 
@@ -75,9 +612,6 @@ def detect_anomalies(domain, query_type, client_address):
         print(f"[INFO] Domaine invalide ou local ignoré : {domain}")
         return
 
-    # Nettoyage des anciennes fenêtres
-    cleanup_expired_windows()
-
     # Extraire le domaine parent et le sous-domaine
     parent_domain = extract_parent_domain(domain)
     subdomain = extract_subdomain(domain)
@@ -86,58 +620,175 @@ def detect_anomalies(domain, query_type, client_address):
         print(f"[INFO] Impossible d'extraire le domaine parent pour {domain}")
         return
 
-    # Calculer la clé temporelle
-    key = get_window_key(parent_domain)
-    if key not in dns_stats:
-        dns_stats[key] = {"count": 0, "unique_subdomains": set(), "timestamp": time.time()}
+    if timestamp is None:
+        timestamp = time.time()
 
-    # Mettre à jour les statistiques
-    if subdomain:  # Ne pas ajouter None
-        dns_stats[key]["unique_subdomains"].add(subdomain)
-    dns_stats[key]["count"] += 1
+    # Tables top-k locales au processus (en mode --workers, une par worker)
+    if heavy_hitters is not None:
+        heavy_hitters.record(
+            domain,
+            parent_domain,
+            client_address,
+            query_type_to_string(query_type),
+            timestamp,
+        )
 
-    # Critères pour lever une alerte
-    alert_interval = 50  # Intervalle d'alerte pour les sous-domaines uniques
+    # Les noms sont scorés par micro-lots ; en mode worker les scores partent avec les deltas
+    lexical_alerts = []
+    if lexical_scorer is not None and subdomain:
+        lexical_alerts = lexical_scorer.add(
+            parent_domain, subdomain, client_address, timestamp=timestamp
+        )
 
-    # Alerte basée sur le nombre élevé de sous-domaines uniques
-    unique_subdomain_count = len(dns_stats[key]["unique_subdomains"])
-    if unique_subdomain_count > 50:  # Seuil initial de 50
-        # Dernier seuil enregistré pour ce domaine
-        last_threshold = last_logged_subdomains.get(parent_domain, 0)
+    if delta_recorder is not None:
+        delta_recorder.record(
+            parent_domain, subdomain, domain, query_type, client_address, timestamp
+        )
+        return
 
-        # Vérifier si un nouveau seuil est atteint
-        if unique_subdomain_count >= last_threshold + alert_interval:
+    for lexical_parent, lexical_client, alert in lexical_alerts:
+        alert_handler(
+            public_suffix=lexical_parent, client_address=lexical_client, **alert
+        )
 
-            # Log dans Elasticsearch
-            log_suspicious_activity(
-                public_suffix=parent_domain,
-                unique_count=unique_subdomain_count,
-                client_address=client_address,
-                alert_level="high",
-                additional_info={
-                    "alert_reason": "High number of unique subdomains",
-                    "query_count": dns_stats[key]["count"],
-                    "query_type": query_type
-                }
-            )
+    client_unique_count = detector_state.record_client(
+        client_address, domain, timestamp
+    )
 
-            # Mettre à jour le dernier seuil logué
-            last_logged_subdomains[parent_domain] = unique_subdomain_count
+    # Les alertes sont envoyées hors du verrou du shard
+    for alert in detector_state.record(parent_domain, subdomain, query_type, timestamp):
+        alert["additional_info"]["client_unique_names"] = client_unique_count
+        attach_lexical_summary(alert, parent_domain)
+        alert_handler(
+            public_suffix=parent_domain, client_address=client_address, **alert
+        )
 
-    # Alerte basée sur un volume élevé de requêtes avec un type suspect
-    if dns_stats[key]["count"] > 100 and query_type in ["TXT", "CNAME"]:  # Volume élevé avec type suspect
-
-        # Log dans Elasticsearch
-        log_suspicious_activity(
-            public_suffix=parent_domain,
-            unique_count=len(dns_stats[key]["unique_subdomains"]),
-            client_address=client_address,
-            alert_level="medium",
-            additional_info={
-                "alert_reason": f"High query volume for type {query_type}",
-                "query_count": dns_stats[key]["count"],
-                "unique_subdomains_count": len(dns_stats[key]["unique_subdomains"]),
-                "query_type": query_type
-            }
+
+class DetectionQueue:
+    """
+    File bornée de (horodatage, qname, qtype, client) vidée par lots par un thread.
+    Les producteurs (threads ou boucle asyncio) ne prennent aucun verrou : append
+    et popleft d'un deque sont atomiques ; l'Event ne sert qu'à réveiller le
+    thread quand la file était vide.
+    """
+
+    def __init__(
+        self,
+        max_size=DETECT_QUEUE_SIZE,
+        policy=DETECT_QUEUE_POLICY,
+        batch_size=DETECT_BATCH_SIZE,
+    ):
+        if policy not in ("drop-new", "drop-oldest"):
+            raise ValueError(
+                f"Unknown detection queue policy {policy!r}, expected drop-new or drop-oldest"
+            )
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.items = deque()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+        # Compteurs
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0  # requêtes dont l'analyse a levé une exception
+        self.lag = 0.0  # retard du dernier lot traité (s)
+
+    def submit(self, domain, query_type, client_address, timestamp=None):
+        if self.thread is None:
+            self._start()
+        self.submitted += 1
+        if len(self.items) >= self.max_size:
+            self.dropped += 1
+            if self.policy == "drop-new":
+                return False
+            try:
+                self.items.popleft()
+            except IndexError:
+                pass
+        self.items.append(
+            (timestamp or time.time(), domain, query_type, client_address)
         )
+        if not self.wakeup.is_set():
+            self.wakeup.set()
+        return True
+
+    def _start(self):
+        with self.thread_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, daemon=True, name="detect-queue"
+                )
+                self.thread.start()
+
+    def _take_batch(self):
+        batch = []
+        items = self.items
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(items.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                self.wakeup.clear()
+                if not self.items:
+                    self.wakeup.wait(1.0)
+                continue
+            start = time.time()
+            self.lag = start - batch[0][0]
+            observe("detect_lag", "queue", self.lag)
+            self.errors += detect_batch(batch)
+            self.processed += len(batch)
+            observe("detect_batch", "queue", time.time() - start)
+
+    def stats(self):
+        return {
+            "queued": len(self.items),
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "errors": self.errors,
+        }
+
+
+def detect_batch(batch):
+    """Analyse un lot de (horodatage, qname, qtype, client) ; retourne le nombre de requêtes en erreur."""
+    errors = 0
+    for timestamp, domain, query_type, client_address in batch:
+        try:
+            detect_anomalies(domain, query_type, client_address, timestamp=timestamp)
+        except Exception as e:
+            errors += 1  # exporté par dns_proxy_detect_queue{event="errors"}
+            if errors == 1:
+                print(f"Detection error : {e}")
+    return errors
+
 
+register(
+    "dns_proxy_detect_state",
+    "Tracked parent domains, names held in exact sets, sets converted to sketches and evicted keys.",
+    lambda: {
+        (("event", name),): value for name, value in detector_state.stats().items()
+    },
+)
+detection_queue = DetectionQueue()
+submit_detection = detection_queue.submit
+register(
+    "dns_proxy_detect_queue",
+    "Detection queue depth and submitted, dropped, processed and failed queries.",
+    lambda: {
+        (("event", name),): value for name, value in detection_queue.stats().items()
+    },
+)
+register(
+    "dns_proxy_detect_lag_seconds",
+    "Age of the oldest query in the last batch analysed.",
+    lambda: detection_queue.lag,
+)
@@ -0,0 +1,394 @@
+"""
+Score lexical des noms de requêtes pour la détection de tunnels DNS.
+
+Un tunnel encode ses données dans les sous-domaines : labels longs, alphabet
+base32/hexadécimal, forte entropie et enchaînements de caractères rares. Ces
+caractéristiques sont calculées avec NumPy sur des micro-lots de noms récents
+(une matrice d'octets par lot) plutôt que nom par nom en Python :
+
+  - entropie de Shannon des caractères du sous-domaine (bits par caractère)
+  - longueur du plus long label et du sous-domaine
+  - proportion de chiffres et de caractères hexadécimaux
+  - rareté des bigrammes (-log2 P(b|a), modèle appris sur un corpus de noms courants)
+
+Les scores (0 = nom ordinaire, 1 = nom typique d'un tunnel) sont cumulés par
+domaine parent sur les fenêtres de temps de detect.py : ils sont joints aux
+alertes et lèvent une alerte dédiée quand un domaine accumule assez de noms
+suspects dans une fenêtre, même à faible débit.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LEXICAL_SCORING = os.getenv("DETECT_LEXICAL", "on") != "off"
+LEXICAL_BATCH_SIZE = int(os.getenv("DETECT_LEXICAL_BATCH", "256"))  # noms par micro-lot
+LEXICAL_MAX_DELAY = 1.0  # un lot incomplet est traité après ce délai (secondes)
+LEXICAL_THRESHOLD = 0.6  # score au-delà duquel un nom est compté comme suspect
+LEXICAL_ALERT_NAMES = (
+    20  # noms suspects cumulés par domaine avant alerte (puis tous les 20)
+)
+LEXICAL_CORPUS = os.getenv("DETECT_LEXICAL_CORPUS")  # un nom ou un mot par ligne
+MAX_SCORED_DOMAINS = 100000
+WINDOW_SIZE = 60  # secondes, remplacé par detect.WINDOW_SIZE dans create_scorer()
+MAX_NAME_LENGTH = 253
+
+# Alphabet : 0 = remplissage, 1-26 lettres, 27-36 chiffres, 37 '-', 38 autre, 39 '.'
+ALPHABET_SIZE = 40
+DOT = 39
+FEATURES = (
+    "entropy",
+    "max_label_length",
+    "length",
+    "digit_ratio",
+    "hex_ratio",
+    "bigram_rarity",
+)
+
+
+def build_lookup():
+    lookup = np.full(256, 38, dtype=np.uint8)
+    lookup[0] = 0
+    for offset, char in enumerate(b"abcdefghijklmnopqrstuvwxyz"):
+        lookup[char] = 1 + offset
+        lookup[char - 32] = 1 + offset  # majuscules
+    for offset, char in enumerate(b"0123456789"):
+        lookup[char] = 27 + offset
+    lookup[ord("-")] = 37
+    lookup[ord(".")] = DOT
+    return lookup
+
+
+def default_corpus():
+    """Mots du corpus : DETECT_LEXICAL_CORPUS, sinon les labels de la Public Suffix List."""
+    from psl import default_psl_file
+
+    path = LEXICAL_CORPUS or default_psl_file()
+    if path is None:
+        return []
+    words = []
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            line = line.strip().lower()
+            if not line or line.startswith("//"):
+                continue
+            words.extend(
+                label
+                for label in line.split()[0].lstrip("!*.").split(".")
+                if label.isascii()
+            )
+    return words
+
+
+class BigramModel:
+    """Table des -log2 P(b|a) apprise sur un corpus, avec lissage de Laplace."""
+
+    def __init__(self, words=()):
+        lookup = build_lookup()
+        counts = np.ones((ALPHABET_SIZE, ALPHABET_SIZE), dtype=np.float64)
+        for word in words:
+            codes = lookup[
+                np.frombuffer(word.encode("ascii", "ignore"), dtype=np.uint8)
+            ]
+            if len(codes) > 1:
+                np.add.at(counts, (codes[:-1], codes[1:]), 1)
+        self.cost = -np.log2(counts / counts.sum(axis=1, keepdims=True))
+        self.max_cost = float(np.log2(ALPHABET_SIZE))
+
+
+class LexicalScorer:
+    def __init__(
+        self,
+        model=None,
+        batch_size=LEXICAL_BATCH_SIZE,
+        max_delay=LEXICAL_MAX_DELAY,
+        threshold=LEXICAL_THRESHOLD,
+        alert_names=LEXICAL_ALERT_NAMES,
+        max_domains=MAX_SCORED_DOMAINS,
+        window_size=WINDOW_SIZE,
+    ):
+        self.lookup = build_lookup()
+        self.model = model if model is not None else BigramModel(default_corpus())
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.alert_names = alert_names
+        self.max_domains = max_domains
+        self.window_size = window_size
+        self.lock = threading.Lock()
+        self.pending = []  # (domaine parent, sous-domaine, client, horodatage)
+        self.pending_since = None
+        # domaine parent -> [noms, somme des scores, noms suspects, max, dernier palier, fenêtre]
+        self.domains = OrderedDict()
+        # mode worker : domaine parent -> [noms, somme, suspects, max, client, fenêtre] à envoyer
+        self.exported = None
+        self.batches = 0
+
+    # Calcul vectorisé
+
+    def encode(self, names):
+        """Matrice (n, longueur max) des codes de caractères, 0 au-delà de la fin du nom."""
+        width = min(max(len(name) for name in names), MAX_NAME_LENGTH)
+        raw = b"".join(
+            name.encode("ascii", "replace")[:width].ljust(width, b"\0")
+            for name in names
+        )
+        return self.lookup[
+            np.frombuffer(raw, dtype=np.uint8).reshape(len(names), width)
+        ]
+
+    def features(self, names):
+        """Caractéristiques lexicales d'un lot de noms (dict de tableaux NumPy de longueur n)."""
+        codes = self.encode(names)
+        count, width = codes.shape
+        valid = codes != 0
+        chars = valid & (codes != DOT)
+        lengths = chars.sum(axis=1)
+        safe_lengths = np.maximum(lengths, 1)
+
+        # Histogramme des caractères par nom -> entropie de Shannon
+        histogram = np.zeros((count, ALPHABET_SIZE), dtype=np.int32)
+        rows = np.broadcast_to(np.arange(count)[:, None], codes.shape)
+        np.add.at(histogram, (rows[chars], codes[chars]), 1)
+        probabilities = histogram / safe_lengths[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            entropy = -np.where(
+                histogram > 0, probabilities * np.log2(probabilities), 0.0
+            ).sum(axis=1)
+
+        digits = histogram[:, 27:37].sum(axis=1)
+        hex_letters = histogram[:, 1:7].sum(axis=1)
+
+        # Longueur du plus long label : distance au dernier point (ou au début)
+        positions = np.arange(width)
+        boundaries = np.where(codes == DOT, positions, -1)
+        last_boundary = np.maximum.accumulate(boundaries, axis=1)
+        max_label = np.where(chars, positions - last_boundary, 0).max(axis=1, initial=0)
+
+        # Rareté moyenne des bigrammes à l'intérieur des labels
+        if width > 1:
+            pairs = chars[:, :-1] & chars[:, 1:]
+            costs = self.model.cost[codes[:, :-1], codes[:, 1:]]
+            rarity = np.where(pairs, costs, 0.0).sum(axis=1) / np.maximum(
+                pairs.sum(axis=1), 1
+            )
+        else:
+            rarity = np.zeros(count)
+
+        return {
+            "entropy": entropy,
+            "max_label_length": max_label,
+            "length": lengths,
+            "digit_ratio": digits / safe_lengths,
+            "hex_ratio": (digits + hex_letters) / safe_lengths,
+            "bigram_rarity": rarity,
+        }
+
+    def score(self, features):
+        """Combine les caractéristiques en un score entre 0 et 1."""
+        entropy = np.clip((features["entropy"] - 2.5) / 2.0, 0, 1)
+        label = np.clip((features["max_label_length"] - 10) / 30, 0, 1)
+        length = np.clip((features["length"] - 20) / 80, 0, 1)
+        digits = np.clip(features["digit_ratio"] / 0.3, 0, 1)
+        hex_only = (features["hex_ratio"] > 0.95) & (features["length"] >= 16)
+        rarity = np.clip(
+            (features["bigram_rarity"] - 3.5) / (self.model.max_cost - 3.5), 0, 1
+        )
+        score = (
+            0.25 * entropy + 0.2 * label + 0.1 * length + 0.15 * digits + 0.3 * rarity
+        )
+        # Les noms très courts ne portent pas de données, quelle que soit leur forme
+        score = np.where(features["length"] < 8, score * 0.5, score)
+        return np.clip(np.maximum(score, np.where(hex_only, 0.8, 0.0)), 0, 1)
+
+    def score_names(self, names):
+        features = self.features(names)
+        return self.score(features), features
+
+    # Micro-lots
+
+    def add(self, parent_domain, subdomain, client_address, now=None, timestamp=None):
+        """
+        Ajoute un nom au lot courant. Quand le lot est plein (ou trop ancien), il est
+        scoré par l'appelant et les alertes éventuelles sont retournées.
+        timestamp (heure de la requête) choisit la fenêtre où le nom est compté.
+        """
+        now = time.monotonic() if now is None else now
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            self.pending.append((parent_domain, subdomain, client_address, timestamp))
+            if self.pending_since is None:
+                self.pending_since = now
+            if (
+                len(self.pending) < self.batch_size
+                and now - self.pending_since < self.max_delay
+            ):
+                return []
+            batch, self.pending, self.pending_since = self.pending, [], None
+        return self.score_batch(batch)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending, self.pending_since = self.pending, [], None
+        return self.score_batch(batch) if batch else []
+
+    def score_batch(self, batch):
+        scores, _features = self.score_names(
+            [subdomain for _parent, subdomain, _client, _timestamp in batch]
+        )
+        per_domain = {}
+        for (parent_domain, _subdomain, client_address, timestamp), score in zip(
+            batch, scores.tolist()
+        ):
+            self._accumulate(
+                per_domain,
+                parent_domain,
+                1,
+                score,
+                int(score >= self.threshold),
+                score,
+                client_address,
+                int(timestamp // self.window_size),
+            )
+        alerts = []
+        with self.lock:
+            self.batches += 1
+            for parent_domain, (
+                names,
+                total,
+                high,
+                max_score,
+                client_address,
+                window_number,
+            ) in per_domain.items():
+                if self.exported is not None:
+                    self._accumulate(
+                        self.exported,
+                        parent_domain,
+                        names,
+                        total,
+                        high,
+                        max_score,
+                        client_address,
+                        window_number,
+                    )
+                    continue
+                alert = self._merge(
+                    parent_domain, names, total, high, max_score, window_number
+                )
+                if alert is not None:
+                    alerts.append((parent_domain, client_address, alert))
+        return alerts
+
+    # Cumul par domaine parent
+
+    @staticmethod
+    def _accumulate(
+        table,
+        parent_domain,
+        names,
+        total,
+        high,
+        max_score,
+        client_address,
+        window_number,
+    ):
+        entry = table.get(parent_domain)
+        if entry is None or entry[5] < window_number:
+            # Seule la fenêtre la plus récente est envoyée
+            table[parent_domain] = [
+                names,
+                total,
+                high,
+                max_score,
+                client_address,
+                window_number,
+            ]
+        elif entry[5] == window_number:
+            entry[0] += names
+            entry[1] += total
+            entry[2] += high
+            entry[3] = max(entry[3], max_score)
+            if high:
+                entry[4] = client_address  # client du dernier nom suspect
+
+    def _merge(self, parent_domain, names, total, high, max_score, window_number):
+        # Appelé sous self.lock
+        entry = self.domains.get(parent_domain)
+        if entry is None:
+            entry = self.domains[parent_domain] = [0, 0.0, 0, 0.0, 0, window_number]
+            if len(self.domains) > self.max_domains:
+                self.domains.popitem(last=False)
+        else:
+            self.domains.move_to_end(parent_domain)
+        if entry[5] > window_number:
+            return None  # fenêtre déjà remplacée
+        if entry[5] < window_number:
+            # Nouvelle fenêtre : les cumuls repartent de zéro, le dernier palier
+            # d'alerte est gardé comme dans detect.py
+            entry[:4] = [0, 0.0, 0, 0.0]
+            entry[5] = window_number
+        entry[0] += names
+        entry[1] += total
+        entry[2] += high
+        entry[3] = max(entry[3], max_score)
+        if entry[2] >= entry[4] + self.alert_names:
+            entry[4] = entry[2]
+            return {
+                "unique_count": entry[2],
+                "alert_level": "medium",
+                "additional_info": {
+                    "alert_reason": "Query names look like encoded data",
+                    "lexical": self._summary(entry),
+                },
+            }
+        return None
+
+    def merge(self, parent_domain, names, total, high, max_score, window_number):
+        """Fusionne des scores calculés ailleurs (mode --workers) ; retourne l'alerte éventuelle."""
+        with self.lock:
+            return self._merge(
+                parent_domain, names, total, high, max_score, window_number
+            )
+
+    def enable_export(self):
+        """Mode worker : les scores sont envoyés à l'agrégateur au lieu d'être cumulés ici."""
+        with self.lock:
+            self.exported = {}
+
+    def take_exported(self):
+        """Mode worker : scores accumulés depuis le dernier envoi à l'agrégateur."""
+        with self.lock:
+            exported, self.exported = self.exported, {}
+        return exported or {}
+
+    @staticmethod
+    def _summary(entry):
+        names, total, high, max_score, _last, _window = entry
+        return {
+            "scored_names": names,
+            "mean_score": round(total / names, 3) if names else 0.0,
+            "max_score": round(max_score, 3),
+            "suspicious_names": high,
+        }
+
+    def summary(self, parent_domain):
+        """Résumé des scores d'un domaine, joint aux alertes (None si aucun nom scoré)."""
+        with self.lock:
+            entry = self.domains.get(parent_domain)
+            return self._summary(entry) if entry is not None else None
+
+
+def create_scorer(window_size=WINDOW_SIZE):
+    if not LEXICAL_SCORING:
+        return None
+    if np is None:
+        print("[INFO] NumPy introuvable : score lexical des noms désactivé")
+        return None
+    return LexicalScorer(window_size=window_size)
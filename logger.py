@@ -1,27 +1,345 @@
+import atexit
+import base64
 import os
+import random
+import threading
+import time
+from collections import deque
 from datetime import datetime
 from elasticsearch import Elasticsearch
+from metrics import observe, increment, register
+from spool import Spool
 
-ES_HOST = "http://elasticsearch:9200/"
+ES_HOST = os.getenv("ES_HOST", "http://elasticsearch:9200/")
 
 ENVIRONMENT = os.getenv("ENVIRONMENT", "dev")
 
 if ENVIRONMENT == "dev":
-    ES_HOST = "http://elasticsearch:9200/"
     es = Elasticsearch([ES_HOST])
 else:
-    ES_HOST = "http://elasticsearch:9200/"
     ES_USERNAME = os.getenv("ES_USERNAME", "default_user")
     ES_PASSWORD = os.getenv("ES_PASSWORD", "default_password")
     es = Elasticsearch([ES_HOST], basic_auth=(ES_USERNAME, ES_PASSWORD))
 
+# Écriture asynchrone par lots (_bulk)
+LOG_QUEUE_SIZE = int(
+    os.getenv("LOG_QUEUE_SIZE", "10000")
+)  # documents en attente au maximum
+LOG_BULK_SIZE = int(
+    os.getenv("LOG_BULK_SIZE", "500")
+)  # envoi dès que ce nombre est atteint
+LOG_FLUSH_INTERVAL = float(
+    os.getenv("LOG_FLUSH_INTERVAL", "1.0")
+)  # ... ou après ce délai (s)
+LOG_OVERFLOW_POLICY = os.getenv(
+    "LOG_OVERFLOW_POLICY", "drop-oldest"
+)  # drop-oldest, drop-new ou block
 
+OVERFLOW_POLICIES = ("drop-oldest", "drop-new", "block")
 
+# Mode de log des réponses : "full" (deux documents par requête) ou "rollup"
+# (compteurs par minute, documents complets échantillonnés)
+LOG_MODE = os.getenv("LOG_MODE", "full")
+LOG_ROLLUP_INTERVAL = float(
+    os.getenv("LOG_ROLLUP_INTERVAL", "60")
+)  # durée d'une fenêtre (s)
+LOG_ROLLUP_MAX_KEYS = int(
+    os.getenv("LOG_ROLLUP_MAX_KEYS", "200000")
+)  # au-delà, envoi anticipé
+LOG_SAMPLE_RATE = float(
+    os.getenv("LOG_SAMPLE_RATE", "0.01")
+)  # part des réponses loggées en entier
+LOG_SUSPICIOUS_TTL = float(
+    os.getenv("LOG_SUSPICIOUS_TTL", "600")
+)  # domaines suspects loggés en entier (s)
 
-def full_log_request(response_data, rcode, source, client_address):
+LOG_MODES = ("full", "rollup")
+
+# Nouvel essai d'expédition du spool quand Elasticsearch est indisponible (s)
+SPOOL_RETRY_MIN = float(os.getenv("LOG_SPOOL_RETRY_MIN", "1"))
+SPOOL_RETRY_MAX = float(os.getenv("LOG_SPOOL_RETRY_MAX", "30"))
+
+
+class BulkSink:
+    """
+    File bornée de documents vidée par un thread d'arrière-plan via l'API _bulk.
+    Les fonctions de log ne font qu'ajouter un document à la file : la réponse DNS
+    n'attend jamais Elasticsearch.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_queue=LOG_QUEUE_SIZE,
+        bulk_size=LOG_BULK_SIZE,
+        flush_interval=LOG_FLUSH_INTERVAL,
+        overflow_policy=LOG_OVERFLOW_POLICY,
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy {overflow_policy!r}, expected one of {OVERFLOW_POLICIES}"
+            )
+        self.client = client
+        self.max_queue = max_queue
+        self.bulk_size = bulk_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.in_flight = 0
+        # Compteurs
+        self.enqueued = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self.bulk_requests = 0
+        self.spooled = 0
+        self.spool = None  # voir enable_spool()
+
+    def enqueue(self, index, document, doc_id=None):
+        """Ajoute un document à la file selon la politique de débordement."""
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, daemon=True, name="es-bulk-writer"
+                )
+                self.thread.start()
+            while len(self.queue) >= self.max_queue:
+                if self.overflow_policy == "drop-new":
+                    self.dropped += 1
+                    return False
+                if self.overflow_policy == "drop-oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                    break
+                self.condition.wait()
+            self.queue.append((index, doc_id, document))
+            self.enqueued += 1
+            if len(self.queue) >= self.bulk_size:
+                self.condition.notify_all()
+        return True
+
+    def enqueue_deferred(self, build_documents):
+        """
+        Ajoute une fonction qui construira ses documents dans le thread d'écriture.
+        Elle retourne une liste de (index, id, document).
+        """
+        return self.enqueue(None, build_documents)
+
+    def _take_batch(self):
+        # Appelé sous self.condition
+        batch = []
+        while self.queue and len(batch) < self.bulk_size:
+            batch.append(self.queue.popleft())
+        self.in_flight = len(batch)
+        self.condition.notify_all()  # libère les producteurs en mode "block"
+        return batch
+
+    def _run(self):
+        while True:
+            with self.condition:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.queue) < self.bulk_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self._take_batch()
+            if batch:
+                self._send(batch)
+            with self.condition:
+                self.in_flight = 0
+                self.condition.notify_all()
+
+    def _expand(self, batch):
+        for index, doc_id, document in batch:
+            if index is not None:
+                yield index, doc_id, document
+                continue
+            try:
+                yield from document()
+            except Exception as e:
+                self.failed += 1
+                print(f"Log document build error : {e}")
+
+    def _send(self, batch):
+        batch = list(self._expand(batch))
+        if not batch:
+            return
+        if self.spool is not None:
+            # Le spool sur disque sert de tampon ; le SpoolShipper envoie les documents
+            try:
+                self.spool.append(batch)
+                self.spooled += len(batch)
+                return
+            except Exception as e:
+                print(f"Log spool error, sending directly : {e}")
+        try:
+            failures = send_bulk(self.client, batch)
+            self.bulk_requests += 1
+            self.failed += failures
+            self.flushed += len(batch) - failures
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Elasticsearch bulk error : {e}")
+
+    def flush(self, timeout=None):
+        """Attend que la file soit vide (utile à l'arrêt du processus)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.condition.notify_all()
+            while self.thread is not None and (self.queue or self.in_flight):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(
+                    remaining if remaining is not None else self.flush_interval
+                )
+        return True
+
+    def stats(self):
+        with self.condition:
+            return {
+                "queued": len(self.queue),
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "bulk_requests": self.bulk_requests,
+                "spooled": self.spooled,
+            }
+
+
+def send_bulk(client, batch):
+    """Envoie une liste de (index, id, document) via _bulk ; retourne le nombre de documents refusés."""
+    actions = []
+    for index, doc_id, document in batch:
+        action = {"_index": index}
+        if doc_id is not None:
+            action["_id"] = doc_id
+        actions.append({"index": action})
+        actions.append(document)
+    start = time.perf_counter()
+    result = client.bulk(body=actions)
+    observe("es_bulk", "ES", time.perf_counter() - start)
+    if result.get("errors"):
+        return sum(
+            1 for item in result.get("items", []) if item.get("index", {}).get("error")
+        )
+    return 0
+
+
+class SpoolShipper:
+    """
+    Thread d'expédition du spool : relit les documents dans l'ordre d'écriture et
+    les envoie par lots. Si Elasticsearch est indisponible ou si la lecture du
+    spool échoue, le même lot est réessayé après un délai qui double jusqu'à
+    SPOOL_RETRY_MAX.
+    """
+
+    def __init__(self, client, spool, bulk_size=LOG_BULK_SIZE):
+        self.client = client
+        self.spool = spool
+        self.bulk_size = bulk_size
+        self.retry_delay = 0.0
+        self.shipped = 0
+        self.failed = 0
+        self.bulk_requests = 0
+        self.retries = 0
+        self.read_failures = 0
+        self.thread = threading.Thread(
+            target=self._run, daemon=True, name="es-spool-shipper"
+        )
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.spool.sync_if_due()
+                documents, position = self.spool.read(
+                    self.bulk_size, timeout=LOG_FLUSH_INTERVAL
+                )
+            except Exception as e:
+                self.read_failures += 1
+                print(f"Log spool read error, retried in {self._backoff():.0f}s : {e}")
+                time.sleep(self.retry_delay)
+                continue
+            if not documents:
+                continue
+            try:
+                failures = send_bulk(self.client, documents)
+            except Exception as e:
+                self.retries += 1
+                print(
+                    f"Elasticsearch unavailable, {len(documents)} spooled documents retried in {self._backoff():.0f}s : {e}"
+                )
+                time.sleep(self.retry_delay)
+                continue
+            # Les documents refusés un par un (mapping...) ne seraient pas acceptés à un nouvel essai
+            self.retry_delay = 0.0
+            self.bulk_requests += 1
+            self.failed += failures
+            self.shipped += len(documents) - failures
+            self.spool.commit(position, len(documents))
+
+    def _backoff(self):
+        self.retry_delay = min(
+            max(2 * self.retry_delay, SPOOL_RETRY_MIN), SPOOL_RETRY_MAX
+        )
+        return self.retry_delay
+
+    def stats(self):
+        stats = self.spool.stats()
+        stats.update(
+            shipper_failed=self.failed,
+            shipper_retries=self.retries,
+            shipper_bulk_requests=self.bulk_requests,
+            shipper_read_failures=self.read_failures,
+        )
+        return stats
+
+
+sink = BulkSink(es)
+atexit.register(sink.flush, timeout=5)
+register(
+    "dns_proxy_log_sink",
+    "Elasticsearch bulk sink queue depth and document counters.",
+    lambda: {(("event", name),): value for name, value in sink.stats().items()},
+)
+shipper = None
+
+
+def enable_spool(directory):
+    """
+    Fait passer les documents par un spool sur disque (spool.py) avant Elasticsearch.
+    À appeler une fois par processus, après un éventuel fork.
+    """
+    global shipper
+    sink.spool = Spool(directory)
+    shipper = SpoolShipper(es, sink.spool)
+
+    def close_spool():
+        if rollups is not None:
+            rollups.flush(everything=True)
+        sink.flush(timeout=5)
+        sink.spool.close()
+
+    atexit.register(close_spool)
+    register(
+        "dns_proxy_log_spool",
+        "Disk spool size and document counters.",
+        lambda: {(("event", name),): value for name, value in shipper.stats().items()},
+    )
+    pending = sink.spool.recovered
+    if pending:
+        print(f"Log spool {directory} : {pending} documents left from a previous run")
+
+
+def full_log_document(response_data, rcode, source, client_address, timestamp=None):
     log_data = {
         "source": source,
-        "timestamp": datetime.utcnow(),
+        "timestamp": timestamp or datetime.utcnow(),
         "answers_count": response_data["answer"],
         "rcode": rcode,
         "query_qname": response_data["query"][0],
@@ -46,19 +364,21 @@ def full_log_request(response_data, rcode, source, client_address):
         if response_data.get("edns0"):
             log_data["edns0"] = response_data["edns0"]
 
-    # Indexation dans Elasticsearch
-    es.index(index="proxy_logs_full", body=log_data)
+    return log_data
 
 
-def log_request(response_data, rcode, source, client_address):
-    """
-    Fonction pour logger une requête DNS dans Elasticsearch.
-    """
-    full_log_request(response_data, rcode, source, client_address)
+def full_log_request(response_data, rcode, source, client_address):
+    # Indexation dans Elasticsearch (par lots, en arrière-plan)
+    sink.enqueue(
+        "proxy_logs_full",
+        full_log_document(response_data, rcode, source, client_address),
+    )
+
 
+def log_document(response_data, rcode, source, timestamp=None):
     log_data = {
         "source": source,
-        "timestamp": datetime.utcnow(),
+        "timestamp": timestamp or datetime.utcnow(),
         "answers_count": response_data["answer"],
         "rcode": rcode,
         "query_type": response_data["query"][1],
@@ -79,23 +399,304 @@ def log_request(response_data, rcode, source, client_address):
     if response_data.get("edns0"):
         log_data["edns0"] = response_data["edns0"]
 
-    # Indexation dans Elasticsearch
-    es.index(index="proxy_logs", body=log_data)
+    return log_data
 
 
-def log_error(error_message, source, query_data_raw, query_data, answer_data, client_address):
+def log_request(response_data, rcode, source, client_address):
+    """
+    Fonction pour logger une requête DNS dans Elasticsearch.
+    """
+    full_log_request(response_data, rcode, source, client_address)
+
+    # Indexation dans Elasticsearch (par lots, en arrière-plan)
+    sink.enqueue("proxy_logs", log_document(response_data, rcode, source))
+
+
+class RollupAggregator:
+    """
+    Compteurs par (fenêtre, qname, qtype, rcode, client), envoyés en un document
+    proxy_logs_rollup par clé à la fin de chaque fenêtre. Les réponses ne sont
+    loggées en entier que pour un échantillon, pour les rcodes d'erreur et pour
+    les domaines ayant levé une alerte récemment.
+    """
+
+    def __init__(
+        self,
+        interval=LOG_ROLLUP_INTERVAL,
+        max_keys=LOG_ROLLUP_MAX_KEYS,
+        sample_rate=LOG_SAMPLE_RATE,
+        suspicious_ttl=LOG_SUSPICIOUS_TTL,
+    ):
+        self.interval = interval
+        self.max_keys = max_keys
+        self.sample_rate = sample_rate
+        self.suspicious_ttl = suspicious_ttl
+        self.lock = threading.Lock()
+        self.counters = (
+            {}
+        )  # (fenêtre, qname, qtype, rcode, client) -> [requêtes, réponses, UDP, TCP]
+        self.suspicious = (
+            {}
+        )  # domaine parent -> fin de la période de log complet (monotonic)
+        self.thread = None
+        # Compteurs
+        self.queries = 0
+        self.documents = 0
+        self.early_flushes = 0
+        self.sampled = 0
+        self.forced = 0
+
+    def add(self, qname, qtype, rcode, client_address, answers, source, timestamp):
+        window = int(timestamp // self.interval)
+        key = (window, qname, qtype, rcode, str(client_address))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, daemon=True, name="log-rollup"
+                )
+                self.thread.start()
+            counter = self.counters.get(key)
+            if counter is None:
+                counter = self.counters[key] = [0, 0, 0, 0]
+            counter[0] += 1
+            counter[1] += answers
+            counter[2 if source == "UDP" else 3] += 1
+            self.queries += 1
+            full = len(self.counters) >= self.max_keys
+        if full:
+            # Trop de clés distinctes : on n'attend pas la fin de la fenêtre
+            self.early_flushes += 1
+            self.flush(everything=True)
+
+    def log_in_full(self, qname, rcode):
+        """Décide si une réponse est aussi loggée en entier (proxy_logs_full et proxy_logs)."""
+        if rcode != 0 or self.is_suspicious(qname):
+            self.forced += 1
+            return True
+        if random.random() < self.sample_rate:
+            self.sampled += 1
+            return True
+        return False
+
+    def mark_suspicious(self, domain):
+        with self.lock:
+            self.suspicious[domain.lower().rstrip(".")] = (
+                time.monotonic() + self.suspicious_ttl
+            )
+
+    def is_suspicious(self, qname):
+        if not self.suspicious:
+            return False
+        labels = qname.lower().rstrip(".").split(".")
+        now = time.monotonic()
+        for index in range(len(labels) - 1):
+            expiry = self.suspicious.get(".".join(labels[index:]))
+            if expiry is not None:
+                if expiry > now:
+                    return True
+                with self.lock:
+                    self.suspicious.pop(".".join(labels[index:]), None)
+        return False
+
+    def flush(self, everything=False):
+        """Envoie les fenêtres terminées (toutes si everything)."""
+        current = int(time.time() // self.interval)
+        with self.lock:
+            if everything:
+                done, self.counters = self.counters, {}
+            else:
+                done = {
+                    key: value
+                    for key, value in self.counters.items()
+                    if key[0] < current
+                }
+                for key in done:
+                    del self.counters[key]
+        if not done:
+            return
+        self.documents += len(done)
+        interval = self.interval
+
+        def build_documents():
+            return [
+                (
+                    "proxy_logs_rollup",
+                    None,
+                    {
+                        "timestamp": datetime.utcfromtimestamp(window * interval),
+                        "interval": interval,
+                        "query_qname": qname,
+                        "query_type": qtype,
+                        "rcode": rcode,
+                        "client_address": client_address,
+                        "count": queries,
+                        "answers_count": answers,
+                        "udp_count": udp,
+                        "tcp_count": tcp,
+                    },
+                )
+                for (window, qname, qtype, rcode, client_address), (
+                    queries,
+                    answers,
+                    udp,
+                    tcp,
+                ) in done.items()
+            ]
+
+        sink.enqueue_deferred(build_documents)
+
+    def _run(self):
+        while True:
+            # Réveil juste après la fin de chaque fenêtre
+            time.sleep(self.interval - time.time() % self.interval + 0.1)
+            self.flush()
+
+    def stats(self):
+        with self.lock:
+            keys = len(self.counters)
+        return {
+            "keys": keys,
+            "queries": self.queries,
+            "documents": self.documents,
+            "early_flushes": self.early_flushes,
+            "sampled": self.sampled,
+            "forced": self.forced,
+        }
+
+
+def create_rollups(mode=LOG_MODE):
+    if mode not in LOG_MODES:
+        raise ValueError(
+            f"Unknown log mode {mode!r}, expected one of {', '.join(LOG_MODES)}"
+        )
+    if mode != "rollup":
+        return None
+    aggregator = RollupAggregator()
+    atexit.register(aggregator.flush, everything=True)  # exécuté avant sink.flush
+    register(
+        "dns_proxy_log_rollup",
+        "Per-minute rollup keys, documents and full documents kept by sampling or forced.",
+        lambda: {
+            (("event", name),): value for name, value in aggregator.stats().items()
+        },
+    )
+    return aggregator
+
+
+rollups = create_rollups()
+
+
+def set_log_mode(mode):
+    """Change le mode de log (option --log-mode du proxy)."""
+    global rollups
+    if (rollups is not None) != (mode == "rollup"):
+        rollups = create_rollups(mode)
+
+
+def rollups_enabled():
+    """Vrai en mode rollup : les réponses sans enregistrement sont alors comptées aussi."""
+    return rollups is not None
+
+
+def mark_suspicious(domain):
+    """En mode rollup, logge en entier les requêtes sous domain pendant LOG_SUSPICIOUS_TTL secondes."""
+    if rollups is not None:
+        rollups.mark_suspicious(domain)
+
+
+def log_response(message, query_data, source, client_address, query_data_raw):
+    """
+    Logge une réponse à partir de la vue paresseuse du décodeur (decoder.DNSMessage).
+    Le décodage complet des enregistrements est fait par le thread d'écriture,
+    hors du chemin de la requête ; une erreur de décodage produit un document proxy_errors.
+    En mode rollup, seules les réponses loggées en entier sont décodées.
+    """
+    timestamp = datetime.utcnow()
+    if rollups is not None:
+        rollups.add(
+            query_data[0],
+            query_data[1],
+            message.rcode,
+            client_address,
+            message.an_count,
+            source,
+            time.time(),
+        )
+        if not rollups.log_in_full(query_data[0], message.rcode):
+            return
+
+    def build_documents():
+        try:
+            start = time.perf_counter()
+            response_data = message.to_response_data(query_data)
+            observe("decode_response", source, time.perf_counter() - start)
+            return [
+                (
+                    "proxy_logs_full",
+                    None,
+                    full_log_document(
+                        response_data, message.rcode, source, client_address, timestamp
+                    ),
+                ),
+                (
+                    "proxy_logs",
+                    None,
+                    log_document(response_data, message.rcode, source, timestamp),
+                ),
+            ]
+        except Exception as e:
+            log_data = error_document(
+                e,
+                source,
+                query_data_raw,
+                query_data,
+                str(message.data),
+                client_address,
+                timestamp,
+            )
+            if not log_data:
+                return []
+            increment(
+                "dns_proxy_errors_total",
+                (("transport", source),),
+                help_text="Exchanges logged to proxy_errors.",
+            )
+            return [("proxy_errors", None, log_data)]
+
+    sink.enqueue_deferred(build_documents)
+
+
+def encode_raw_query(query_data_raw):
+    """Requête brute en base64 (champ query_data_raw de proxy_errors, relu par replay_error.py)."""
+    if isinstance(query_data_raw, (bytes, bytearray, memoryview)):
+        return base64.b64encode(query_data_raw).decode("ascii"), "base64"
+    return query_data_raw, None
+
+
+def error_document(
+    error_message,
+    source,
+    query_data_raw,
+    query_data,
+    answer_data,
+    client_address,
+    timestamp=None,
+):
 
     error_message_str = str(error_message)
 
     if "Expected at least 1 answer, got" not in error_message_str:
+        query_data_raw, encoding = encode_raw_query(query_data_raw)
         log_data = {
-            "timestamp": datetime.utcnow(),
+            "timestamp": timestamp or datetime.utcnow(),
             "type": source,
             "error_message": error_message_str,
             "query_data_raw": query_data_raw,
             "answer_data": answer_data,
             "client_address": str(client_address),
         }
+        if encoding:
+            log_data["query_data_encoding"] = encoding
 
         try:
             log_data["query_qname"] = query_data[0]
@@ -110,7 +711,23 @@ def log_error(error_message, source, query_data_raw, query_data, answer_data, cl
         except Exception:
             pass
 
-        es.index(index="proxy_errors", body=log_data)
+        return log_data
+    return None
+
+
+def log_error(
+    error_message, source, query_data_raw, query_data, answer_data, client_address
+):
+    log_data = error_document(
+        error_message, source, query_data_raw, query_data, answer_data, client_address
+    )
+    if log_data:
+        increment(
+            "dns_proxy_errors_total",
+            (("transport", source),),
+            help_text="Exchanges logged to proxy_errors.",
+        )
+        sink.enqueue("proxy_errors", log_data)
 
 
 from datetime import datetime
@@ -150,5 +767,8 @@ def log_suspicious_activity(public_suffix, unique_count, client_address, alert_l
     if additional_info:
         log_data.update({"additional_info": additional_info})
 
-    # Log to Elasticsearch (assuming `es` is your Elasticsearch client)
-    es.index(index="suspicious_activity_logs", id=log_id, body=log_data)
+    # Log to Elasticsearch through the background bulk writer
+    sink.enqueue("suspicious_activity_logs", log_data, doc_id=log_id)
+
+    # In rollup mode, queries under this domain are logged in full for a while
+    mark_suspicious(public_suffix)
@@ -0,0 +1,247 @@
+"""
+Instrumentation du proxy : histogrammes de latence par étape et par transport,
+compteurs et jauges, exposés au format texte Prometheus sur un port HTTP local.
+
+Les histogrammes sont de type HDR (log-linéaires) : 16 sous-intervalles par
+puissance de deux, soit une précision relative d'environ 6 % sur toute la plage
+(1 µs à plusieurs heures) avec un tableau fixe de compteurs.
+"""
+
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+BUCKET_COUNT = 32 * SUB_BUCKETS
+# Bornes des buckets exportés vers Prometheus (secondes)
+EXPORT_BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+EXPORT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+    """Index du bucket pour une valeur entière en microsecondes."""
+    if value < SUB_BUCKETS:
+        return max(0, value)
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    index = (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+    return min(index, BUCKET_COUNT - 1)
+
+
+def bucket_upper_bound(index):
+    """Borne haute (exclue) d'un bucket, en microsecondes."""
+    if index < SUB_BUCKETS:
+        return index + 1
+    shift = index // SUB_BUCKETS - 1
+    return (SUB_BUCKETS + index % SUB_BUCKETS + 1) << shift
+
+
+class LatencyHistogram:
+    __slots__ = ("lock", "counts", "count", "total")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0  # secondes
+
+    def record(self, seconds):
+        index = bucket_index(int(seconds * 1_000_000))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.total
+
+    @staticmethod
+    def quantile(counts, count, fraction):
+        """Quantile (secondes) calculé sur un instantané des compteurs."""
+        if not count:
+            return 0.0
+        rank = fraction * count
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if bucket and seen >= rank:
+                return bucket_upper_bound(index) / 1_000_000
+        return bucket_upper_bound(BUCKET_COUNT - 1) / 1_000_000
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (étape, transport) -> LatencyHistogram
+        self.counters = {}  # (nom, labels) -> valeur
+        self.collectors = {}  # nom -> (type, aide, fonction)
+        self.help = {}
+
+    def histogram(self, stage, transport):
+        key = (stage, transport)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe(self, stage, transport, seconds):
+        self.histogram(stage, transport).record(seconds)
+
+    def increment(self, name, labels=(), amount=1, help_text=""):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            if help_text:
+                self.help.setdefault(name, help_text)
+
+    def register(self, name, help_text, function, kind="gauge"):
+        """
+        Enregistre une métrique calculée au moment de l'export. La fonction retourne
+        une valeur, ou un dict {labels: valeur} où labels est un tuple de (nom, valeur).
+        """
+        self.collectors[name] = (kind, help_text, function)
+
+    def render(self):
+        lines = []
+        name = "dns_proxy_stage_latency_seconds"
+        lines.append(f"# HELP {name} Latency of each request processing stage.")
+        lines.append(f"# TYPE {name} histogram")
+        quantile_lines = []
+        for (stage, transport), histogram in sorted(self.histograms.items()):
+            counts, count, total = histogram.snapshot()
+            labels = f'stage="{stage}",transport="{transport}"'
+            cumulative = 0
+            index = 0
+            for bound in EXPORT_BUCKETS:
+                limit = int(bound * 1_000_000)
+                while index < BUCKET_COUNT and bucket_upper_bound(index) <= limit:
+                    cumulative += counts[index]
+                    index += 1
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+            for fraction in EXPORT_QUANTILES:
+                value = LatencyHistogram.quantile(counts, count, fraction)
+                quantile_lines.append(
+                    f'dns_proxy_stage_latency_quantile_seconds{{{labels},quantile="{fraction}"}} {value:.6f}'
+                )
+        if quantile_lines:
+            lines.append(
+                "# HELP dns_proxy_stage_latency_quantile_seconds Latency quantiles from the HDR histograms."
+            )
+            lines.append("# TYPE dns_proxy_stage_latency_quantile_seconds gauge")
+            lines.extend(quantile_lines)
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+        by_name = {}
+        for (counter, labels), value in counters:
+            by_name.setdefault(counter, []).append((labels, value))
+        for counter, values in by_name.items():
+            lines.append(f"# HELP {counter} {self.help.get(counter, counter)}")
+            lines.append(f"# TYPE {counter} counter")
+            for labels, value in values:
+                lines.append(f"{counter}{format_labels(labels)} {value}")
+
+        for metric, (kind, help_text, function) in sorted(self.collectors.items()):
+            try:
+                value = function()
+            except Exception as e:
+                print(f"Metrics collector {metric} failed : {e}")
+                continue
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            if isinstance(value, dict):
+                for labels, item in sorted(value.items()):
+                    lines.append(f"{metric}{format_labels(labels)} {item}")
+            else:
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = MetricsRegistry()
+observe = registry.observe
+increment = registry.increment
+register = registry.register
+
+# Endpoints JSON servis à côté de /metrics : chemin -> fonction(paramètres) -> objet
+endpoints = {}
+
+
+def register_endpoint(path, function):
+    endpoints[path] = function
+
+
+START_TIME = time.time()
+register("dns_proxy_threads", "Number of live threads.", threading.active_count)
+register(
+    "dns_proxy_start_time_seconds", "Start time of the process.", lambda: START_TIME
+)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        if path in endpoints:
+            params = dict(urllib.parse.parse_qsl(query))
+            try:
+                payload = json.dumps(endpoints[path](params)).encode()
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.reply(payload, "application/json")
+            return
+        if path != "/metrics":
+            self.send_error(404)
+            return
+        self.reply(registry.render().encode(), "text/plain; version=0.0.4")
+
+    def reply(self, payload, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_metrics_server(host, port):
+    """Sert /metrics dans un thread d'arrière-plan."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, daemon=True, name="metrics-http"
+    ).start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return server
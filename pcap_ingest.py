@@ -0,0 +1,654 @@
+"""
+Analyse hors ligne de captures pcap/pcapng avec le décodeur et le détecteur du proxy.
+
+Les paquets sont lus un par un par des générateurs (fichier projeté en mémoire
+avec mmap quand c'est possible, lecture en flux sinon) : la capture n'est
+jamais chargée en entier. Les messages DNS du port 53 (UDP, et TCP avec
+réassemblage des flux et découpage des messages préfixés par leur longueur)
+passent par decode_dns_query / decode_dns_response puis par detect_anomalies,
+avec l'horodatage du paquet à la place de l'heure courante.
+
+Les alertes sont écrites en JSON, une par ligne, sur la sortie standard (ou
+--alerts) ; un résumé JSON est écrit sur la sortie d'erreur à la fin.
+
+Avec --workers N, la capture est découpée en tranches d'environ --chunk-mb Mo
+(aux frontières de paquets) traitées par N processus ; leurs compteurs de
+détection sont fusionnés dans l'ordre des tranches comme en mode --workers du
+proxy. Un flux TCP à cheval sur deux tranches perd le message coupé.
+
+    python3 pcap_ingest.py capture.pcapng [--workers 8] [--alerts alerts.jsonl]
+"""
+
+import argparse
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import socket
+import struct
+import sys
+import time
+from collections import Counter, OrderedDict
+
+import detect
+from decoder import (
+    decode_dns_query,
+    decode_dns_response,
+    parse_dns_message,
+    query_type_to_string,
+)
+
+DNS_PORT = 53
+CHUNK_SIZE = 64 * 1024 * 1024  # taille d'une tranche en mode --workers
+MAX_TCP_FLOWS = 10000  # flux TCP suivis simultanément (LRU)
+MAX_TCP_BUFFER = 2 * 65537  # au-delà, le flux est désynchronisé et remis à zéro
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),  # horodatage en nanosecondes
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 1
+PCAPNG_OPB = 2
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_LE_MAGIC = b"\x4d\x3c\x2b\x1a"
+
+# Types de lien (LINKTYPE_*)
+LINK_NULL = 0
+LINK_ETHERNET = 1
+LINK_RAW = (12, 14, 101)
+LINK_LOOP = 108
+LINK_SLL = 113
+LINK_IPV4 = 228
+LINK_IPV6 = 229
+LINK_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+IPV6_EXTENSIONS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+
+# Lecture des captures
+
+
+def open_capture(path):
+    """Source de lecture : le fichier projeté en mémoire si possible, sinon le fichier lui-même."""
+    f = open(path, "rb")
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return f  # fichier vide, tube, système de fichiers sans mmap...
+    f.close()  # la projection garde sa propre référence au fichier
+    return mapped
+
+
+class CaptureState:
+    """Ce qu'il faut savoir pour lire une capture à partir d'une position quelconque."""
+
+    __slots__ = ("format", "byte_order", "ts_scale", "linktype", "interfaces")
+
+    def __init__(
+        self,
+        format,
+        byte_order="<",
+        ts_scale=1e-6,
+        linktype=LINK_ETHERNET,
+        interfaces=None,
+    ):
+        self.format = format
+        self.byte_order = byte_order
+        self.ts_scale = ts_scale
+        self.linktype = linktype
+        self.interfaces = (
+            interfaces or []
+        )  # pcapng : (type de lien, échelle des horodatages)
+
+    def copy(self):
+        return CaptureState(
+            self.format,
+            self.byte_order,
+            self.ts_scale,
+            self.linktype,
+            list(self.interfaces),
+        )
+
+
+def read_header(source):
+    """Lit l'en-tête de fichier et retourne l'état de lecture (la source est placée après l'en-tête pcap)."""
+    magic = source.read(4)
+    if magic in PCAP_MAGIC:
+        byte_order, ts_scale = PCAP_MAGIC[magic]
+        _major, _minor, _zone, _sigfigs, _snaplen, linktype = struct.unpack(
+            byte_order + "HHiIII", source.read(20)
+        )
+        return CaptureState("pcap", byte_order, ts_scale, linktype & 0xFFFF)
+    if len(magic) == 4 and struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+        source.seek(0)  # le Section Header Block est relu par read_pcapng
+        return CaptureState("pcapng")
+    raise ValueError(f"Not a pcap or pcapng file (magic {magic.hex()})")
+
+
+def read_pcap(source, state, end=None):
+    """Générateur de (horodatage, type de lien, trame) pour un fichier pcap."""
+    record = struct.Struct(state.byte_order + "IIII")
+    while end is None or source.tell() < end:
+        header = source.read(16)
+        if len(header) < 16:
+            return
+        seconds, fraction, captured, _original = record.unpack(header)
+        frame = source.read(captured)
+        if len(frame) < captured:
+            return  # capture tronquée
+        yield seconds + fraction * state.ts_scale, state.linktype, frame
+
+
+def interface_ts_scale(options, byte_order):
+    """Échelle des horodatages d'une interface pcapng (option if_tsresol), 1 µs par défaut."""
+    index = 0
+    while index + 4 <= len(options):
+        code, length = struct.unpack_from(byte_order + "HH", options, index)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            resolution = options[index + 4]
+            return (
+                2.0 ** -(resolution & 0x7F) if resolution & 0x80 else 10.0**-resolution
+            )
+        index += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+
+def read_pcapng(source, state, end=None):
+    """Générateur de (horodatage, type de lien, trame) pour un fichier pcapng."""
+    last_timestamp = 0.0
+    while end is None or source.tell() < end:
+        header = source.read(8)
+        if len(header) < 8:
+            return
+        if struct.unpack("<I", header[:4])[0] == PCAPNG_SHB:
+            magic = source.read(4)
+            state.byte_order = "<" if magic == PCAPNG_LE_MAGIC else ">"
+            state.interfaces = []
+            length = struct.unpack(state.byte_order + "I", header[4:])[0]
+            source.seek(length - 12, os.SEEK_CUR)
+            continue
+        block_type, length = struct.unpack(state.byte_order + "II", header)
+        if length < 12:
+            raise ValueError(f"Invalid pcapng block length {length}")
+        body = source.read(length - 8)
+        if len(body) < length - 8:
+            return
+        byte_order = state.byte_order
+
+        if block_type == PCAPNG_IDB:
+            linktype, _reserved, _snaplen = struct.unpack_from(byte_order + "HHI", body)
+            state.interfaces.append(
+                (linktype, interface_ts_scale(body[8:-4], byte_order))
+            )
+        elif block_type == PCAPNG_EPB:
+            interface, high, low, captured, _original = struct.unpack_from(
+                byte_order + "IIIII", body
+            )
+            linktype, ts_scale = state.interfaces[interface]
+            last_timestamp = ((high << 32) | low) * ts_scale
+            yield last_timestamp, linktype, body[20 : 20 + captured]
+        elif block_type == PCAPNG_OPB:
+            interface, _drops, high, low, captured, _original = struct.unpack_from(
+                byte_order + "HHIIII", body
+            )
+            linktype, ts_scale = state.interfaces[interface]
+            last_timestamp = ((high << 32) | low) * ts_scale
+            yield last_timestamp, linktype, body[20 : 20 + captured]
+        elif block_type == PCAPNG_SPB and state.interfaces:
+            # Pas d'horodatage : on reprend celui du paquet précédent
+            original = struct.unpack_from(byte_order + "I", body)[0]
+            yield last_timestamp, state.interfaces[0][0], body[
+                4 : 4 + min(original, len(body) - 8)
+            ]
+
+
+def iter_packets(source, state, end=None):
+    reader = read_pcap if state.format == "pcap" else read_pcapng
+    return reader(source, state, end)
+
+
+def split_capture(path, chunk_size=CHUNK_SIZE):
+    """
+    Découpe une capture en tranches (début, fin, état de lecture) aux frontières
+    de paquets, en ne lisant que les en-têtes des enregistrements.
+    """
+    source = open_capture(path)
+    try:
+        state = read_header(source)
+        chunks = []
+        start = source.tell()
+        if state.format == "pcap":
+            record = struct.Struct(state.byte_order + "IIII")
+            while True:
+                header = source.read(16)
+                if len(header) < 16:
+                    break
+                source.seek(record.unpack(header)[2], os.SEEK_CUR)
+                if source.tell() - start >= chunk_size:
+                    chunks.append((start, source.tell(), state.copy()))
+                    start = source.tell()
+        else:
+            # Les blocs SHB/IDB sont lus pour connaître les interfaces au début de chaque tranche
+            chunk_state = state.copy()
+            while True:
+                position = source.tell()
+                header = source.read(8)
+                if len(header) < 8:
+                    break
+                if struct.unpack("<I", header[:4])[0] == PCAPNG_SHB:
+                    magic = source.read(4)
+                    state.byte_order = "<" if magic == PCAPNG_LE_MAGIC else ">"
+                    state.interfaces = []
+                    length = struct.unpack(state.byte_order + "I", header[4:])[0]
+                    source.seek(position + length)
+                    continue
+                block_type, length = struct.unpack(state.byte_order + "II", header)
+                if block_type == PCAPNG_IDB:
+                    body = source.read(length - 8)
+                    linktype = struct.unpack_from(state.byte_order + "H", body)[0]
+                    state.interfaces.append(
+                        (linktype, interface_ts_scale(body[8:-4], state.byte_order))
+                    )
+                source.seek(position + length)
+                if source.tell() - start >= chunk_size:
+                    chunks.append((start, source.tell(), chunk_state))
+                    start = source.tell()
+                    chunk_state = state.copy()
+            state = chunk_state
+        if source.tell() > start:
+            chunks.append((start, source.tell(), state))
+        return chunks
+    finally:
+        source.close()
+
+
+# Décodage des couches réseau
+
+
+def network_layer(linktype, frame):
+    """Retourne (version IP, paquet IP) ou None pour les trames non IP."""
+    if linktype == LINK_ETHERNET:
+        ethertype = int.from_bytes(frame[12:14], "big")
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = int.from_bytes(frame[offset + 2 : offset + 4], "big")
+            offset += 4
+    elif linktype == LINK_SLL:
+        ethertype, offset = int.from_bytes(frame[14:16], "big"), 16
+    elif linktype == LINK_SLL2:
+        ethertype, offset = int.from_bytes(frame[0:2], "big"), 20
+    elif linktype in (LINK_NULL, LINK_LOOP):
+        family = frame[0] or frame[3]  # ordre d'octets de la machine de capture
+        ethertype, offset = (ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6), 4
+    elif linktype in LINK_RAW or linktype in (LINK_IPV4, LINK_IPV6):
+        if not frame:
+            return None
+        ethertype, offset = (
+            ETHERTYPE_IPV4 if frame[0] >> 4 == 4 else ETHERTYPE_IPV6
+        ), 0
+    else:
+        return None
+    if ethertype == ETHERTYPE_IPV4:
+        return 4, frame[offset:]
+    if ethertype == ETHERTYPE_IPV6:
+        return 6, frame[offset:]
+    return None
+
+
+def transport_layer(version, packet):
+    """Retourne (protocole, source, destination, segment) ou None (fragments non initiaux, autres protocoles)."""
+    if version == 4:
+        if len(packet) < 20:
+            return None
+        header_length = (packet[0] & 0x0F) * 4
+        total_length = int.from_bytes(packet[2:4], "big") or len(packet)
+        if int.from_bytes(packet[6:8], "big") & 0x1FFF:
+            return None
+        return (
+            packet[9],
+            socket.inet_ntoa(packet[12:16]),
+            socket.inet_ntoa(packet[16:20]),
+            packet[header_length:total_length],
+        )
+    if len(packet) < 40:
+        return None
+    next_header = packet[6]
+    end = 40 + int.from_bytes(packet[4:6], "big")
+    offset = 40
+    while next_header in IPV6_EXTENSIONS or next_header == IPV6_FRAGMENT:
+        if next_header == IPV6_FRAGMENT:
+            if int.from_bytes(packet[offset + 2 : offset + 4], "big") & 0xFFF8:
+                return None
+            length = 8
+        else:
+            length = (packet[offset + 1] + 1) * 8
+        next_header = packet[offset]
+        offset += length
+    source = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+    destination = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+    return next_header, source, destination, packet[offset:end]
+
+
+class TCPStream:
+    __slots__ = ("next_seq", "buffer")
+
+    def __init__(self):
+        self.next_seq = None
+        self.buffer = bytearray()
+
+
+class TCPReassembler:
+    """Reconstitue les messages DNS (préfixés par leur longueur) des flux TCP, capturés dans l'ordre."""
+
+    def __init__(self, max_flows=MAX_TCP_FLOWS):
+        self.flows = OrderedDict()
+        self.max_flows = max_flows
+        self.resets = 0
+
+    def segment(self, key, data):
+        """Ajoute un segment TCP et retourne la liste des messages DNS complets."""
+        if len(data) < 20:
+            return []
+        seq = int.from_bytes(data[4:8], "big")
+        flags = data[13]
+        payload = data[(data[12] >> 4) * 4 :]
+        end_seq = (seq + len(payload)) & 0xFFFFFFFF
+        stream = self.flows.get(key)
+        if stream is None:
+            stream = self.flows[key] = TCPStream()
+            if len(self.flows) > self.max_flows:
+                self.flows.popitem(last=False)
+        else:
+            self.flows.move_to_end(key)
+
+        if flags & 0x02:  # SYN
+            stream.next_seq = (seq + 1) & 0xFFFFFFFF
+            stream.buffer.clear()
+        if payload:
+            if stream.next_seq is not None and seq != stream.next_seq:
+                overlap = (stream.next_seq - seq) & 0xFFFFFFFF
+                if overlap < len(payload):
+                    payload = payload[overlap:]  # retransmission partielle
+                elif overlap < 0x80000000:
+                    payload = b""  # retransmission complète
+                else:
+                    stream.buffer.clear()  # segment manquant : on se resynchronise
+                    self.resets += 1
+            if payload:
+                stream.buffer += payload
+                stream.next_seq = end_seq
+        messages = self._messages(stream)
+        if flags & 0x05:  # FIN ou RST
+            self.flows.pop(key, None)
+        return messages
+
+    def _messages(self, stream):
+        messages = []
+        buffer = stream.buffer
+        while len(buffer) >= 2:
+            length = int.from_bytes(buffer[:2], "big")
+            if length < 12 or len(buffer) > MAX_TCP_BUFFER:
+                buffer.clear()
+                self.resets += 1
+                break
+            if len(buffer) < 2 + length:
+                break
+            messages.append(bytes(buffer[2 : 2 + length]))
+            del buffer[: 2 + length]
+        return messages
+
+
+# Analyse
+
+
+def new_stats():
+    return {
+        "packets": 0,
+        "bytes": 0,
+        "dns_messages": 0,
+        "queries": 0,
+        "responses": 0,
+        "udp": 0,
+        "tcp": 0,
+        "decode_errors": 0,
+        "first_timestamp": None,
+        "last_timestamp": None,
+        "query_types": Counter(),
+        "rcodes": Counter(),
+        "clients": Counter(),
+    }
+
+
+def merge_stats(total, stats):
+    for key, value in stats.items():
+        if isinstance(value, Counter):
+            total[key].update(value)
+        elif key == "first_timestamp":
+            if value is not None and (total[key] is None or value < total[key]):
+                total[key] = value
+        elif key == "last_timestamp":
+            if value is not None and (total[key] is None or value > total[key]):
+                total[key] = value
+        else:
+            total[key] += value
+    return total
+
+
+def handle_message(message, timestamp, source, destination, stats):
+    """Décode un message DNS et alimente le détecteur (requêtes) ou les statistiques (réponses)."""
+    stats["dns_messages"] += 1
+    try:
+        if len(message) < 12:
+            raise ValueError("Truncated DNS header")
+        if not message[2] & 0x80:
+            _transaction_id, _question_end, query_data, error = decode_dns_query(
+                message
+            )
+            if error:
+                raise ValueError(error)
+            stats["queries"] += 1
+            stats["query_types"][query_type_to_string(query_data[1])] += 1
+            stats["clients"][source] += 1
+            detect.detect_anomalies(
+                query_data[0], query_data[1], source, timestamp=timestamp
+            )
+        else:
+            response = parse_dns_message(message)
+            stats["responses"] += 1
+            stats["rcodes"][response.rcode] += 1
+            if response.an_count:
+                decode_dns_response(
+                    response,
+                    response.question_end,
+                    (response.qname, response.qtype, response.qclass),
+                )
+    except Exception:
+        stats["decode_errors"] += 1
+
+
+def analyze(packets, stats, reassembler=None):
+    """Passe les paquets (horodatage, type de lien, trame) dans le décodeur et le détecteur."""
+    reassembler = reassembler or TCPReassembler()
+    for timestamp, linktype, frame in packets:
+        stats["packets"] += 1
+        stats["bytes"] += len(frame)
+        if stats["first_timestamp"] is None:
+            stats["first_timestamp"] = timestamp
+        stats["last_timestamp"] = timestamp
+        try:
+            network = network_layer(linktype, frame)
+            transport = network and transport_layer(*network)
+        except (IndexError, ValueError, struct.error, OSError):
+            continue
+        if not transport:
+            continue
+        protocol, source, destination, segment = transport
+        if protocol not in (PROTO_UDP, PROTO_TCP) or len(segment) < 8:
+            continue
+        source_port = int.from_bytes(segment[0:2], "big")
+        destination_port = int.from_bytes(segment[2:4], "big")
+        if DNS_PORT not in (source_port, destination_port):
+            continue
+        if protocol == PROTO_UDP:
+            stats["udp"] += 1
+            handle_message(
+                segment[8 : int.from_bytes(segment[4:6], "big") or len(segment)],
+                timestamp,
+                source,
+                destination,
+                stats,
+            )
+        else:
+            key = (source, source_port, destination, destination_port)
+            for message in reassembler.segment(key, segment):
+                stats["tcp"] += 1
+                handle_message(message, timestamp, source, destination, stats)
+    return stats
+
+
+def summarize(stats, alerts, elapsed):
+    duration = (stats["last_timestamp"] or 0) - (stats["first_timestamp"] or 0)
+    return {
+        "packets": stats["packets"],
+        "bytes": stats["bytes"],
+        "dns_messages": stats["dns_messages"],
+        "queries": stats["queries"],
+        "responses": stats["responses"],
+        "udp_messages": stats["udp"],
+        "tcp_messages": stats["tcp"],
+        "decode_errors": stats["decode_errors"],
+        "capture_duration_s": round(duration, 3),
+        "processing_s": round(elapsed, 3),
+        "packets_per_second": round(stats["packets"] / elapsed) if elapsed else None,
+        "query_types": dict(stats["query_types"].most_common()),
+        "rcodes": {
+            str(rcode): count for rcode, count in sorted(stats["rcodes"].items())
+        },
+        "top_clients": dict(stats["clients"].most_common(10)),
+        "alerts": dict(alerts),
+    }
+
+
+# Mode --workers
+
+
+def init_worker():
+    # Chaque processus envoie ses compteurs sous forme de deltas, fusionnés par le processus principal
+    detect.enable_aggregation(queue.Queue())
+
+
+def process_chunk(task):
+    path, start, end, state = task
+    source = open_capture(path)
+    try:
+        source.seek(start)
+        stats = analyze(iter_packets(source, state, end), new_stats())
+    finally:
+        source.close()
+    detect.delta_recorder.flush()
+    batches = []
+    while True:
+        try:
+            batches.append(detect.delta_recorder.queue.get_nowait())
+        except queue.Empty:
+            return stats, batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("captures", nargs="+", help="fichiers pcap ou pcapng")
+    parser.add_argument(
+        "--alerts",
+        default="-",
+        help="fichier des alertes, une par ligne en JSON (défaut : sortie standard)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="processus d'analyse (0 : analyse dans le processus courant)",
+    )
+    parser.add_argument(
+        "--chunk-mb",
+        type=float,
+        default=CHUNK_SIZE // (1024 * 1024),
+        help="taille des tranches en mode --workers",
+    )
+    args = parser.parse_args()
+
+    output = (
+        sys.stdout if args.alerts == "-" else open(args.alerts, "w", encoding="utf-8")
+    )
+    alert_counts = Counter()
+
+    def write_alert(
+        public_suffix,
+        unique_count,
+        client_address,
+        alert_level="high",
+        additional_info=None,
+    ):
+        additional_info = additional_info or {}
+        alert_counts[additional_info.get("alert_reason", "unknown")] += 1
+        alert = {
+            "public_suffix": public_suffix,
+            "unique_count": unique_count,
+            "client_address": client_address,
+            "alert_level": alert_level,
+            "additional_info": additional_info,
+        }
+        output.write(json.dumps(alert, default=str) + "\n")
+
+    detect.set_alert_handler(write_alert)
+    started = time.perf_counter()
+    stats = new_stats()
+
+    if args.workers > 0:
+        tasks = [
+            (path, start, end, state)
+            for path in args.captures
+            for start, end, state in split_capture(
+                path, int(args.chunk_mb * 1024 * 1024)
+            )
+        ]
+        context = multiprocessing.get_context("fork")
+        with context.Pool(args.workers, initializer=init_worker) as pool:
+            # Résultats dans l'ordre des tranches : les fenêtres de détection avancent dans le temps
+            for chunk_stats, batches in pool.imap(process_chunk, tasks):
+                merge_stats(stats, chunk_stats)
+                for batch in batches:
+                    detect.merge_deltas(*batch)
+    else:
+        for path in args.captures:
+            source = open_capture(path)
+            try:
+                analyze(iter_packets(source, read_header(source)), stats)
+            finally:
+                source.close()
+        if detect.lexical_scorer is not None:
+            for parent_domain, client_address, alert in detect.lexical_scorer.flush():
+                write_alert(
+                    public_suffix=parent_domain, client_address=client_address, **alert
+                )
+
+    output.flush()
+    summary = summarize(stats, alert_counts, time.perf_counter() - started)
+    json.dump(summary, sys.stderr, indent=2)
+    print(file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,350 @@
+"""
+Liste de blocage : les noms d'un domaine bloqué reçoivent une réponse locale
+(NXDOMAIN, REFUSED ou adresse de sinkhole), sans requête vers l'amont ni
+document Elasticsearch.
+
+La liste (BLOCKLIST_FILE, un domaine par ligne ; le format hosts
+« 0.0.0.0 domaine » est aussi accepté) est compilée en un index de suffixes
+haché : une table à adressage ouvert des empreintes 64 bits des domaines, soit
+16 à 32 octets par entrée. Un nom est bloqué si l'un de ses suffixes
+(a.b.example.com, b.example.com, example.com...) est dans l'index : une
+recherche dans la table par label. Le fichier est relu en arrière-plan quand
+il change, et l'index remplacé d'un bloc.
+
+Avec BLOCKLIST_AUTO=on, les domaines qui lèvent une alerte de détection sont
+ajoutés pendant BLOCKLIST_AUTO_TTL secondes, au plus BLOCKLIST_AUTO_MAX à la
+fois (les plus proches de l'expiration sont retirés en premier). En mode
+--workers, l'agrégateur qui lève les alertes les transmet aux workers. Si
+BLOCKLIST_AUTO_FILE est défini, les domaines encore bloqués y sont réécrits (une
+ligne par domaine, sans les expirés) à chaque ajout, et relus au redémarrage
+comme par les autres processus.
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+from array import array
+
+from decoder import DNSMessage
+
+BLOCKLIST_FILE = os.getenv("BLOCKLIST_FILE", "")  # vide : pas de liste
+BLOCKLIST_ACTION = os.getenv(
+    "BLOCKLIST_ACTION", "nxdomain"
+)  # nxdomain, refused ou sinkhole
+BLOCKLIST_SINKHOLE_V4 = os.getenv("BLOCKLIST_SINKHOLE_V4", "0.0.0.0")
+BLOCKLIST_SINKHOLE_V6 = os.getenv("BLOCKLIST_SINKHOLE_V6", "::")
+BLOCKLIST_TTL = int(os.getenv("BLOCKLIST_TTL", "60"))  # TTL des réponses locales
+BLOCKLIST_RELOAD_INTERVAL = float(os.getenv("BLOCKLIST_RELOAD_INTERVAL", "5"))
+BLOCKLIST_AUTO = os.getenv("BLOCKLIST_AUTO", "off") == "on"
+BLOCKLIST_AUTO_FILE = os.getenv("BLOCKLIST_AUTO_FILE", "")
+BLOCKLIST_AUTO_TTL = float(
+    os.getenv("BLOCKLIST_AUTO_TTL", "3600")
+)  # 0 : sans expiration
+BLOCKLIST_AUTO_MAX = int(
+    os.getenv("BLOCKLIST_AUTO_MAX", "10000")
+)  # domaines bloqués automatiquement à la fois
+
+ACTIONS = ("nxdomain", "refused", "sinkhole")
+RCODE_NXDOMAIN = 3
+RCODE_REFUSED = 5
+TYPE_A = 1
+TYPE_AAAA = 28
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_RA = 0x0080
+
+
+def normalize(domain):
+    domain = domain.strip().lower().rstrip(".")
+    if domain.startswith("*."):
+        domain = domain[2:]
+    return domain
+
+
+def domain_hash(domain):
+    # hash() des str : rapide et mis en cache sur l'objet, mais propre au processus ;
+    # l'index n'est jamais écrit sur disque.
+    return hash(domain)
+
+
+def read_domains(path):
+    """Domaines d'un fichier de liste (commentaires #, format hosts accepté)."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.split("#", 1)[0].split()
+            if not line:
+                continue
+            domain = normalize(line[-1])
+            if domain and domain not in ("localhost", "0.0.0.0"):
+                yield domain
+
+
+class SuffixIndex:
+    """
+    Ensemble compact de domaines : table de hachage à adressage ouvert (sondage
+    linéaire) de leurs empreintes 64 bits, remplie au plus à moitié.
+    """
+
+    __slots__ = ("table", "mask", "count")
+
+    def __init__(self, domains=()):
+        hashes = {
+            domain_hash(domain) or 1 for domain in domains
+        }  # 0 marque une case vide
+        size = 16
+        while size < 2 * len(hashes):
+            size *= 2
+        table = array("q", bytes(8 * size))
+        mask = size - 1
+        for value in hashes:
+            slot = value & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = value
+        self.table = table
+        self.mask = mask
+        self.count = len(hashes)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, domain):
+        value = domain_hash(domain) or 1
+        table = self.table
+        mask = self.mask
+        slot = value & mask
+        while True:
+            stored = table[slot]
+            if stored == value:
+                return True
+            if not stored:
+                return False
+            slot = (slot + 1) & mask
+
+    def match(self, qname):
+        """Suffixe bloqué de qname (lui-même compris), ou None."""
+        if not self.count:
+            return None
+        name = normalize(qname)
+        while name:
+            if name in self:
+                return name
+            dot = name.find(".")
+            if dot < 0:
+                return None
+            name = name[dot + 1 :]
+        return None
+
+
+def blocked_response(
+    data,
+    action,
+    ttl=BLOCKLIST_TTL,
+    sinkhole_v4=BLOCKLIST_SINKHOLE_V4,
+    sinkhole_v6=BLOCKLIST_SINKHOLE_V6,
+):
+    """Réponse locale à une requête bloquée, ou None si la requête est illisible."""
+    try:
+        message = DNSMessage(data)
+        if message.qd_count != 1:
+            return None
+        question = bytes(data[12 : message.question_end])
+    except (IndexError, ValueError, struct.error):
+        return None
+    flags = (
+        FLAG_QR | FLAG_AA | FLAG_RA | (message.flags & 0x7900)
+    )  # opcode et RD recopiés
+    answer = b""
+    if action == "refused":
+        flags = (flags & ~FLAG_AA) | RCODE_REFUSED
+    elif action == "nxdomain":
+        flags |= RCODE_NXDOMAIN
+    elif message.qtype == TYPE_A:
+        answer = struct.pack("!HHHIH", 0xC00C, TYPE_A, 1, ttl, 4) + socket.inet_pton(
+            socket.AF_INET, sinkhole_v4
+        )
+    elif message.qtype == TYPE_AAAA:
+        answer = struct.pack(
+            "!HHHIH", 0xC00C, TYPE_AAAA, 1, ttl, 16
+        ) + socket.inet_pton(socket.AF_INET6, sinkhole_v6)
+    # sinkhole des autres types : réponse vide (NODATA)
+    return (
+        struct.pack("!6H", message.id, flags, 1, 1 if answer else 0, 0, 0)
+        + question
+        + answer
+    )
+
+
+class Blocklist:
+    def __init__(
+        self,
+        path=BLOCKLIST_FILE,
+        action=BLOCKLIST_ACTION,
+        auto_path=BLOCKLIST_AUTO_FILE,
+        auto_ttl=BLOCKLIST_AUTO_TTL,
+        auto_max=BLOCKLIST_AUTO_MAX,
+    ):
+        if action not in ACTIONS:
+            raise ValueError(
+                f"Unknown blocklist action {action!r}, expected one of {', '.join(ACTIONS)}"
+            )
+        self.path = path
+        self.action = action
+        self.auto_path = auto_path
+        self.auto_ttl = auto_ttl
+        self.auto_max = auto_max
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # réécritures de auto_path
+        self.index = SuffixIndex()
+        self.auto = (
+            {}
+        )  # domaine ajouté par la détection -> heure d'expiration (time.time(), 0 : jamais)
+        self.mtimes = {}
+        # Compteurs
+        self.lookups = 0
+        self.blocked = 0
+        self.auto_blocked = 0
+        self.reloads = 0
+        self.reload()
+
+    def _changed(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+        if self.mtimes.get(path) == mtime:
+            return False
+        self.mtimes[path] = mtime
+        return True
+
+    def reload(self):
+        """Relit la liste et les domaines ajoutés automatiquement s'ils ont changé."""
+        if self.path and self._changed(self.path):
+            start = time.perf_counter()
+            index = SuffixIndex(read_domains(self.path))
+            self.index = index  # remplacement atomique : les recherches en cours gardent l'ancien index
+            self.reloads += 1
+            print(
+                f"Blocklist {self.path} : {len(index)} domains loaded in {time.perf_counter() - start:.1f}s"
+            )
+        if self.auto_path and self._changed(self.auto_path):
+            auto = {}
+            now = time.time()
+            with open(self.auto_path, encoding="utf-8") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        expires = float(fields[1])
+                        if not expires or expires > now:
+                            auto[fields[0]] = expires
+            with self.lock:
+                self.auto.update(auto)
+                self._prune_auto(now)
+
+    def start_reload(self, interval=BLOCKLIST_RELOAD_INTERVAL):
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload()
+                except (OSError, ValueError) as e:
+                    print(f"Blocklist reload error : {e}")
+
+        threading.Thread(target=loop, daemon=True, name="blocklist-reload").start()
+
+    def add(self, domain, persist=True):
+        """
+        Bloque un domaine signalé par la détection pendant auto_ttl secondes.
+        persist=False ne réécrit pas BLOCKLIST_AUTO_FILE (blocage reçu de l'agrégateur).
+        """
+        domain = normalize(domain)
+        if not domain:
+            return
+        now = time.time()
+        expires = now + self.auto_ttl if self.auto_ttl else 0
+        with self.lock:
+            self.auto[domain] = expires
+            self._prune_auto(now)
+        if persist and self.auto_path:
+            self._write_auto()
+
+    def _prune_auto(self, now):
+        # Appelé sous self.lock : retire les expirés, puis les plus proches de l'expiration au-delà de auto_max
+        if len(self.auto) <= self.auto_max:
+            return
+        for domain, expires in list(self.auto.items()):
+            if expires and expires <= now:
+                del self.auto[domain]
+        excess = len(self.auto) - self.auto_max
+        if excess > 0:
+            soonest = sorted(
+                self.auto, key=lambda domain: self.auto[domain] or float("inf")
+            )[:excess]
+            for domain in soonest:
+                del self.auto[domain]
+
+    def _write_auto(self):
+        """Réécrit le fichier des domaines bloqués automatiquement : un domaine par ligne, sans les expirés."""
+        path = self.auto_path
+        with self.write_lock:
+            now = time.time()
+            with self.lock:
+                entries = sorted(self.auto.items())
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                for domain, expires in entries:
+                    if not expires or expires > now:
+                        f.write(f"{domain} {expires}\n")
+            os.replace(
+                path + ".tmp", path
+            )  # les autres processus ne lisent jamais un fichier à moitié écrit
+
+    def match(self, qname):
+        """Domaine bloqué couvrant qname, ou None."""
+        self.lookups += 1
+        domain = self.index.match(qname)
+        if domain is None and self.auto:
+            domain = self._match_auto(qname)
+        if domain is not None:
+            self.blocked += 1
+        return domain
+
+    def _match_auto(self, qname):
+        name = normalize(qname)
+        while name:
+            expires = self.auto.get(name)
+            if expires is not None:
+                if not expires or expires > time.time():
+                    self.auto_blocked += 1
+                    return name
+                with self.lock:
+                    self.auto.pop(name, None)
+            dot = name.find(".")
+            if dot < 0:
+                break
+            name = name[dot + 1 :]
+        return None
+
+    def answer(self, data, qname):
+        """Réponse locale si qname est bloqué, sinon None."""
+        if self.match(qname) is None:
+            return None
+        return blocked_response(data, self.action)
+
+    def stats(self):
+        return {
+            "domains": len(self.index),
+            "auto_domains": len(self.auto),
+            "lookups": self.lookups,
+            "blocked": self.blocked,
+            "auto_blocked": self.auto_blocked,
+            "reloads": self.reloads,
+        }
+
+
+def create_blocklist(path=BLOCKLIST_FILE, action=BLOCKLIST_ACTION, auto=BLOCKLIST_AUTO):
+    """Blocklist configurée par l'environnement, ou None sans liste ni ajout automatique."""
+    if not path and not auto:
+        return None
+    return Blocklist(path, action)
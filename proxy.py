@@ -1,71 +1,336 @@
+import argparse
+import asyncio
+import atexit
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
 import socket
+import sys
 import threading
-from decoder import decode_dns_query, decode_dns_response
-from logger import log_request, log_error
-from detect import detect_anomalies
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decoder import decode_dns_query, parse_dns_message
+from logger import (
+    log_response,
+    log_error,
+    log_suspicious_activity,
+    enable_spool,
+    set_log_mode,
+    rollups_enabled,
+    mark_suspicious,
+    LOG_MODE,
+    LOG_MODES,
+)
+from detect import (
+    submit_detection,
+    enable_aggregation,
+    run_aggregator,
+    set_alert_handler,
+    broadcast_alerts,
+    receive_alerts,
+)
+from upstream import UpstreamSet, parse_address, recv_exact
+from cache import DNSCache, CACHE_SIZE, CACHE_SNAPSHOT, parse_question
+from ratelimit import (
+    create_rate_limiter,
+    RATE_LIMIT_QPS,
+    RATE_LIMIT_ACTION,
+    ACTIONS as RATE_LIMIT_ACTIONS,
+)
+from policy import (
+    create_blocklist,
+    BLOCKLIST_FILE,
+    BLOCKLIST_ACTION,
+    BLOCKLIST_AUTO,
+    ACTIONS as BLOCKLIST_ACTIONS,
+)
+from metrics import observe, increment, register, start_metrics_server
+from spool import SPOOL_DIR
+from capture import create_query_capture, QUERY_CAPTURE
 from collections import defaultdict
 
 LISTEN_HOST = "0.0.0.0"
 LISTEN_PORT = 53
 DNS_SERVER = "8.8.8.8"  # Google DNS
 DNS_PORT = 53
+UPSTREAMS = None  # liste de (adresse, port) ; par défaut [(DNS_SERVER, DNS_PORT)]
 BUFFER_SIZE = 4096
+RCODE_SERVFAIL = 2
+REUSE_PORT = False  # SO_REUSEPORT, activé en mode --workers
+AGGREGATION_QUEUE_SIZE = (
+    1000  # lots de compteurs en attente vers l'agrégateur de détection
+)
+ALERT_QUEUE_SIZE = (
+    1000  # domaines alertés en attente de l'agrégateur vers chaque worker
+)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = (
+    9153  # 0 = pas d'endpoint /metrics ; en mode --workers, port + numéro du worker
+)
 
+# Connexions TCP clientes (RFC 7766)
+TCP_IDLE_TIMEOUT = 10  # secondes sans requête avant de fermer la connexion
+TCP_MAX_PIPELINE = 32  # requêtes traitées en parallèle sur une même connexion
 
+# Moteur asyncio
+MAX_INFLIGHT = 2048  # requêtes UDP en cours avant de commencer à en ignorer
+LOG_WORKERS = 8  # threads dédiés à la détection et aux logs Elasticsearch
 
-def forward_to_resolver(data, use_tcp=False):
-    """Forward the DNS query to the real DNS resolver over UDP or TCP."""
-    if use_tcp:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as resolver_socket:
-            resolver_socket.connect((DNS_SERVER, DNS_PORT))
-            resolver_socket.sendall(len(data).to_bytes(2, byteorder="big") + data)
-            response_length = int.from_bytes(resolver_socket.recv(2), byteorder="big")
-            response = resolver_socket.recv(response_length)
+_upstreams = None
+_upstreams_lock = threading.Lock()
+
+# Cache des réponses (None = désactivé)
+response_cache = DNSCache(CACHE_SIZE)
+# Limitation du débit par client (None = désactivée)
+rate_limiter = create_rate_limiter()
+# Liste de blocage (None = désactivée), chargée au démarrage
+blocklist = None
+# Enregistrement des requêtes brutes (--capture), créé par start_capture()
+query_capture = None
+
+
+def get_upstreams():
+    """Returns the shared set of upstream resolvers, created on first use."""
+    global _upstreams
+    if _upstreams is None:
+        with _upstreams_lock:
+            if _upstreams is None:
+                _upstreams = UpstreamSet(UPSTREAMS or [(DNS_SERVER, DNS_PORT)])
+    return _upstreams
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight questions: concurrent queries with the same
+    (qname, qtype, qclass, DO bit, EDNS UDP size) and transport share one upstream request,
+    whose response is then patched with each client's transaction ID.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # clé -> Future de la requête amont partagée
+        self.upstream_queries = 0
+        self.saved = 0
+
+    def submit(self, data, use_tcp, start):
+        """Returns (future, question end) for the upstream request answering data."""
+        key, qend = parse_question(data)
+        if key is None:
+            return start(), None
+        key += (use_tcp,)
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.saved += 1
+                return future, qend
+            self.upstream_queries += 1
+            future = self.calls[key] = start()
+        future.add_done_callback(lambda _done: self._forget(key, future))
+        return future, qend
+
+    def _forget(self, key, future):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+    @staticmethod
+    def answer_for(data, response, qend):
+        """The shared response with the client's transaction ID and question case."""
+        if qend is None or len(response) < qend:
             return response
+        return data[:2] + response[2:12] + data[12:qend] + response[qend:]
+
+
+singleflight = SingleFlight()
+
+
+def submit_to_resolver(data, use_tcp):
+    return singleflight.submit(
+        data, use_tcp, lambda: get_upstreams().submit(data, use_tcp=use_tcp)
+    )
+
+
+def forward_to_resolver(data, use_tcp=False):
+    """Forward the DNS query to the fastest healthy upstream resolver over UDP or TCP."""
+    future, qend = submit_to_resolver(data, use_tcp)
+    return SingleFlight.answer_for(data, future.result(), qend)
+
+
+def over_rate_limit(client_ip, source):
+    """True when the client has exceeded its rate; the caller then applies rate_limiter.response()."""
+    if (
+        rate_limiter is None
+        or not rate_limiter.applies_to(source == "TCP")
+        or rate_limiter.allow(client_ip)
+    ):
+        return False
+    increment(
+        "dns_proxy_rate_limited_total",
+        (("action", rate_limiter.action), ("transport", source)),
+        help_text="Queries rejected by the per-client rate limiter.",
+    )
+    return True
+
+
+def capture_query(data, client_ip, source):
+    """Appends the raw query to the capture file when --capture is on."""
+    if query_capture is not None:
+        query_capture.record(data, client_ip, tcp=(source == "TCP"))
+
+
+def blocked_answer(data, query_data, source):
+    """Local NXDOMAIN/REFUSED/sinkhole answer for a query under a blocked domain, or None."""
+    if blocklist is None or not query_data:
+        return None
+    response = blocklist.answer(data, query_data[0])
+    if response is not None:
+        increment(
+            "dns_proxy_blocked_total",
+            (("action", blocklist.action), ("transport", source)),
+            help_text="Queries answered locally by the blocklist.",
+        )
+    return response
+
+
+def block_detected_domain(
+    public_suffix,
+    unique_count,
+    client_address,
+    alert_level="high",
+    additional_info=None,
+):
+    """Alert handler of the detector when BLOCKLIST_AUTO is on: logs the alert and blocks the domain."""
+    log_suspicious_activity(
+        public_suffix, unique_count, client_address, alert_level, additional_info
+    )
+    blocklist.add(public_suffix)
+
+
+def timed(stage, transport, function, *args, **kwargs):
+    """Calls function and records its duration in the stage latency histogram."""
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        observe(stage, transport, time.perf_counter() - start)
+
+
+def refresh_cache_entry(query):
+    """Re-resolves a popular cached name in the background, shortly before it expires."""
+    future, _qend = submit_to_resolver(query, False)
+
+    def store(done):
+        if not done.cancelled() and done.exception() is None:
+            response_cache.put(query, done.result())
+
+    future.add_done_callback(store)
+
+
+def stale_answer(data, response=None):
+    """
+    Expired cached answer to serve when the upstream failed or answered SERVFAIL
+    (RFC 8767), or None.
+    """
+    if response_cache is None or (
+        response is not None and response[3] & 0x0F != RCODE_SERVFAIL
+    ):
+        return None
+    return response_cache.get_stale(data)
+
+
+def resolve(data, use_tcp=False):
+    """Answers from the response cache when possible, otherwise forwards to the resolver."""
+    transport = "TCP" if use_tcp else "UDP"
+    if response_cache is not None:
+        cached = timed("cache", transport, response_cache.get, data)
+        if cached is not None:
+            return cached
+    try:
+        response = timed(
+            "forward", transport, forward_to_resolver, data, use_tcp=use_tcp
+        )
+    except Exception:
+        stale = stale_answer(data)
+        if stale is None:
+            raise
+        return stale
+    stale = stale_answer(data, response)
+    if stale is not None:
+        return stale
+    # Seules les réponses UDP sont mises en cache : une réponse TCP peut dépasser
+    # la taille acceptée par un client UDP.
+    if response_cache is not None and not use_tcp:
+        response_cache.put(data, response)
+    return response
+
+
+def log_exchange(data, response, query_data, source, client_ip):
+    """
+    Logs a forwarded query. Only the response header is parsed here: the records
+    are decoded lazily by the log writer.
+    """
+    message = parse_dns_message(response)
+    rcode = message.rcode  # Récupère le rcode des flags
+    increment(
+        "dns_proxy_responses_total",
+        (("rcode", rcode), ("transport", source)),
+        help_text="Responses sent to clients, by rcode.",
+    )
+
+    # Comme decode_dns_response : une réponse sans enregistrement n'est pas journalisée,
+    # sauf en mode rollup où son rcode est compté (NXDOMAIN, NODATA, SERVFAIL...)
+    if not rollups_enabled():
+        assert (
+            message.an_count > 0
+        ), f"Expected at least 1 answer, got {message.an_count}"
+    # Vérification du rcode et des réponses attendues
+    if rcode == 3:  # NXDOMAIN
+        assert message.an_count == 0, "NXDOMAIN mais des réponses détectées"
+
+    if query_data[0] == "error":
+        log_error(
+            "Invalid qname decode query",
+            source=source,
+            query_data=query_data,
+            answer_data=str(response),
+            query_data_raw=data,
+            client_address=client_ip,
+        )
     else:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as resolver_socket:
-            resolver_socket.sendto(data, (DNS_SERVER, DNS_PORT))
-            response, _ = resolver_socket.recvfrom(BUFFER_SIZE)
-            return response
+        log_response(
+            message,
+            query_data,
+            source=source,
+            client_address=client_ip,
+            query_data_raw=data,
+        )
 
 
 def handle_dns_request_udp(sock, data, addr):
     """Handles a DNS request over UDP."""
     client_ip, client_port = addr
+    start = time.perf_counter()
     try:
-        _transaction_id, question_end_index, query_data, error = decode_dns_query(data)
-        try:
-            detect_anomalies(query_data[0], query_data[1],client_ip)
-        except Exception as e:
-            print(f"Error in detect_anomalies : {e}")
-            pass
+        _transaction_id, question_end_index, query_data, error = timed(
+            "decode_query", "UDP", decode_dns_query, data
+        )
+        # Analysée par le thread de détection, hors du chemin de la réponse
+        submit_detection(query_data[0], query_data[1], client_ip)
         if error:
             raise Exception(error)
+        blocked = blocked_answer(data, query_data, "UDP")
+        if blocked is not None:
+            sock.sendto(blocked, addr)
+            observe("total", "UDP", time.perf_counter() - start)
+            return
         try:
-            response = forward_to_resolver(data, use_tcp=False)
-            rcode = response[3] & 0x0F  # Récupère le rcode des flags
-
-            response_data = decode_dns_response(
-                response, question_end_index, query_data, data
+            response = resolve(data, use_tcp=False)
+            timed(
+                "log", "UDP", log_exchange, data, response, query_data, "UDP", client_ip
             )
-
-
-            # Vérification du rcode et des réponses attendues
-            if rcode == 3:  # NXDOMAIN
-                assert response_data["answer"] == 0, "NXDOMAIN mais des réponses détectées"
-
-            if query_data[0] == 'error':
-                log_error(
-                    "Invalid qname decode query",
-                    source=f"UDP",
-                    query_data=query_data,
-                    answer_data=str(response),
-                    query_data_raw=str(data),
-                    client_address=client_ip
-                )
-            else:
-                log_request(response_data, rcode, source="UDP", client_address=client_ip)
             sock.sendto(response, addr)
+            observe("total", "UDP", time.perf_counter() - start)
         except Exception as e:
             if 'response' in locals():
                 sock.sendto(response, addr)
@@ -74,79 +339,146 @@ def handle_dns_request_udp(sock, data, addr):
                 source=f"UDP",
                 query_data=query_data,
                 answer_data=str(response) if 'response' in locals() else "No response data",
-                query_data_raw=str(data),
+                query_data_raw=data,
                 client_address=client_ip
             )
     except Exception as e:
-        response = forward_to_resolver(data, use_tcp=False)
+        response = resolve(data, use_tcp=False)
         sock.sendto(response, addr)
         log_error(
             e,
             source=f"UDP",
             query_data=query_data if 'query_data' in locals() else None,
             answer_data=str(response),
-            query_data_raw=str(data),
+            query_data_raw=data,
             client_address=client_ip
         )
 
 
 def handle_dns_request_tcp(client_socket, client_addr):
-    """Handles a DNS request over TCP."""
+    """
+    Serves a client TCP connection (RFC 7766): queries are read until the client
+    closes the connection or stays idle for TCP_IDLE_TIMEOUT, and each one is
+    answered as soon as it is resolved, possibly out of order.
+    """
     client_ip, client_port = client_addr
-    try:
-        message_length = int.from_bytes(client_socket.recv(2), byteorder="big")
-        data = client_socket.recv(message_length)
-        _transaction_id, question_end_index, query_data, error = decode_dns_query(data)
+    send_lock = threading.Lock()
+    pipeline = threading.BoundedSemaphore(TCP_MAX_PIPELINE)
+    workers = []
+
+    def send(response):
+        with send_lock:
+            client_socket.sendall(len(response).to_bytes(2, byteorder="big") + response)
+
+    def answer(data):
         try:
-            detect_anomalies(query_data[0], query_data[1],client_ip)
-        except Exception as e:
-            print(f"Error in detect_anomalies : {e}")
-            pass
+            handle_dns_query_tcp(send, data, client_ip)
+        finally:
+            pipeline.release()
+
+    client_socket.settimeout(TCP_IDLE_TIMEOUT)
+    try:
+        while True:
+            try:
+                message_length = int.from_bytes(
+                    recv_exact(client_socket, 2), byteorder="big"
+                )
+            except (socket.timeout, ConnectionError):
+                break  # connexion inactive ou fermée par le client entre deux messages
+            data = recv_exact(client_socket, message_length)
+            capture_query(data, client_ip, "TCP")
+            if over_rate_limit(client_ip, "TCP"):
+                response = rate_limiter.response(data, use_tcp=True)
+                if response is not None:
+                    send(response)
+                continue
+            pipeline.acquire()
+            worker = threading.Thread(target=answer, args=(data,))
+            worker.start()
+            workers = [w for w in workers if w.is_alive()]
+            workers.append(worker)
+    except Exception as e:
+        log_error(
+            e,
+            source="TCP",
+            query_data_raw="No query data",
+            query_data=None,
+            answer_data="No response data",
+            client_address=client_ip,
+        )
+    finally:
+        # Les réponses en cours partent avant la fermeture
+        for worker in workers:
+            worker.join()
+        client_socket.close()
+
+
+def handle_dns_query_tcp(send, data, client_ip):
+    """Handles one DNS query received on a client TCP connection."""
+    try:
+        start = time.perf_counter()
+        _transaction_id, question_end_index, query_data, error = timed(
+            "decode_query", "TCP", decode_dns_query, data
+        )
+        # Analysée par le thread de détection, hors du chemin de la réponse
+        submit_detection(query_data[0], query_data[1], client_ip)
         if error:
             raise Exception(error)
+        blocked = blocked_answer(data, query_data, "TCP")
+        if blocked is not None:
+            send(blocked)
+            observe("total", "TCP", time.perf_counter() - start)
+            return
         try:
-
-            response = forward_to_resolver(data, use_tcp=True)
-            response_data = decode_dns_response(
-                response, question_end_index, query_data, data
+            response = resolve(data, use_tcp=True)
+            timed(
+                "log", "TCP", log_exchange, data, response, query_data, "TCP", client_ip
             )
-            rcode = response[3] & 0x0F  # Récupère le rcode des flags
-
-            log_request(response_data, rcode, source="TCP", client_address=client_ip)
-            client_socket.sendall(len(response).to_bytes(2, byteorder="big") + response)
+            send(response)
+            observe("total", "TCP", time.perf_counter() - start)
         except Exception as e:
             if 'response' in locals():
-                client_socket.sendall(len(response).to_bytes(2, byteorder="big") + response)
+                send(response)
             log_error(
                 e,
                 source="TCP",
                 query_data=query_data,
                 answer_data=str(response) if 'response' in locals() else "No response data",
-                query_data_raw=str(data),
+                query_data_raw=data,
                 client_address=client_ip
             )
     except Exception as e:
-        if 'data' in locals():
-            response = forward_to_resolver(data, use_tcp=True)
-            client_socket.sendall(len(response).to_bytes(2, byteorder="big") + response)
-        log_error(e,
-                  source="TCP",
-                  query_data_raw=str(data) if 'data' in locals() else "No query data",
-                  query_data=query_data if 'query_data' in locals() else None,
-                  answer_data=str(response) if 'response' in locals() else "No response data",
-                  client_address=client_ip
-                  )
-    finally:
-        client_socket.close()
+        try:
+            response = resolve(data, use_tcp=True)
+            send(response)
+        except Exception:
+            pass
+        log_error(
+            e,
+            source="TCP",
+            query_data_raw=data,
+            query_data=query_data if "query_data" in locals() else None,
+            answer_data=str(response) if "response" in locals() else "No response data",
+            client_address=client_ip,
+        )
 
 
 def start_udp_server():
     udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if REUSE_PORT:
+        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     udp_sock.bind((LISTEN_HOST, LISTEN_PORT))
     print(f"DNS Proxy listening on UDP {LISTEN_HOST}:{LISTEN_PORT}")
 
     while True:
         data, addr = udp_sock.recvfrom(BUFFER_SIZE)
+        capture_query(data, addr[0], "UDP")
+        # Un client au-delà de son débit ne coûte ni thread ni requête amont
+        if over_rate_limit(addr[0], "UDP"):
+            response = rate_limiter.response(data)
+            if response is not None:
+                udp_sock.sendto(response, addr)
+            continue
         threading.Thread(
             target=handle_dns_request_udp, args=(udp_sock, data, addr)
         ).start()
@@ -155,6 +487,8 @@ def start_udp_server():
 def start_tcp_server():
     tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if REUSE_PORT:
+        tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     tcp_sock.bind((LISTEN_HOST, LISTEN_PORT))
     tcp_sock.listen(5)
     print(f"DNS Proxy listening on TCP {LISTEN_HOST}:{LISTEN_PORT}")
@@ -168,14 +502,589 @@ def start_tcp_server():
 
 
 
+async def forward_to_resolver_async(data, use_tcp=False):
+    """Forward the DNS query to the real DNS resolver without blocking the event loop."""
+    # Les pools gèrent eux-mêmes les délais, les retransmissions et les requêtes doublées.
+    future, qend = submit_to_resolver(data, use_tcp)
+    # shield : un client qui abandonne ne doit pas annuler la requête partagée
+    response = await asyncio.shield(asyncio.wrap_future(future))
+    return SingleFlight.answer_for(data, response, qend)
+
+
+async def resolve_async(data, use_tcp=False):
+    """asyncio counterpart of resolve()."""
+    transport = "TCP" if use_tcp else "UDP"
+    if response_cache is not None:
+        cached = timed("cache", transport, response_cache.get, data)
+        if cached is not None:
+            return cached
+    start = time.perf_counter()
+    try:
+        response = await forward_to_resolver_async(data, use_tcp=use_tcp)
+    except Exception:
+        stale = stale_answer(data)
+        if stale is None:
+            raise
+        return stale
+    finally:
+        observe("forward", transport, time.perf_counter() - start)
+    stale = stale_answer(data, response)
+    if stale is not None:
+        return stale
+    if response_cache is not None and not use_tcp:
+        response_cache.put(data, response)
+    return response
+
+
+def report_exchange(data, response, query_data, error, source, client_ip, log=True):
+    """
+    Queues the query for detection, decodes the response and logs the exchange (unless log is False).
+    Called from the log executor so that the event loop never waits on Elasticsearch.
+    """
+    if query_data is not None:
+        submit_detection(query_data[0], query_data[1], client_ip)
+    if not log:
+        return
+
+    try:
+        if isinstance(error, Exception):
+            raise error
+        if error:
+            raise Exception(error)
+        timed(
+            "log", source, log_exchange, data, response, query_data, source, client_ip
+        )
+    except Exception as e:
+        log_error(
+            e,
+            source=source,
+            query_data=query_data,
+            answer_data=str(response) if response is not None else "No response data",
+            query_data_raw=data,
+            client_address=client_ip,
+        )
+
+
+class AsyncProxyEngine:
+    """asyncio engine: same decode -> detect -> forward -> log pipeline, without a thread per request."""
+
+    def __init__(self, max_inflight=MAX_INFLIGHT, log_workers=LOG_WORKERS):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.dropped = 0
+        self.tasks = set()
+        self.log_executor = ThreadPoolExecutor(
+            max_workers=log_workers, thread_name_prefix="proxy-log"
+        )
+        register(
+            "dns_proxy_asyncio_tasks",
+            "Live asyncio request tasks.",
+            lambda: len(self.tasks),
+        )
+        register(
+            "dns_proxy_asyncio_inflight",
+            "UDP requests being answered.",
+            lambda: self.inflight,
+        )
+        register(
+            "dns_proxy_asyncio_dropped_total",
+            "UDP datagrams dropped above MAX_INFLIGHT.",
+            lambda: self.dropped,
+            kind="counter",
+        )
+        register(
+            "dns_proxy_log_executor_queue",
+            "Exchanges waiting for the log executor.",
+            lambda: self.log_executor._work_queue.qsize(),
+        )
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def handle_dns_request(self, data, client_ip, source):
+        """Handles a DNS request and returns the response to send back (or None)."""
+        start = time.perf_counter()
+        try:
+            _transaction_id, _question_end_index, query_data, error = timed(
+                "decode_query", source, decode_dns_query, data
+            )
+        except Exception as e:
+            query_data, error = None, e
+
+        response = None if error else blocked_answer(data, query_data, source)
+        if response is not None:
+            self.log_executor.submit(
+                report_exchange,
+                data,
+                response,
+                query_data,
+                None,
+                source,
+                client_ip,
+                log=False,
+            )
+            observe("total", source, time.perf_counter() - start)
+            return response
+        try:
+            response = await resolve_async(data, use_tcp=(source == "TCP"))
+        except Exception as e:
+            error = error or e
+        self.log_executor.submit(
+            report_exchange, data, response, query_data, error, source, client_ip
+        )
+        observe("total", source, time.perf_counter() - start)
+        return response
+
+    async def answer_udp(self, transport, data, addr):
+        try:
+            response = await self.handle_dns_request(data, addr[0], "UDP")
+            if response is not None:
+                transport.sendto(response, addr)
+        finally:
+            self.inflight -= 1
+
+    async def handle_tcp_client(self, reader, writer):
+        """
+        Serves a client TCP connection (RFC 7766): pipelined queries are answered
+        out of order until the client closes or stays idle for TCP_IDLE_TIMEOUT.
+        """
+        client_ip = writer.get_extra_info("peername")[0]
+        pipeline = asyncio.Semaphore(TCP_MAX_PIPELINE)
+        pending = set()
+
+        async def answer(data):
+            try:
+                response = await self.handle_dns_request(data, client_ip, "TCP")
+                if response is not None and not writer.is_closing():
+                    writer.write(len(response).to_bytes(2, byteorder="big") + response)
+                    await writer.drain()
+            except ConnectionError as e:
+                print(f"TCP client exception : {e}")
+            finally:
+                pipeline.release()
+
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(
+                        reader.readexactly(2), TCP_IDLE_TIMEOUT
+                    )
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break  # connexion inactive ou fermée par le client entre deux messages
+                data = await reader.readexactly(int.from_bytes(header, byteorder="big"))
+                capture_query(data, client_ip, "TCP")
+                if over_rate_limit(client_ip, "TCP"):
+                    response = rate_limiter.response(data, use_tcp=True)
+                    if response is not None:
+                        writer.write(
+                            len(response).to_bytes(2, byteorder="big") + response
+                        )
+                    continue
+                await pipeline.acquire()
+                task = self.spawn(answer(data))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            print(f"TCP client exception : {e}")
+        finally:
+            if pending:
+                await asyncio.wait(pending)
+            writer.close()
+
+    async def serve(self, host=None, port=None):
+        host = host or LISTEN_HOST
+        port = port or LISTEN_PORT
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(
+            lambda: ProxyDatagramProtocol(self),
+            local_addr=(host, port),
+            reuse_port=REUSE_PORT or None,
+        )
+        print(f"DNS Proxy (asyncio) listening on UDP {host}:{port}")
+        server = await asyncio.start_server(
+            self.handle_tcp_client,
+            host,
+            port,
+            reuse_address=True,
+            reuse_port=REUSE_PORT or None,
+        )
+        print(f"DNS Proxy (asyncio) listening on TCP {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+class ProxyDatagramProtocol(asyncio.DatagramProtocol):
+    """Receives client datagrams and hands them to the asyncio engine."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        engine = self.engine
+        capture_query(data, addr[0], "UDP")
+        if over_rate_limit(addr[0], "UDP"):
+            response = rate_limiter.response(data)
+            if response is not None:
+                self.transport.sendto(response, addr)
+            return
+        # Au-delà de MAX_INFLIGHT on ignore le datagramme : le client retentera.
+        if engine.inflight >= engine.max_inflight:
+            engine.dropped += 1
+            return
+        engine.inflight += 1
+        engine.spawn(engine.answer_udp(self.transport, data, addr))
+
+
+def cache_metrics():
+    if response_cache is None:
+        return {}
+    return {(("event", name),): value for name, value in response_cache.stats().items()}
+
+
+def upstream_metrics():
+    if _upstreams is None:
+        return {}
+    values = {}
+    for upstream in _upstreams.upstreams:
+        server = ("server", upstream.name)
+        for name, value in upstream.stats().items():
+            values[(("event", name), server)] = value
+        for transport, pool in (("UDP", upstream.udp), ("TCP", upstream.tcp)):
+            if pool is None:
+                continue
+            labels = (server, ("transport", transport))
+            values[(("event", "pending"),) + labels] = len(pool.pending)
+            values[(("event", "timeouts"),) + labels] = pool.timeouts
+            values[(("event", "retransmissions"),) + labels] = pool.retransmissions
+        if upstream.udp is not None:
+            values[(("event", "socket_renewals"), server, ("transport", "UDP"))] = (
+                upstream.udp.renewals
+            )
+        if upstream.tcp is not None:
+            values[(("event", "connects"), server, ("transport", "TCP"))] = (
+                upstream.tcp.connects
+            )
+    return values
+
+
+register(
+    "dns_proxy_singleflight",
+    "Upstream queries sent, and saved by coalescing identical in-flight questions.",
+    lambda: {
+        (("event", "upstream_queries"),): singleflight.upstream_queries,
+        (("event", "saved"),): singleflight.saved,
+        (("event", "inflight"),): len(singleflight.calls),
+    },
+)
+register(
+    "dns_proxy_rate_limiter",
+    "Per-client rate limiter tracked clients and decisions.",
+    lambda: (
+        {}
+        if rate_limiter is None
+        else {(("event", name),): value for name, value in rate_limiter.stats().items()}
+    ),
+)
+register(
+    "dns_proxy_cache",
+    "Response cache entries and hit/miss/eviction counters.",
+    cache_metrics,
+)
+register(
+    "dns_proxy_blocklist",
+    "Blocklist size, lookups, blocked queries and reloads.",
+    lambda: (
+        {}
+        if blocklist is None
+        else {(("event", name),): value for name, value in blocklist.stats().items()}
+    ),
+)
+register(
+    "dns_proxy_upstream",
+    "Per upstream RTT, failure rate, circuit state, hedged queries and pool counters.",
+    upstream_metrics,
+)
+
+
+def start_metrics(offset=0):
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT + offset)
+
+
+def main_asyncio():
+    asyncio.run(AsyncProxyEngine().serve())
+
+
 def main():
-    udp_thread = threading.Thread(target=start_udp_server)
-    tcp_thread = threading.Thread(target=start_tcp_server)
+    # Threads démons : SIGTERM termine le processus sans attendre ces boucles sans fin
+    udp_thread = threading.Thread(target=start_udp_server, daemon=True)
+    tcp_thread = threading.Thread(target=start_tcp_server, daemon=True)
     udp_thread.start()
     tcp_thread.start()
     udp_thread.join()
     tcp_thread.join()
 
 
+def start_cache(suffix=""):
+    """Cache snapshots (--cache-snapshot, one file per process with --workers) and prefetch."""
+    if response_cache is None:
+        return
+    if CACHE_SNAPSHOT:
+        response_cache.start_snapshots(CACHE_SNAPSHOT + suffix)
+    response_cache.start_prefetch(refresh_cache_entry)
+
+
+def start_blocklist(alerts=True):
+    """Blocklist hot reload, and auto-blocking of detected domains in the process that raises alerts."""
+    if blocklist is None:
+        return
+    blocklist.start_reload()
+    if alerts and BLOCKLIST_AUTO:
+        set_alert_handler(block_detected_domain)
+
+
+def start_spool(name=None):
+    """Spool disque des logs (--log-spool), un sous-répertoire par processus en mode --workers."""
+    if SPOOL_DIR:
+        enable_spool(os.path.join(SPOOL_DIR, name) if name else SPOOL_DIR)
+
+
+def start_capture(suffix=""):
+    """Enregistrement des requêtes brutes (--capture), un jeu de fichiers par processus en mode --workers."""
+    global query_capture
+    if not QUERY_CAPTURE:
+        return
+    query_capture = create_query_capture(QUERY_CAPTURE + suffix)
+    register(
+        "dns_proxy_query_capture",
+        "Query capture queue depth, queries and bytes written, file rotations, write errors and dropped queries.",
+        lambda: {
+            (("event", name),): value for name, value in query_capture.stats().items()
+        },
+    )
+
+
+def apply_aggregator_alert(domain):
+    """Alert raised by the aggregator from the merged view of all workers (--workers mode)."""
+    mark_suspicious(domain)
+    if blocklist is not None and BLOCKLIST_AUTO:
+        # Bloqué aussi par l'agrégateur, qui seul réécrit BLOCKLIST_AUTO_FILE
+        blocklist.add(domain, persist=False)
+
+
+def exit_on_sigterm():
+    """docker stop and Process.terminate() send SIGTERM: exit normally so that logs, cache snapshot and capture are flushed."""
+
+    def stop(signum, frame):
+        # Un seul arrêt, même si le signal est renvoyé pendant les vidages
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+
+def run_worker(index, aggregation_queue, alert_queue, serve):
+    exit_on_sigterm()
+    try:
+        start_metrics(index)
+        start_spool(f"worker-{index}")
+        start_cache(f".{index}")
+        start_capture(f".{index}")
+        start_blocklist(alerts=False)
+        # Chaque worker envoie ses compteurs de détection à l'agrégateur au lieu d'alerter seul.
+        enable_aggregation(aggregation_queue)
+        receive_alerts(alert_queue, apply_aggregator_alert)
+        serve()
+    finally:
+        # Un processus forké sort par os._exit(), qui saute les fonctions atexit
+        atexit._run_exitfuncs()
+
+
+def run_detection_aggregator(aggregation_queue, alert_queues):
+    exit_on_sigterm()
+    try:
+        start_spool("aggregator")
+        start_blocklist()
+        # Les alertes repartent vers les workers (blocage automatique, log complet en mode rollup)
+        broadcast_alerts(alert_queues)
+        run_aggregator(aggregation_queue)
+    finally:
+        atexit._run_exitfuncs()
+
+
+def main_workers(count, serve):
+    """
+    Forks `count` worker processes that all bind the listening port with SO_REUSEPORT,
+    plus one aggregator process that merges their detection counters.
+    """
+    global REUSE_PORT
+    REUSE_PORT = True
+    context = multiprocessing.get_context("fork")
+    aggregation_queue = context.Queue(maxsize=AGGREGATION_QUEUE_SIZE)
+    # Une file par worker, gardée quand le worker redémarre
+    alert_queues = [context.Queue(maxsize=ALERT_QUEUE_SIZE) for _ in range(count)]
+
+    aggregator = context.Process(
+        target=run_detection_aggregator,
+        args=(aggregation_queue, alert_queues),
+        name="detect-aggregator",
+        daemon=True,
+    )
+    aggregator.start()
+
+    def start_worker(index):
+        worker = context.Process(
+            target=run_worker,
+            args=(index, aggregation_queue, alert_queues[index], serve),
+            name=f"proxy-worker-{index}",
+            daemon=True,
+        )
+        worker.start()
+        return worker
+
+    # docker stop envoie SIGTERM : on arrête proprement les workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = [start_worker(index) for index in range(count)]
+    print(f"DNS Proxy started {count} workers")
+    try:
+        while True:
+            multiprocessing.connection.wait(
+                [worker.sentinel for worker in workers] + [aggregator.sentinel]
+            )
+            if not aggregator.is_alive():
+                raise RuntimeError("Detection aggregator exited")
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    print(
+                        f"Worker {worker.name} exited with code {worker.exitcode}, restarting"
+                    )
+                    workers[index] = start_worker(index)
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for process in workers + [aggregator]:
+            process.terminate()
+        for process in workers + [aggregator]:
+            process.join(timeout=5)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DNS proxy")
+    parser.add_argument(
+        "--host", default=os.getenv("PROXY_HOST", LISTEN_HOST), help="listening address"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=int(os.getenv("PROXY_PORT", LISTEN_PORT)),
+        help="listening port (UDP and TCP)",
+    )
+    parser.add_argument(
+        "--upstream",
+        default=os.getenv("PROXY_UPSTREAM", f"{DNS_SERVER}:{DNS_PORT}"),
+        help="comma-separated upstream resolvers, HOST[:PORT] or [IPV6]:PORT",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["threads", "asyncio"],
+        default=os.getenv("PROXY_ENGINE", "threads"),
+        help="serving engine: one thread per request (default) or asyncio",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=int(os.getenv("PROXY_CACHE_SIZE", str(CACHE_SIZE))),
+        help="maximum number of cached responses, 0 disables the cache",
+    )
+    parser.add_argument(
+        "--cache-snapshot",
+        default=CACHE_SNAPSHOT,
+        help="file where the cache is saved periodically and reloaded at startup (default from CACHE_SNAPSHOT, empty: none)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("PROXY_WORKERS", "0")),
+        help="number of worker processes sharing the port with SO_REUSEPORT (0: single process)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=RATE_LIMIT_QPS,
+        help="queries per second allowed per client (0: no limit, default from RATE_LIMIT_QPS)",
+    )
+    parser.add_argument(
+        "--rate-limit-action",
+        choices=RATE_LIMIT_ACTIONS,
+        default=RATE_LIMIT_ACTION,
+        help="what to do with queries over the limit: drop, refused, or truncate (TC=1, retry over TCP)",
+    )
+    parser.add_argument(
+        "--blocklist",
+        default=BLOCKLIST_FILE,
+        help="file of blocked domains, one per line or in hosts format (default from BLOCKLIST_FILE)",
+    )
+    parser.add_argument(
+        "--blocklist-action",
+        choices=BLOCKLIST_ACTIONS,
+        default=BLOCKLIST_ACTION,
+        help="answer for blocked names: nxdomain, refused, or sinkhole (A/AAAA to BLOCKLIST_SINKHOLE_V4/V6)",
+    )
+    parser.add_argument(
+        "--metrics",
+        default=os.getenv("PROXY_METRICS", f"{METRICS_HOST}:{METRICS_PORT}"),
+        help="Prometheus /metrics endpoint, HOST[:PORT] (port 0 disables; worker N listens on PORT+N)",
+    )
+    parser.add_argument(
+        "--log-mode",
+        choices=LOG_MODES,
+        default=LOG_MODE,
+        help="full: two Elasticsearch documents per query; rollup: per-minute counters plus sampled full documents",
+    )
+    parser.add_argument(
+        "--log-spool",
+        default=SPOOL_DIR,
+        help="directory of the disk spool for log documents while Elasticsearch is unavailable (default from LOG_SPOOL_DIR, empty: no spool)",
+    )
+    parser.add_argument(
+        "--capture",
+        default=QUERY_CAPTURE,
+        help="record raw queries to rotating binary files FILE.000001... for benchmarks.replay_capture (default from QUERY_CAPTURE, empty: none)",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    LISTEN_HOST, LISTEN_PORT = args.host, args.port
+    UPSTREAMS = [
+        parse_address(value.strip(), DNS_PORT)
+        for value in args.upstream.split(",")
+        if value.strip()
+    ]
+    DNS_SERVER, DNS_PORT = UPSTREAMS[0]
+    METRICS_HOST, METRICS_PORT = parse_address(args.metrics, METRICS_PORT)
+    response_cache = DNSCache(args.cache_size) if args.cache_size > 0 else None
+    rate_limiter = create_rate_limiter(args.rate_limit, args.rate_limit_action)
+    blocklist = create_blocklist(args.blocklist, args.blocklist_action)
+    SPOOL_DIR = args.log_spool
+    CACHE_SNAPSHOT = args.cache_snapshot
+    QUERY_CAPTURE = args.capture
+    set_log_mode(args.log_mode)
+    serve = main_asyncio if args.engine == "asyncio" else main
+    if args.workers > 0:
+        main_workers(args.workers, serve)
+    else:
+        exit_on_sigterm()
+        start_metrics()
+        start_spool()
+        start_cache()
+        start_capture()
+        start_blocklist()
+        serve()
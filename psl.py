@@ -0,0 +1,125 @@
+"""
+Extraction du domaine enregistrable à partir de la Public Suffix List (PSL).
+
+La liste est compilée une seule fois au démarrage en un trie de labels
+inversés (com -> example -> ...). Les noms les plus fréquents sont servis par
+un cache LRU, la recherche dans le trie ne coûte que quelques accès dict.
+"""
+
+import importlib.util
+import os
+from functools import lru_cache
+
+PSL_CACHE_SIZE = int(os.getenv("PSL_CACHE_SIZE", "65536"))
+SYSTEM_PSL_FILE = "/usr/share/publicsuffix/public_suffix_list.dat"
+
+TERMINAL = "$"  # marque la fin d'une règle
+EXCEPTION = "!"  # règle d'exception (!www.ck)
+WILDCARD = "*"
+
+
+def default_psl_file():
+    """Fichier PSL local : PSL_FILE, celui fourni par le paquet publicsuffixlist, ou celui du système."""
+    path = os.getenv("PSL_FILE")
+    if path:
+        return path
+    spec = importlib.util.find_spec("publicsuffixlist")
+    if spec is not None and spec.origin:
+        bundled = os.path.join(os.path.dirname(spec.origin), "public_suffix_list.dat")
+        if os.path.exists(bundled):
+            return bundled
+    if os.path.exists(SYSTEM_PSL_FILE):
+        return SYSTEM_PSL_FILE
+    return None
+
+
+def to_ascii(label):
+    # Les requêtes arrivent en punycode (xn--...), la liste contient des règles Unicode
+    try:
+        return label.encode("idna").decode("ascii")
+    except UnicodeError:
+        return label
+
+
+class PublicSuffixTrie:
+    """Trie de labels inversés compilé depuis la PSL."""
+
+    def __init__(self, rules=()):
+        self.root = {}
+        self.rules = 0
+        for rule in rules:
+            self.add_rule(rule)
+
+    @classmethod
+    def from_file(cls, path):
+        trie = cls()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("//"):
+                    continue
+                trie.add_rule(line.split()[0])
+        return trie
+
+    def add_rule(self, rule):
+        exception = rule.startswith(EXCEPTION)
+        if exception:
+            rule = rule[1:]
+        node = self.root
+        for label in reversed(rule.lower().split(".")):
+            if label != WILDCARD:
+                label = to_ascii(label)
+            node = node.setdefault(label, {})
+        node[EXCEPTION if exception else TERMINAL] = True
+        self.rules += 1
+
+    def suffix_length(self, labels):
+        """Nombre de labels du suffixe public pour une liste de labels dans l'ordre du nom."""
+        node = self.root
+        length = 1  # règle par défaut "*" : le TLD est un suffixe public
+        depth = 0
+        for label in reversed(labels):
+            child = node.get(label)
+            wildcard = node.get(WILDCARD)
+            depth += 1
+            if child is not None and EXCEPTION in child:
+                # Exception : le suffixe s'arrête au label précédent
+                return depth - 1
+            if wildcard is not None and TERMINAL in wildcard:
+                length = depth
+            if child is None:
+                break
+            if TERMINAL in child:
+                length = depth
+            node = child
+        return length
+
+    def registrable_domain(self, domain):
+        """Suffixe public + un label (ex. bbc.co.uk), ou le domaine lui-même s'il est un suffixe public."""
+        labels = domain.lower().rstrip(".").split(".")
+        length = self.suffix_length(labels)
+        if len(labels) <= length:
+            return ".".join(labels)
+        return ".".join(labels[-(length + 1) :])
+
+
+def load_default_trie():
+    path = default_psl_file()
+    if path is None:
+        print(
+            "[INFO] Public Suffix List introuvable : domaine parent = deux derniers labels"
+        )
+        return None
+    return PublicSuffixTrie.from_file(path)
+
+
+suffix_trie = load_default_trie()
+
+
+@lru_cache(maxsize=PSL_CACHE_SIZE)
+def registrable_domain(domain):
+    """Domaine enregistrable d'un nom, avec cache LRU pour les noms fréquents."""
+    if suffix_trie is None:
+        parts = domain.split(".")
+        return ".".join(parts[-2:])
+    return suffix_trie.registrable_domain(domain)
@@ -0,0 +1,146 @@
+"""
+Limitation du débit par client, appliquée avant tout traitement de la requête.
+
+Chaque client (adresse IP, ou préfixe /24 en IPv4 et /56 en IPv6 si configuré)
+a un seau à jetons de RATE_LIMIT_QPS jetons par seconde et de capacité
+RATE_LIMIT_BURST. Le seau est stocké sous forme GCRA : un seul flottant par
+client (l'heure théorique d'arrivée de la prochaine requête), dans un
+OrderedDict borné à RATE_LIMIT_MAX_CLIENTS entrées avec éviction LRU. Une
+inondation depuis des adresses usurpées ne fait donc qu'évincer les clients
+les plus anciens.
+
+Actions possibles au-delà de la limite :
+  - drop : la requête est ignorée
+  - refused : réponse REFUSED
+  - truncate : réponse vide avec TC=1, le client doit réessayer en TCP ; les
+    requêtes TCP ne sont alors pas limitées, la poignée de main TCP prouvant
+    l'adresse source
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from decoder import DNSMessage
+
+RATE_LIMIT_QPS = float(os.getenv("RATE_LIMIT_QPS", "0"))  # 0 = pas de limite
+RATE_LIMIT_BURST = float(
+    os.getenv("RATE_LIMIT_BURST", "0")
+)  # 0 = deux secondes de débit
+RATE_LIMIT_ACTION = os.getenv("RATE_LIMIT_ACTION", "drop")
+RATE_LIMIT_PREFIX_V4 = int(
+    os.getenv("RATE_LIMIT_PREFIX_V4", "32")
+)  # 24 : un seau par /24
+RATE_LIMIT_PREFIX_V6 = int(
+    os.getenv("RATE_LIMIT_PREFIX_V6", "128")
+)  # 56 : un seau par /56
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000"))
+
+ACTIONS = ("drop", "refused", "truncate")
+RCODE_REFUSED = 5
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+
+
+def client_key(address, prefix_v4=32, prefix_v6=128):
+    """Entier identifiant le client ou son préfixe (les clés IPv6 sont décalées au-delà de 2**128)."""
+    if ":" in address:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big")
+        return (1 << 128) | (value >> (128 - prefix_v6))
+    value = int.from_bytes(socket.inet_aton(address), "big")
+    return value >> (32 - prefix_v4)
+
+
+def limited_response(data, action, use_tcp=False):
+    """Réponse à envoyer à un client limité, ou None s'il faut ignorer la requête."""
+    if action == "drop":
+        return None
+    try:
+        message = DNSMessage(data)
+        if message.qd_count != 1:
+            return None
+        question = bytes(data[12 : message.question_end])
+    except (IndexError, ValueError, struct.error):
+        return None
+    flags = FLAG_QR | (message.flags & 0x7900)  # opcode et RD recopiés
+    if action == "truncate" and not use_tcp:
+        flags |= FLAG_TC
+    else:
+        flags |= RCODE_REFUSED
+    return struct.pack("!6H", message.id, flags, 1, 0, 0, 0) + question
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        qps=RATE_LIMIT_QPS,
+        burst=RATE_LIMIT_BURST,
+        action=RATE_LIMIT_ACTION,
+        prefix_v4=RATE_LIMIT_PREFIX_V4,
+        prefix_v6=RATE_LIMIT_PREFIX_V6,
+        max_clients=RATE_LIMIT_MAX_CLIENTS,
+    ):
+        if action not in ACTIONS:
+            raise ValueError(
+                f"Unknown rate limit action {action!r}, expected one of {', '.join(ACTIONS)}"
+            )
+        self.interval = 1.0 / qps  # temps d'émission d'un jeton
+        self.tolerance = max(burst or 2 * qps, 1.0) * self.interval
+        self.action = action
+        self.prefix_v4 = prefix_v4
+        self.prefix_v6 = prefix_v6
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = (
+            OrderedDict()
+        )  # clé client -> heure théorique d'arrivée (monotonic)
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+
+    def allow(self, address, now=None):
+        """Consomme un jeton pour ce client ; False s'il a dépassé son débit."""
+        try:
+            key = client_key(address, self.prefix_v4, self.prefix_v6)
+        except (OSError, ValueError):
+            return True
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            arrival = self.buckets.get(key)
+            arrival = now if arrival is None or arrival < now else arrival
+            if arrival + self.interval - now > self.tolerance:
+                self.buckets.move_to_end(key)
+                self.limited += 1
+                return False
+            self.buckets[key] = arrival + self.interval
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+                self.evictions += 1
+            self.allowed += 1
+            return True
+
+    def applies_to(self, use_tcp):
+        return not (use_tcp and self.action == "truncate")
+
+    def response(self, data, use_tcp=False):
+        return limited_response(data, self.action, use_tcp)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "clients": len(self.buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+                "evictions": self.evictions,
+            }
+
+
+def create_rate_limiter(qps=RATE_LIMIT_QPS, action=RATE_LIMIT_ACTION):
+    """RateLimiter configuré par l'environnement, ou None si qps vaut 0."""
+    if qps <= 0:
+        return None
+    return RateLimiter(qps=qps, action=action)
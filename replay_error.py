@@ -1,51 +1,344 @@
-from elasticsearch import Elasticsearch
-import os
+"""
+Rejoue les requêtes DNS enregistrées dans l'index proxy_errors.
+
+Avec des identifiants, chaque requête est renvoyée à l'amont et la réponse
+affichée (mode utilisé par ssh_replay.py) :
+
+    python3 replay_error.py <ID_ERREUR> [<ID_ERREUR>...]
+
+Sans identifiant, les erreurs qui correspondent aux filtres sont lues page par
+page (API scroll) et rejouées en parallèle vers --upstream, au plus
+--concurrency requêtes à la fois. Les réponses sont décodées avec decoder.py et
+un résumé JSON regroupe les résultats par message d'erreur :
+
+    python3 replay_error.py --since now-1h --error "Expected 1 question" \\
+        --upstream 127.0.0.1:5353 --concurrency 200 --summary replay.json
+
+query_data_raw contient la requête en base64 (query_data_encoding: base64) ;
+les documents plus anciens contiennent le repr() Python des octets.
+"""
+
+import argparse
 import ast
-from proxy import forward_to_resolver
+import base64
+import binascii
+import json
+import os
+import sys
+import threading
+import time
+
+from elasticsearch import Elasticsearch
+
+from decoder import decode_dns_query, decode_dns_response, parse_dns_message
+from upstream import UpstreamSet, parse_address
+
+ES_HOST = os.getenv("ES_HOST", "http://elasticsearch:9200/")
+ERRORS_INDEX = "proxy_errors"
+DEFAULT_UPSTREAM = os.getenv("REPLAY_UPSTREAM", "8.8.8.8")
+DEFAULT_PORT = 53
+DEFAULT_CONCURRENCY = 100
+PAGE_SIZE = 1000
+SCROLL_TIMEOUT = "2m"
+EXAMPLES = 3  # identifiants gardés par résultat dans le résumé
+
+RCODE_NAMES = {
+    0: "NOERROR",
+    1: "FORMERR",
+    2: "SERVFAIL",
+    3: "NXDOMAIN",
+    4: "NOTIMP",
+    5: "REFUSED",
+}
+
+
+def es_client(host=ES_HOST):
+    """Client Elasticsearch configuré comme celui de logger.py."""
+    if os.getenv("ENVIRONMENT", "dev") == "dev":
+        return Elasticsearch([host])
+    username = os.getenv("ES_USERNAME", "default_user")
+    password = os.getenv("ES_PASSWORD", "default_password")
+    return Elasticsearch([host], basic_auth=(username, password))
+
+
+def raw_query(document):
+    """Octets de la requête enregistrée ; ValueError si le champ est absent ou illisible."""
+    value = document.get("query_data_raw")
+    if not isinstance(value, str) or not value:
+        raise ValueError("missing query_data_raw")
+    if document.get("query_data_encoding") == "base64":
+        try:
+            return base64.b64decode(value, validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"invalid base64 query_data_raw: {e}") from e
+    # Ancien format : repr() des octets (b'...'), relu avec literal_eval
+    if not value.startswith(("b'", 'b"', "bytearray(b")):
+        raise ValueError(f"query_data_raw is not a query: {value[:40]}")
+    if value.startswith("bytearray("):
+        value = value[len("bytearray(") : -1]
+    try:
+        data = ast.literal_eval(value)
+    except (ValueError, SyntaxError) as e:
+        raise ValueError(f"invalid query_data_raw: {e}") from e
+    if not isinstance(data, bytes):
+        raise ValueError("query_data_raw is not a query")
+    return data
+
+
+def error_filter(since=None, until=None, error=None, transport=None, query=None):
+    """Requête Elasticsearch sélectionnant les erreurs à rejouer."""
+    filters = []
+    if since or until:
+        bounds = {}
+        if since:
+            bounds["gte"] = since
+        if until:
+            bounds["lt"] = until
+        filters.append({"range": {"timestamp": bounds}})
+    if error:
+        filters.append({"match_phrase": {"error_message": error}})
+    if transport:
+        filters.append({"term": {"type": transport}})
+    if query:
+        filters.append({"query_string": {"query": query}})
+    if not filters:
+        return {"match_all": {}}
+    return {"bool": {"filter": filters}}
+
+
+def stream_errors(client, query, page_size=PAGE_SIZE, limit=None):
+    """Parcourt les documents proxy_errors correspondant à query : (id, document)."""
+    response = client.search(
+        index=ERRORS_INDEX,
+        query=query,
+        size=page_size,
+        scroll=SCROLL_TIMEOUT,
+        sort=["_doc"],
+    )
+    scroll_id = response.get("_scroll_id")
+    count = 0
+    try:
+        while True:
+            hits = response["hits"]["hits"]
+            if not hits:
+                return
+            for hit in hits:
+                yield hit["_id"], hit["_source"]
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            if scroll_id is None:
+                return
+            response = client.scroll(scroll_id=scroll_id, scroll=SCROLL_TIMEOUT)
+            scroll_id = response.get("_scroll_id", scroll_id)
+    finally:
+        if scroll_id is not None:
+            try:
+                client.clear_scroll(scroll_id=scroll_id)
+            except Exception:
+                pass
+
 
-def replay_error(error_id, es_host="http://localhost:9200/"):
+def classify(data, response):
+    """Résultat d'un rejeu : rcode de la réponse, ou erreur de décodage comme dans logger.py."""
+    try:
+        _transaction_id, index, query_data, _error = decode_dns_query(data)
+        message = parse_dns_message(response)
+        rcode = RCODE_NAMES.get(message.rcode, f"RCODE{message.rcode}")
+        if message.an_count == 0:
+            return f"{rcode} (no answer)"
+        decode_dns_response(message, index, query_data)
+        return rcode
+    except Exception as e:
+        return f"decode error: {e}"
+
+
+class ReplaySummary:
+    """Résultats regroupés par message d'erreur d'origine."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.replayed = 0
+        self.skipped = 0
+
+    def add(self, error_message, outcome, error_id):
+        with self.lock:
+            group = self.groups.setdefault(error_message, {"count": 0, "outcomes": {}})
+            group["count"] += 1
+            entry = group["outcomes"].setdefault(outcome, {"count": 0, "examples": []})
+            entry["count"] += 1
+            if len(entry["examples"]) < EXAMPLES:
+                entry["examples"].append(error_id)
+            if outcome.startswith("invalid query"):
+                self.skipped += 1
+            else:
+                self.replayed += 1
+
+    def report(self, elapsed):
+        with self.lock:
+            groups = sorted(
+                self.groups.items(), key=lambda item: item[1]["count"], reverse=True
+            )
+            return {
+                "replayed": self.replayed,
+                "skipped": self.skipped,
+                "elapsed_s": round(elapsed, 2),
+                "qps": round(self.replayed / elapsed, 1) if elapsed else 0,
+                "errors": [
+                    {
+                        "error_message": message,
+                        "count": group["count"],
+                        "outcomes": dict(
+                            sorted(
+                                group["outcomes"].items(),
+                                key=lambda item: -item[1]["count"],
+                            )
+                        ),
+                    }
+                    for message, group in groups
+                ],
+            }
+
+
+def replay_all(documents, upstreams, concurrency=DEFAULT_CONCURRENCY, use_tcp=None):
     """
-    Rejoue une requête DNS depuis les erreurs enregistrées dans Elasticsearch.
-    :param error_id: ID de l'erreur à rejouer.
-    :param es_host: Adresse du serveur Elasticsearch.
+    Rejoue les (id, document) en parallèle, au plus concurrency à la fois.
+    use_tcp=None reprend le transport enregistré dans le champ type.
     """
-    ES_HOST = "http://elasticsearch:9200/"
+    summary = ReplaySummary()
+    slots = threading.BoundedSemaphore(concurrency)
+    start = time.monotonic()
+    for error_id, document in documents:
+        error_message = document.get("error_message", "")
+        try:
+            data = raw_query(document)
+        except ValueError as e:
+            summary.add(error_message, f"invalid query: {e}", error_id)
+            continue
+        tcp = (
+            use_tcp
+            if use_tcp is not None
+            else str(document.get("type", "")).startswith("TCP")
+        )
+        slots.acquire()
+        try:
+            future = upstreams.submit(data, use_tcp=tcp)
+        except Exception as e:
+            slots.release()
+            summary.add(error_message, f"upstream error: {e}", error_id)
+            continue
 
-    ENVIRONMENT = os.getenv("ENVIRONMENT", "dev")
+        def done(future, data=data, error_message=error_message, error_id=error_id):
+            try:
+                outcome = classify(data, future.result())
+            except Exception as e:
+                outcome = f"upstream error: {type(e).__name__}"
+            summary.add(error_message, outcome, error_id)
+            slots.release()
 
-    if ENVIRONMENT == "dev":
-        ES_HOST = "http://elasticsearch:9200/"
-        es = Elasticsearch([ES_HOST])
-    else:
-        ES_HOST = "http://elasticsearch:9200/"
-        ES_USERNAME = os.getenv("ES_USERNAME", "default_user")
-        ES_PASSWORD = os.getenv("ES_PASSWORD", "default_password")
-    es = Elasticsearch([ES_HOST], basic_auth=(ES_USERNAME, ES_PASSWORD))
+        future.add_done_callback(done)
+    # Attend les dernières réponses
+    for _ in range(concurrency):
+        slots.acquire()
+    return summary.report(time.monotonic() - start)
 
+
+def replay_error(error_id, client=None, upstreams=None):
+    """
+    Rejoue une requête DNS depuis les erreurs enregistrées dans Elasticsearch.
+    :param error_id: ID de l'erreur à rejouer.
+    :param client: Client Elasticsearch (par défaut ES_HOST).
+    :param upstreams: Résolveurs amont (par défaut DEFAULT_UPSTREAM).
+    """
+    client = client or es_client()
+    upstreams = upstreams or UpstreamSet(
+        [parse_address(DEFAULT_UPSTREAM, DEFAULT_PORT)]
+    )
     try:
         # Récupérer l'erreur par son ID
-        error = es.get(index="proxy_errors", id=error_id)["_source"]
-        query_data_raw = error.get("query_data_raw")
-        # Débogage : vérifier le type de query_data_raw
-
-        print(type(query_data_raw))
-        print(query_data_raw)
-        query_data = ast.literal_eval(query_data_raw)
-        print(type(query_data))
-        print(query_data)
-        
-
-        # Rejouer la requête en utilisant forward_to_resolver
-        response = forward_to_resolver(query_data, use_tcp=False)
+        error = client.get(index=ERRORS_INDEX, id=error_id)["_source"]
+        data = raw_query(error)
+        print(f"Erreur : {error.get('error_message')}")
+        print(f"Requête : {data}")
+        response = upstreams.query(
+            data, use_tcp=str(error.get("type", "")).startswith("TCP")
+        )
         print(f"Réponse reçue : {response}")
+        print(f"Résultat : {classify(data, response)}")
         return response
     except Exception as e:
         print(f"Erreur lors du rejouage : {e}")
+        return None
 
-# Exécuter depuis la ligne de commande
-if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 2:
-        print("Usage : python replay.py <ID_ERREUR>")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "ids", nargs="*", help="identifiants d'erreurs à rejouer un par un"
+    )
+    parser.add_argument("--es-host", default=ES_HOST)
+    parser.add_argument(
+        "--since", help="début de la période (date ou expression, ex. now-1h)"
+    )
+    parser.add_argument("--until", help="fin de la période")
+    parser.add_argument("--error", help="texte du message d'erreur (match_phrase)")
+    parser.add_argument("--transport", help="valeur du champ type (UDP, TCP...)")
+    parser.add_argument("--query", help="filtre supplémentaire en syntaxe query_string")
+    parser.add_argument("--limit", type=int, help="nombre maximal d'erreurs rejouées")
+    parser.add_argument(
+        "--upstream",
+        default=DEFAULT_UPSTREAM,
+        help=f"résolveurs amont HOST[:PORT] ou [IPV6]:PORT, séparés par des virgules (défaut {DEFAULT_UPSTREAM})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="requêtes en vol au maximum",
+    )
+    parser.add_argument(
+        "--tcp",
+        action="store_true",
+        help="rejoue tout en TCP (défaut : transport enregistré)",
+    )
+    parser.add_argument(
+        "--summary", help="fichier du résumé JSON (défaut : sortie standard)"
+    )
+    args = parser.parse_args()
+
+    client = es_client(args.es_host)
+    upstreams = UpstreamSet(
+        [
+            parse_address(value, DEFAULT_PORT)
+            for value in args.upstream.split(",")
+            if value.strip()
+        ]
+    )
+    if args.ids:
+        for error_id in args.ids:
+            replay_error(error_id, client, upstreams)
+        return
+
+    query = error_filter(args.since, args.until, args.error, args.transport, args.query)
+    report = replay_all(
+        stream_errors(client, query, limit=args.limit),
+        upstreams,
+        args.concurrency,
+        use_tcp=True if args.tcp else None,
+    )
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
     else:
-        replay_error(sys.argv[1])
\ No newline at end of file
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    print(
+        f"{report['replayed']} errors replayed in {report['elapsed_s']}s ({report['qps']} qps), "
+        f"{report['skipped']} skipped",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Esquisses probabilistes pour detect.py : cardinalité (HyperLogLog) et
+éléments les plus fréquents (Space-Saving).
+
+Un HyperLogLog compte les éléments distincts avec une mémoire fixe de 2^p
+registres d'un octet, pour une erreur relative typique de 1.04 / sqrt(2^p).
+Tant que peu d'éléments ont été vus, on garde un petit ensemble exact (mode
+creux), converti en registres dès qu'il dépasserait leur taille : les petits
+domaines restent exacts et la mémoire par domaine reste bornée.
+
+Space-Saving suit au plus `capacity` éléments : un nouvel élément remplace le
+moins fréquent et hérite de son compteur, noté comme erreur maximale. Tout
+élément de fréquence supérieure à N / capacity est garanti d'être suivi.
+"""
+
+import hashlib
+import heapq
+import math
+
+DEFAULT_ERROR = 0.04  # erreur relative typique visée
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+HASH_BITS = 64
+
+
+def precision_for_error(error):
+    """Nombre de bits d'index p tel que 1.04 / sqrt(2^p) <= error."""
+    precision = math.ceil(math.log2((1.04 / error) ** 2))
+    return min(MAX_PRECISION, max(MIN_PRECISION, precision))
+
+
+def hash64(item):
+    """Hash stable entre processus (contrairement à hash()), nécessaire pour fusionner des esquisses."""
+    if isinstance(item, str):
+        item = item.encode("utf-8", errors="replace")
+    return int.from_bytes(hashlib.blake2b(item, digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """Compteur d'éléments distincts, interface compatible avec set pour add() et len()."""
+
+    __slots__ = ("precision", "sparse", "registers", "scaled_sum", "zeros")
+
+    def __init__(self, error=DEFAULT_ERROR, precision=None):
+        self.precision = precision or precision_for_error(error)
+        self.sparse = set()  # hashes vus tant que l'esquisse est petite
+        self.registers = None
+        self.scaled_sum = 0  # somme exacte des 2^(HASH_BITS - registre)
+        self.zeros = 0  # registres encore à zéro
+
+    @property
+    def size(self):
+        return 1 << self.precision
+
+    def _sparse_limit(self):
+        # Un hash en Python occupe bien plus d'un octet : on convertit bien avant 2^p éléments.
+        return self.size // 16
+
+    def add(self, item):
+        value = hash64(item)
+        if self.registers is None:
+            self.sparse.add(value)
+            if len(self.sparse) > self._sparse_limit():
+                self._densify()
+            return
+        self._add_hash(value)
+
+    def _densify(self):
+        self.registers = bytearray(self.size)
+        self.scaled_sum = self.size << HASH_BITS
+        self.zeros = self.size
+        for value in self.sparse:
+            self._add_hash(value)
+        self.sparse = None
+
+    def _add_hash(self, value):
+        precision = self.precision
+        index = value >> (HASH_BITS - precision)
+        remaining_bits = HASH_BITS - precision
+        remaining = value & ((1 << remaining_bits) - 1)
+        rank = remaining_bits - remaining.bit_length() + 1
+        old = self.registers[index]
+        if rank > old:
+            self.registers[index] = rank
+            self.scaled_sum += (1 << (HASH_BITS - rank)) - (1 << (HASH_BITS - old))
+            if old == 0:
+                self.zeros -= 1
+
+    def count(self):
+        """Estimation du nombre d'éléments distincts."""
+        if self.registers is None:
+            return len(self.sparse)
+        m = self.size
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m * (1 << HASH_BITS) / self.scaled_sum
+        # Correction petites cardinalités (comptage linéaire)
+        if estimate <= 2.5 * m and self.zeros:
+            estimate = m * math.log(m / self.zeros)
+        return estimate
+
+    def __len__(self):
+        return int(round(self.count()))
+
+    def merge(self, other):
+        """Fusionne une autre esquisse de même précision (union des ensembles)."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches with different precisions")
+        if other.registers is None:
+            for value in other.sparse:
+                if self.registers is None:
+                    self.sparse.add(value)
+                else:
+                    self._add_hash(value)
+            if self.registers is None and len(self.sparse) > self._sparse_limit():
+                self._densify()
+            return
+        if self.registers is None:
+            self._densify()
+        for index, rank in enumerate(other.registers):
+            old = self.registers[index]
+            if rank > old:
+                self.registers[index] = rank
+                self.scaled_sum += (1 << (HASH_BITS - rank)) - (1 << (HASH_BITS - old))
+                if old == 0:
+                    self.zeros -= 1
+
+
+class SpaceSaving:
+    """Compteurs approchés des éléments les plus fréquents, en mémoire bornée."""
+
+    __slots__ = ("capacity", "counters", "heap", "total")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}  # élément -> [compte, erreur]
+        # Une entrée (compte, élément) par élément suivi ; le compte peut être en retard
+        # sur le vrai compteur, il est corrigé quand l'entrée arrive en tête.
+        self.heap = []
+        self.total = 0
+
+    def add(self, item, amount=1):
+        self.total += amount
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += amount
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [amount, 0]
+            heapq.heappush(self.heap, (amount, item))
+            return
+        # Table pleine : on remplace l'élément le moins fréquent
+        heap = self.heap
+        while True:
+            count, victim = heap[0]
+            current = self.counters[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(heap, (current, victim))
+        del self.counters[victim]
+        self.counters[item] = [count + amount, count]
+        heapq.heapreplace(heap, (count + amount, item))
+
+    def merge(self, other):
+        """Ajoute les compteurs d'une autre table (le résultat peut dépasser capacity)."""
+        self.total += other.total
+        for item, (count, error) in other.counters.items():
+            counter = self.counters.get(item)
+            if counter is None:
+                self.counters[item] = [count, error]
+            else:
+                counter[0] += count
+                counter[1] += error
+        self.heap = [(count, item) for item, (count, _error) in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def top(self, k):
+        """Les k éléments les plus fréquents : [(élément, compte, erreur)], compte - erreur <= vrai compte <= compte."""
+        best = heapq.nlargest(k, self.counters.items(), key=lambda entry: entry[1][0])
+        return [(item, count, error) for item, (count, error) in best]
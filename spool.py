@@ -0,0 +1,372 @@
+"""
+Spool disque des documents de log, pour ne rien perdre quand Elasticsearch est
+arrêté ou lent.
+
+Le thread d'écriture du BulkSink ajoute les documents à la fin du spool au lieu
+de les envoyer ; un thread d'expédition les relit dans l'ordre et les envoie
+par lots _bulk, puis avance un curseur persistant. Tant qu'Elasticsearch ne
+répond pas, les documents s'accumulent sur disque et l'expédition reprend
+(avec un délai croissant entre les essais) dès son retour, y compris après un
+redémarrage du proxy.
+
+Le spool est une suite de segments en ajout seul (spool-000000000001.log...) ;
+chaque enregistrement est préfixé par sa longueur et son CRC32, ce qui permet
+d'ignorer une fin de segment incomplète après un arrêt brutal. Les segments
+entièrement expédiés sont supprimés ; au-delà de LOG_SPOOL_MAX_MB, les plus
+anciens sont supprimés même s'ils n'ont pas été expédiés.
+
+La livraison est « au moins une fois » : un arrêt entre l'envoi d'un lot et la
+mise à jour du curseur renvoie ce lot au redémarrage.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import date, datetime
+
+SPOOL_DIR = os.getenv("LOG_SPOOL_DIR", "")  # vide : pas de spool, envoi direct
+SPOOL_SEGMENT_SIZE = int(os.getenv("LOG_SPOOL_SEGMENT_MB", "16")) * 1024 * 1024
+SPOOL_MAX_SIZE = int(os.getenv("LOG_SPOOL_MAX_MB", "1024")) * 1024 * 1024
+SPOOL_FSYNC = os.getenv("LOG_SPOOL_FSYNC", "interval")  # always, interval ou never
+SPOOL_FSYNC_INTERVAL = float(os.getenv("LOG_SPOOL_FSYNC_INTERVAL", "1.0"))
+SPOOL_MMAP = os.getenv("LOG_SPOOL_MMAP", "off") == "on"
+
+FSYNC_POLICIES = ("always", "interval", "never")
+RECORD_HEADER = struct.Struct("<II")  # longueur, CRC32
+SEGMENT_PREFIX = "spool-"
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor"
+
+
+def encode_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_record(index, doc_id, document):
+    payload = json.dumps(
+        [index, doc_id, document], default=encode_value, separators=(",", ":")
+    ).encode()
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def scan_records(data, offset=0):
+    """Parcourt les enregistrements valides ; retourne [(début, fin, payload)]."""
+    records = []
+    while offset + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if length == 0 or end > len(data):
+            break  # fin des données (zéros d'un segment préalloué) ou écriture interrompue
+        payload = bytes(data[offset + RECORD_HEADER.size : end])
+        if zlib.crc32(payload) != checksum:
+            break
+        records.append((offset, end, payload))
+        offset = end
+    return records
+
+
+class Segment:
+    __slots__ = ("number", "path", "size", "records")
+
+    def __init__(self, number, path, size=0, records=0):
+        self.number = number
+        self.path = path
+        self.size = size  # octets valides
+        self.records = records
+
+
+class Spool:
+    def __init__(
+        self,
+        directory,
+        segment_size=SPOOL_SEGMENT_SIZE,
+        max_size=SPOOL_MAX_SIZE,
+        fsync=SPOOL_FSYNC,
+        fsync_interval=SPOOL_FSYNC_INTERVAL,
+        use_mmap=SPOOL_MMAP,
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(
+                f"Unknown spool fsync policy {fsync!r}, expected one of {', '.join(FSYNC_POLICIES)}"
+            )
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max(max_size, 2 * segment_size)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.use_mmap = use_mmap
+        self.condition = threading.Condition()
+        # Un seul processus par répertoire (en mode --workers, un sous-répertoire par worker)
+        self.lock_file = open(os.path.join(directory, ".lock"), "w", encoding="utf-8")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as exc:
+            self.lock_file.close()
+            raise RuntimeError(
+                f"Spool directory {directory} is used by another process"
+            ) from exc
+        self.segments = []
+        self.file = None
+        self.mapped = None
+        self.last_sync = time.monotonic()
+        self.dirty = False
+        # Compteurs
+        self.appended = 0
+        self.shipped = 0
+        self.evicted = 0
+        self.recovered = 0
+        self._recover()
+
+    # Reprise après redémarrage
+
+    def _recover(self):
+        numbers = sorted(
+            int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        for number in numbers:
+            segment = Segment(number, self._path(number))
+            with open(segment.path, "rb") as f:
+                records = scan_records(f.read())
+            segment.size = records[-1][1] if records else 0
+            segment.records = len(records)
+            self.segments.append(segment)
+        self.cursor = self._read_cursor()
+        if self.segments:
+            self.recovered = self._pending_records()
+        self._open_segment(self.segments[-1] if self.segments else None)
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), encoding="utf-8") as f:
+                number, offset = map(int, f.read().split())
+        except (OSError, ValueError):
+            number, offset = 0, 0
+        first = self.segments[0].number if self.segments else 1
+        if number < first:
+            return first, 0
+        return number, offset
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(f"{self.cursor[0]} {self.cursor[1]}\n")
+            if self.fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _path(self, number):
+        return os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{number:012d}{SEGMENT_SUFFIX}"
+        )
+
+    # Écriture
+
+    def _open_segment(self, segment):
+        """Ouvre un segment en ajout (un nouveau si segment vaut None ou est plein)."""
+        self._close_file()
+        if segment is None or segment.size >= self.segment_size:
+            number = (
+                self.segments[-1].number + 1
+                if self.segments
+                else max(self.cursor[0], 1)
+            )
+            segment = Segment(number, self._path(number))
+            self.segments.append(segment)
+        self.file = open(segment.path, "r+b" if os.path.exists(segment.path) else "w+b")
+        self.file.truncate(segment.size)  # fin incomplète d'une écriture interrompue
+        if self.use_mmap:
+            # Segment préalloué : un ajout n'est qu'une copie en mémoire
+            self.file.truncate(self.segment_size)
+            self.mapped = mmap.mmap(self.file.fileno(), 0)
+        else:
+            self.file.seek(segment.size)
+
+    def _close_file(self):
+        if self.file is None:
+            return
+        self._sync()
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+            active = self.segments[-1]
+            self.file.truncate(active.size)  # rend la place préallouée
+        self.file.close()
+        self.file = None
+
+    def _sync(self):
+        if not self.dirty:
+            return
+        if self.mapped is not None:
+            self.mapped.flush()
+        else:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.dirty = False
+        self.last_sync = time.monotonic()
+
+    def append(self, documents):
+        """Ajoute une liste de (index, id, document) à la fin du spool."""
+        records = [
+            encode_record(index, doc_id, document)
+            for index, doc_id, document in documents
+        ]
+        if not records:
+            return
+        with self.condition:
+            for record in records:
+                active = self.segments[-1]
+                if active.size and active.size + len(record) > self.segment_size:
+                    self._open_segment(None)
+                    active = self.segments[-1]
+                    self._enforce_cap()
+                if self.mapped is not None and active.size + len(record) > len(
+                    self.mapped
+                ):
+                    # Enregistrement plus grand qu'un segment : on agrandit la projection
+                    self.mapped.resize(active.size + len(record))
+                if self.mapped is not None:
+                    self.mapped[active.size : active.size + len(record)] = record
+                else:
+                    self.file.write(record)
+                active.size += len(record)
+                active.records += 1
+            if self.mapped is None:
+                self.file.flush()  # visible par le thread d'expédition
+            self.dirty = True
+            self.appended += len(records)
+            if self.fsync == "always" or (
+                self.fsync == "interval"
+                and time.monotonic() - self.last_sync >= self.fsync_interval
+            ):
+                self._sync()
+            self.condition.notify_all()
+
+    def sync_if_due(self):
+        """Applique la politique "interval" quand les ajouts se sont arrêtés."""
+        with self.condition:
+            if (
+                self.fsync == "interval"
+                and time.monotonic() - self.last_sync >= self.fsync_interval
+            ):
+                self._sync()
+
+    def _enforce_cap(self):
+        # Appelé sous self.condition : supprime les segments les plus anciens au-delà de la taille maximale
+        while (
+            len(self.segments) > 1
+            and sum(segment.size for segment in self.segments) > self.max_size
+        ):
+            oldest = self.segments.pop(0)
+            if self.cursor[0] <= oldest.number:
+                self.evicted += self._records_after(
+                    oldest, self.cursor[1] if self.cursor[0] == oldest.number else 0
+                )
+                self.cursor = (self.segments[0].number, 0)
+                self._write_cursor()
+            os.unlink(oldest.path)
+
+    # Lecture et expédition
+
+    def _read_segment(self, segment, offset):
+        with open(segment.path, "rb") as f:
+            f.seek(offset)
+            return f.read(segment.size - offset)
+
+    def _records_after(self, segment, offset):
+        if offset == 0:
+            return segment.records
+        return len(scan_records(self._read_segment(segment, offset)))
+
+    def _pending_records(self):
+        return sum(
+            self._records_after(
+                segment, self.cursor[1] if segment.number == self.cursor[0] else 0
+            )
+            for segment in self.segments
+            if segment.number >= self.cursor[0]
+        )
+
+    def read(self, max_records, timeout=None):
+        """
+        Retourne jusqu'à max_records documents (index, id, document) à partir du curseur,
+        et la position à passer à commit() une fois le lot expédié. Attend au plus
+        timeout secondes si le spool est vide.
+        """
+        with self.condition:
+            if not self._has_pending():
+                self.condition.wait(timeout)
+            self._skip_evicted()
+            segments = [
+                segment for segment in self.segments if segment.number >= self.cursor[0]
+            ]
+            number, offset = self.cursor
+        documents = []
+        position = (number, offset)
+        for segment in segments:
+            start = offset if segment.number == number else 0
+            try:
+                data = self._read_segment(segment, start)
+            except FileNotFoundError:
+                # Évincé pendant la lecture : le lot continue au segment suivant
+                position = (segment.number + 1, 0)
+                continue
+            for _start, end, payload in scan_records(data):
+                documents.append(tuple(json.loads(payload)))
+                position = (segment.number, start + end)
+                if len(documents) >= max_records:
+                    return documents, position
+            if segment is not segments[-1]:
+                position = (segment.number + 1, 0)
+        return documents, position
+
+    def _skip_evicted(self):
+        # Appelé sous self.condition : un curseur resté sur un segment supprimé passe au premier segment vivant
+        if self.segments and self.cursor[0] < self.segments[0].number:
+            self.cursor = (self.segments[0].number, 0)
+
+    def _has_pending(self):
+        number, offset = self.cursor
+        return any(
+            segment.size > (offset if segment.number == number else 0)
+            for segment in self.segments
+            if segment.number >= number
+        )
+
+    def commit(self, position, count):
+        """Avance le curseur après l'expédition de count documents et supprime les segments terminés."""
+        with self.condition:
+            if position[0] < self.cursor[0]:
+                return  # segment évincé entre-temps : le curseur est déjà sur un segment vivant
+            self.cursor = position
+            self._skip_evicted()
+            self.shipped += count
+            while len(self.segments) > 1 and self.segments[0].number < position[0]:
+                os.unlink(self.segments.pop(0).path)
+            self._write_cursor()
+
+    def close(self):
+        with self.condition:
+            self._close_file()
+            self.lock_file.close()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "segments": len(self.segments),
+                "bytes": sum(segment.size for segment in self.segments),
+                "appended": self.appended,
+                "shipped": self.shipped,
+                "evicted": self.evicted,
+                "recovered": self.recovered,
+            }
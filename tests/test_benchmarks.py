@@ -0,0 +1,51 @@
+import argparse
+import random
+
+import pytest
+
+from benchmarks.loadtest import build_query, next_query, parse_mix, percentiles
+from benchmarks.stub_resolver import TXT_PAYLOAD, build_answer
+from decoder import parse_dns_message
+
+
+def stub_reply(name, qtype=1, transaction_id=0x5151):
+    return parse_dns_message(build_answer(build_query(name, qtype, transaction_id)))
+
+
+def test_a_answer_is_stable_per_name():
+    first, second = stub_reply("www1.bench-example.com"), stub_reply("www1.bench-example.com", transaction_id=7)
+    assert (first.id, first.rcode, first.an_count) == (0x5151, 0, 1)
+    assert second.id == 7
+    assert next(first.records()).data == next(second.records()).data
+
+
+def test_txt_answer_carries_large_payload():
+    reply = stub_reply("abc.txt-bench.net", qtype=16)
+    (record,) = reply.records()
+    assert record.rtype == 16 and record.ttl == 60
+    assert TXT_PAYLOAD.decode() in str(record.data)
+
+
+@pytest.mark.parametrize("name, qtype, rcode", [("nx-missing.bench-example.com", 1, 3), ("www.bench-example.com", 15, 0)])
+def test_negative_answers_carry_soa(name, qtype, rcode):
+    reply = stub_reply(name, qtype)
+    assert (reply.rcode, reply.an_count, reply.ns_count) == (rcode, 0, 1)
+
+
+def test_query_mix_parsing():
+    assert parse_mix("cacheable=0.6,tunnel=0.4") == {"cacheable": 0.6, "tunnel": 0.4}
+    with pytest.raises(argparse.ArgumentTypeError, match="unknown query kind"):
+        parse_mix("cacheable=0.5,flood=0.5")
+
+
+def test_tunnel_queries_use_random_subdomains():
+    rng = random.Random(1)
+    names = {next_query("tunnel", rng)[0] for _ in range(20)}
+    assert len(names) == 20
+    assert all(name.endswith(".t.tunnel-bench.net") for name in names)
+
+
+def test_latency_percentiles():
+    result = percentiles([float(value) for value in range(1, 1001)])
+    assert (result["p50"], result["p99"], result["max"], result["mean"]) == (501.0, 991.0, 1000.0, 500.5)
+    assert percentiles([]) == {}
@@ -0,0 +1,216 @@
+import struct
+import zlib
+
+import pytest
+
+import cache
+from cache import DNSCache, build_query, parse_question, scan_response
+from decoder import OPT_TYPE
+
+
+def question(name, qtype=1):
+    return b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\x00" + struct.pack(
+        "!HH", qtype, 1
+    )
+
+
+def query(name, qtype=1, udp_size=None, do_bit=False, transaction_id=0x1234):
+    opt = b""
+    if udp_size is not None:
+        opt = b"\x00" + struct.pack("!HHIH", OPT_TYPE, udp_size, 0x8000 if do_bit else 0, 0)
+    header = struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 1 if opt else 0)
+    return header + question(name, qtype) + opt
+
+
+def answer(request, ttl=300, count=1, rdata=b"\xc0\x00\x02\x01", rtype=1, rcode=0, authority=b"", opt=False):
+    """Réponse à request : count enregistrements identiques pointant sur la question."""
+    qend = 12 + request[12:].index(b"\x00") + 5
+    records = struct.pack("!HHHIH", 0xC00C, rtype, 1, ttl, len(rdata)) + rdata
+    additional = b"\x00" + struct.pack("!HHIH", OPT_TYPE, 1232, 0, 0) if opt else b""
+    header = struct.pack(
+        "!6H", struct.unpack("!H", request[:2])[0], 0x8180 | rcode, 1, count, 1 if authority else 0, 1 if opt else 0
+    )
+    return header + request[12:qend] + records * count + authority + additional
+
+
+def soa(ttl, minimum):
+    rdata = b"\x00\x00" + struct.pack("!5I", 1, 3600, 600, 86400, minimum)
+    return struct.pack("!HHHIH", 0xC00C, 6, 1, ttl, len(rdata)) + rdata
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_key_separates_edns_and_payload_size():
+    plain, _ = parse_question(query("example.com"))
+    small, _ = parse_question(query("example.com", udp_size=1232))
+    large, _ = parse_question(query("example.com", udp_size=8192))
+    signed, _ = parse_question(query("example.com", udp_size=1232, do_bit=True))
+    assert plain[3:] == (0, 0)
+    assert small[3:] == (0, 1232)
+    assert large[3:] == (0, cache.EDNS_MAX_UDP_SIZE)
+    assert signed[3:] == (1, 1232)
+    assert len({plain, small, large, signed}) == 4
+
+
+def test_key_ignores_qname_case():
+    assert parse_question(query("WWW.Example.COM"))[0] == parse_question(query("www.example.com"))[0]
+
+
+def test_unparseable_query_is_not_cacheable():
+    assert parse_question(b"\x00\x01\x02") == (None, None)
+
+
+def test_hit_rewrites_transaction_id_and_case(clock):
+    dns_cache = DNSCache(10)
+    request = query("www.example.com")
+    dns_cache.put(request, answer(request))
+    other = query("WWW.example.com", transaction_id=0xBEEF)
+    response = dns_cache.get(other)
+    assert response[:2] == b"\xbe\xef"
+    assert response[12 : 12 + len(question("WWW.example.com"))] == question("WWW.example.com")
+
+
+def test_ttl_decreases_with_time_in_cache(clock):
+    dns_cache = DNSCache(10)
+    request = query("www.example.com")
+    response = answer(request, ttl=300)
+    dns_cache.put(request, response)
+    clock[0] += 100
+    ttl_fields, _ttl = scan_response(response)
+    cached = dns_cache.get(request)
+    assert struct.unpack_from("!I", cached, ttl_fields[0][0])[0] == 200
+    clock[0] += 201
+    assert dns_cache.get(request) is None
+
+
+def test_edns_answer_is_not_served_to_plain_client(clock):
+    dns_cache = DNSCache(10)
+    request = query("big.example.com", qtype=16, udp_size=4096)
+    large = answer(request, rtype=16, rdata=b"\xff" + b"x" * 255, count=3, opt=True)
+    assert len(large) > 512
+    dns_cache.put(request, large)
+    assert dns_cache.get(query("big.example.com", qtype=16)) is None
+    assert dns_cache.get(query("big.example.com", qtype=16, udp_size=4096)) is not None
+
+
+def test_answer_larger_than_advertised_size_is_not_cached(clock):
+    dns_cache = DNSCache(10)
+    request = query("big.example.com", qtype=16)
+    dns_cache.put(request, answer(request, rtype=16, rdata=b"\xff" + b"x" * 255, count=3))
+    assert dns_cache.get(request) is None
+    assert dns_cache.stats()["inserts"] == 0
+
+
+def test_truncated_answer_is_not_cached(clock):
+    dns_cache = DNSCache(10)
+    request = query("www.example.com")
+    response = bytearray(answer(request))
+    response[2] |= 0x02  # TC
+    dns_cache.put(request, bytes(response))
+    assert dns_cache.get(request) is None
+
+
+def test_nxdomain_uses_soa_minimum(clock):
+    request = query("missing.example.com")
+    response = answer(request, count=0, rcode=3, authority=soa(ttl=900, minimum=60))
+    _fields, ttl = scan_response(response)
+    assert ttl == 60
+    dns_cache = DNSCache(10)
+    dns_cache.put(request, response)
+    assert dns_cache.get(request) is not None
+    assert dns_cache.stats()["negative_hits"] == 1
+
+
+def test_negative_answer_without_soa_is_not_cached():
+    request = query("missing.example.com")
+    assert scan_response(answer(request, count=0, rcode=3))[1] is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    dns_cache = DNSCache(2)
+    requests = [query(f"n{i}.example.com") for i in range(3)]
+    dns_cache.put(requests[0], answer(requests[0]))
+    dns_cache.put(requests[1], answer(requests[1]))
+    dns_cache.get(requests[0])
+    dns_cache.put(requests[2], answer(requests[2]))
+    assert dns_cache.get(requests[1]) is None
+    assert dns_cache.get(requests[0]) is not None
+    assert dns_cache.stats()["evictions"] == 1
+
+
+@pytest.mark.parametrize("udp_size,do_bit", [(0, 0), (1232, 0), (4096, 1)])
+def test_prefetch_query_reproduces_the_key(udp_size, do_bit):
+    key, _ = parse_question(query("www.example.com", udp_size=udp_size or None, do_bit=bool(do_bit)))
+    assert parse_question(build_query(key))[0] == key
+
+
+def test_prefetch_candidates_are_popular_and_expiring(clock):
+    dns_cache = DNSCache(10, prefetch_hits=2)
+    popular, idle = query("popular.example.com"), query("idle.example.com")
+    dns_cache.put(popular, answer(popular, ttl=100))
+    dns_cache.put(idle, answer(idle, ttl=100))
+    dns_cache.get(popular)
+    dns_cache.get(popular)
+    assert dns_cache.prefetch_candidates() == []
+    clock[0] += 95
+    assert dns_cache.prefetch_candidates() == [parse_question(popular)[0]]
+    assert dns_cache.prefetch_candidates() == []  # déjà en cours
+
+
+def test_stale_answer_after_expiry(clock):
+    dns_cache = DNSCache(10, stale_max=3600)
+    request = query("www.example.com")
+    response = answer(request, ttl=60)
+    dns_cache.put(request, response)
+    clock[0] += 120
+    assert dns_cache.get(request) is None
+    stale = dns_cache.get_stale(request)
+    offset = scan_response(response)[0][0][0]
+    assert struct.unpack_from("!I", stale, offset)[0] == cache.STALE_ANSWER_TTL
+    # Pendant STALE_REFRESH_TIME, get() sert directement la réponse expirée
+    assert dns_cache.get(request) is not None
+
+
+def test_snapshot_round_trip(tmp_path, clock):
+    dns_cache = DNSCache(10)
+    plain, edns = query("www.example.com"), query("www.example.com", udp_size=1232, do_bit=True)
+    dns_cache.put(plain, answer(plain, ttl=300))
+    dns_cache.put(edns, answer(edns, ttl=300, opt=True))
+    path = str(tmp_path / "cache.snapshot")
+    assert dns_cache.save(path) == 2
+    restored = DNSCache(10)
+    assert restored.load(path) == 2
+    assert set(restored.entries) == set(dns_cache.entries)
+
+
+def test_snapshot_with_unknown_version_is_ignored(tmp_path):
+    path = tmp_path / "cache.snapshot"
+    path.write_bytes(cache.SNAPSHOT_HEADER.pack(cache.SNAPSHOT_MAGIC, 1, 0.0, 0))
+    assert DNSCache(10).load(str(path)) == 0
+
+
+@pytest.mark.parametrize("damage", ["overstated_count", "truncated_entry"])
+def test_damaged_snapshot_is_ignored(tmp_path, clock, capsys, damage):
+    dns_cache = DNSCache(10)
+    for name in ("www.example.com", "mail.example.com"):
+        request = query(name)
+        dns_cache.put(request, answer(request))
+    path = tmp_path / "cache.snapshot"
+    dns_cache.save(str(path))
+    data = path.read_bytes()
+    magic, version, saved_at, count = cache.SNAPSHOT_HEADER.unpack_from(data)
+    body = zlib.decompress(data[cache.SNAPSHOT_HEADER.size :])
+    if damage == "overstated_count":
+        count += 1
+    else:
+        body = body[:-3]
+    path.write_bytes(cache.SNAPSHOT_HEADER.pack(magic, version, saved_at, count) + zlib.compress(body))
+    restored = DNSCache(10)
+    assert restored.load(str(path)) == 0
+    assert not restored.entries
+    assert "ignored" in capsys.readouterr().out
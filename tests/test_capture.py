@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from capture import MAGIC, QueryCapture, capture_files, encode_record, read_capture
+
+QUERY = b"\xab\xcd\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01"
+
+
+@pytest.fixture
+def capture_path(tmp_path):
+    return str(tmp_path / "captures" / "queries.qcap")
+
+
+def captured(path):
+    return [record for name in capture_files(path) for record in read_capture(name)]
+
+
+def test_record_does_no_file_io(capture_path, monkeypatch):
+    capture = QueryCapture(capture_path, flush_interval=3600)
+    calls = []
+    monkeypatch.setattr(capture, "_rotate", lambda: calls.append("rotate"))
+    monkeypatch.setattr(capture, "_start", lambda: None)  # pas de thread d'écriture
+    for _ in range(10):
+        capture.record(QUERY, "192.0.2.1")
+    assert calls == []
+    assert capture_files(capture_path) == []
+    assert capture.stats()["queued"] == 10
+
+
+def test_writer_thread_drains_queue(capture_path):
+    capture = QueryCapture(capture_path, flush_interval=0.05)
+    capture.record(QUERY, "192.0.2.1")
+    capture.record(QUERY, "2001:db8::1", tcp=True)
+    for _ in range(100):
+        if capture.stats()["recorded"] == 2:
+            break
+        threading.Event().wait(0.02)
+    capture.close()
+    records = captured(capture_path)
+    assert [(client, tcp, query) for _timestamp, client, tcp, query in records] == [
+        ("192.0.2.1", False, QUERY),
+        ("2001:db8::1", True, QUERY),
+    ]
+
+
+def test_full_queue_drops_new_records(capture_path, monkeypatch):
+    capture = QueryCapture(capture_path, max_queue=4)
+    monkeypatch.setattr(capture, "_start", lambda: None)
+    for _ in range(6):
+        capture.record(QUERY, "192.0.2.1")
+    assert capture.stats()["queued"] == 4
+    assert capture.stats()["dropped"] == 2
+    capture.close()
+    assert len(captured(capture_path)) == 4
+
+
+def test_rotation_keeps_last_files(capture_path, monkeypatch):
+    record_size = len(encode_record(QUERY, "192.0.2.1"))
+    capture = QueryCapture(capture_path, segment_size=len(MAGIC) + 2 * record_size, keep=2)
+    monkeypatch.setattr(capture, "_start", lambda: None)
+    for _ in range(7):
+        capture.record(QUERY, "192.0.2.1")
+    capture.close()
+    files = capture_files(capture_path)
+    assert [name.rsplit(".", 1)[1] for name in files] == ["000003", "000004"]
+    assert capture.stats()["rotations"] == 3
+    assert len(captured(capture_path)) == 3
+
+
+def test_truncated_tail_is_ignored(capture_path, monkeypatch):
+    capture = QueryCapture(capture_path)
+    monkeypatch.setattr(capture, "_start", lambda: None)
+    capture.record(QUERY, "192.0.2.1")
+    capture.close()
+    (name,) = capture_files(capture_path)
+    with open(name, "ab") as f:
+        f.write(encode_record(QUERY, "192.0.2.2")[:-3])
+    assert len(captured(capture_path)) == 1
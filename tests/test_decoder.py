@@ -0,0 +1,102 @@
+import struct
+
+import pytest
+
+from decoder import MAX_POINTER_HOPS, DNSMessage, decode_dns_query, parse_dns_message
+
+QNAME = b"\x03www\x07example\x03com\x00"
+
+
+def message(flags=0x8180, answers=b"", an_count=0, tail=b""):
+    header = struct.pack("!6H", 0x4242, flags, 1, an_count, 0, 0)
+    return header + QNAME + b"\x00\x01\x00\x01" + answers + tail
+
+
+def a_record(name=b"\xc0\x0c", address=b"\xc0\x00\x02\x01"):
+    return name + struct.pack("!HHIH", 1, 1, 300, 4) + address
+
+
+def pointer(offset):
+    return struct.pack("!H", 0xC000 | offset)
+
+
+@pytest.mark.parametrize(
+    "flags, truncated",
+    [(0x8180, 0), (0x8380, 1), (0x8182, 0), (0x8382, 1)],  # 0x0002 : rcode SERVFAIL, pas le bit TC
+)
+def test_truncated_reads_tc_bit(flags, truncated):
+    data = message(flags=flags, answers=a_record(), an_count=1)
+    response = parse_dns_message(data).to_response_data(("www.example.com", 1, 1))
+    assert response["truncated"] == truncated
+
+
+def test_query_and_answer_names():
+    data = message(answers=a_record(), an_count=1)
+    parsed = parse_dns_message(data)
+    assert parsed.qname == "www.example.com"
+    (record,) = parsed.records()
+    assert record.qname == "www.example.com"
+    assert decode_dns_query(data)[2] == ("www.example.com", 1, 1)
+
+
+def test_label_then_pointer():
+    name = b"\x04mail" + pointer(16)  # mail + example.com (dans la question)
+    data = message(answers=a_record(name=name), an_count=1)
+    (record,) = parse_dns_message(data).records()
+    assert record.qname == "mail.example.com"
+
+
+def chained_names(hops):
+    """Message dont le dernier nom traverse `hops` pointeurs successifs jusqu'à la question."""
+    data = bytearray(message())
+    target = 12
+    for number in range(hops):
+        offset = len(data)
+        data += bytes([1, ord("a") + number % 26]) + pointer(target)
+        target = offset
+    return bytes(data), target
+
+
+def test_long_pointer_chain_is_iterative():
+    data, start = chained_names(MAX_POINTER_HOPS - 1)
+    name, end = DNSMessage(data).read_name(start)
+    assert name.endswith(".www.example.com")
+    assert name.count(".") == MAX_POINTER_HOPS - 1 + 2
+    assert end == start + 4
+
+
+def test_pointer_hop_limit():
+    data, start = chained_names(MAX_POINTER_HOPS + 5)
+    with pytest.raises(ValueError, match="Too many compression pointers"):
+        DNSMessage(data).read_name(start)
+
+
+def test_intermediate_names_are_memoized():
+    data, start = chained_names(3)
+    parsed = DNSMessage(data)
+    parsed.read_name(start)
+    middle = start - 4
+    assert parsed._names[middle] == ("b.a.www.example.com", middle + 4)
+    assert parsed._names[12] == ("www.example.com", 12 + len(QNAME))
+
+
+@pytest.mark.parametrize(
+    "tail",
+    [
+        pointer(0x3FFF),  # pointe après le nom : boucle possible
+        b"\x01a",  # label tronqué
+        b"\x50" + b"a" * 0x50 + b"\x00",  # label de plus de 63 octets
+    ],
+)
+def test_malformed_names_rejected(tail):
+    data = message(tail=tail)
+    with pytest.raises((ValueError, IndexError)):
+        DNSMessage(data).read_name(len(data) - len(tail))
+
+
+def test_self_pointer_rejected():
+    data = message(tail=b"\x00")
+    offset = len(data)
+    data += pointer(offset)
+    with pytest.raises(ValueError, match="Infinite loop"):
+        DNSMessage(data).read_name(offset)
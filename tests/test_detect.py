@@ -0,0 +1,207 @@
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import detect  # noqa: E402
+from detect import DetectorState, WINDOW_SIZE  # noqa: E402
+from sketch import HyperLogLog  # noqa: E402
+
+T0 = 1_700_000_000.0 - 1_700_000_000.0 % WINDOW_SIZE  # début d'une fenêtre
+
+
+@pytest.fixture
+def recorder():
+    """DeltaRecorder d'un worker, sans thread d'envoi vers l'agrégateur."""
+    recorder = detect.DeltaRecorder.__new__(detect.DeltaRecorder)
+    recorder.lock = detect.threading.Lock()
+    recorder.domains = {}
+    recorder.clients = {}
+    return recorder
+
+
+def fill(state, domain, count, timestamp=T0, prefix="n"):
+    alerts = []
+    for number in range(count):
+        alerts += state.record(domain, f"{prefix}{number}", 1, timestamp)
+    return alerts
+
+
+def unique_counter(state, domain, timestamp=T0):
+    shard = state.shard(domain)
+    return shard.window(int(timestamp // WINDOW_SIZE)).stats[domain].unique_subdomains
+
+
+def test_alert_every_interval_past_threshold():
+    state = DetectorState()
+    alerts = fill(state, "example.com", 120)
+    assert [alert["unique_count"] for alert in alerts] == [51, 101]
+
+
+def test_wheel_slot_reused_by_later_window():
+    state = DetectorState(shard_count=1)
+    fill(state, "example.com", 30)
+    fill(state, "example.org", 5, timestamp=T0 + WINDOW_SIZE)
+    assert state.tracked_domains() == 2
+    # La fenêtre de T0 est remplacée d'un bloc quand l'anneau revient sur son emplacement
+    fill(state, "example.net", 5, timestamp=T0 + detect.WHEEL_SLOTS * WINDOW_SIZE)
+    assert state.tracked_domains() == 2
+
+
+def test_record_for_expired_window_ignored():
+    state = DetectorState()
+    fill(state, "example.com", 5, timestamp=T0 + detect.WHEEL_SLOTS * WINDOW_SIZE)
+    assert fill(state, "example.com", 60) == []
+    assert state.tracked_domains() == 1
+
+
+def test_least_recently_seen_domain_evicted():
+    state = DetectorState(shard_count=1, max_domains=2)
+    fill(state, "example.com", 3)
+    fill(state, "example.org", 3)
+    fill(state, "example.com", 1, prefix="m")
+    fill(state, "example.net", 3)
+    assert state.shard("example.com").evictions == 1
+    assert state.tracked_domains() == 2
+
+
+
+def test_names_counted_against_global_budget():
+    state = DetectorState(max_names=1000)
+    fill(state, "example.com", 30)
+    fill(state, "example.org", 20)
+    state.record_client("192.0.2.1", "a.example.com", T0)
+    assert state.stats()["names"] == 51
+
+
+def test_set_becomes_sketch_when_budget_is_used_up():
+    state = DetectorState(max_names=40)
+    fill(state, "example.com", 30)
+    fill(state, "example.org", 20)
+    assert isinstance(unique_counter(state, "example.com"), set)
+    assert isinstance(unique_counter(state, "example.org"), HyperLogLog)
+    assert len(unique_counter(state, "example.org")) == 20
+    # Les noms de l'ensemble converti sont rendus au budget
+    assert state.stats() == {"domains": 2, "names": 30, "sketches": 1, "evictions": 0}
+
+
+def test_set_becomes_sketch_at_per_domain_cap():
+    state = DetectorState(max_unique=10)
+    fill(state, "example.com", 25)
+    counter = unique_counter(state, "example.com")
+    assert isinstance(counter, HyperLogLog)
+    assert len(counter) == 25
+    assert state.stats()["names"] == 0
+
+
+def test_expired_window_returns_its_names():
+    state = DetectorState(max_names=1000)
+    fill(state, "example.com", 30)
+    later = T0 + detect.WHEEL_SLOTS * WINDOW_SIZE
+    fill(state, "example.com", 5, timestamp=later)
+    assert state.stats()["names"] == 5
+
+
+def test_evicted_domain_returns_its_names():
+    state = DetectorState(shard_count=1, max_domains=1, max_names=1000)
+    fill(state, "example.com", 30)
+    fill(state, "example.org", 5)
+    assert state.stats() == {"domains": 1, "names": 5, "sketches": 0, "evictions": 1}
+
+
+def test_alert_threshold_kept_across_windows():
+    state = DetectorState()
+    first = fill(state, "example.com", 60)
+    assert [alert["unique_count"] for alert in first] == [51]
+    # Fenêtre suivante : comme avant la roue, le même domaine ne réalerte qu'au-delà du seuil suivant
+    second = fill(state, "example.com", 60, timestamp=T0 + WINDOW_SIZE)
+    assert second == []
+    third = fill(state, "example.com", 120, timestamp=T0 + 2 * WINDOW_SIZE, prefix="m")
+    assert [alert["unique_count"] for alert in third] == [101]
+
+
+def test_merge_counts_worker_names_against_budget():
+    state = DetectorState(max_names=10)
+    delta = detect.WindowDelta()
+    delta.count = 12
+    delta.unique_subdomains = {f"w{number}" for number in range(12)}
+    delta.client_address = "192.0.2.7"
+    window_number = int(T0 // WINDOW_SIZE)
+    state.merge(window_number, "example.net", delta)
+    counter = unique_counter(state, "example.net")
+    assert isinstance(counter, HyperLogLog)
+    assert len(counter) == 12
+    assert state.stats()["names"] == 0
+
+
+@pytest.mark.parametrize("qtype, alerted", [(16, True), (5, True), (1, False), ("TXT", False)])
+def test_suspicious_types_match_numeric_qtype(qtype, alerted):
+    state = DetectorState()
+    alerts = []
+    for _ in range(detect.SUSPICIOUS_QUERY_THRESHOLD + 1):
+        alerts += state.record("example.com", None, qtype, T0)
+    assert bool(alerts) == alerted
+    if alerted:
+        reason = alerts[0]["additional_info"]["alert_reason"]
+        assert reason == f"High query volume for type {detect.query_type_to_string(qtype)}"
+
+
+def test_worker_delta_counts_numeric_suspicious_types(recorder):
+    for qtype in (16, 16, 5, 1):
+        recorder.record("example.com", "a", "a.example.com", qtype, "192.0.2.1", T0)
+    delta = recorder.domains[(int(T0 // WINDOW_SIZE), "example.com")]
+    assert delta.suspicious == {16: 2, 5: 1}
+
+    state = DetectorState()
+    delta.count = detect.SUSPICIOUS_QUERY_THRESHOLD + 3
+    alerts = state.merge(int(T0 // WINDOW_SIZE), "example.com", delta)
+    assert [alert["additional_info"]["query_type"] for alert in alerts] == [16, 5]
+
+
+def test_client_names_become_sketch_at_client_cap():
+    state = DetectorState(max_client_unique=20)
+    for number in range(50):
+        count = state.record_client("192.0.2.9", f"n{number}.example.com", T0)
+    shard = state.client_shards[hash("192.0.2.9") % len(state.client_shards)]
+    counter = shard.window(int(T0 // WINDOW_SIZE)).stats["192.0.2.9"].unique_subdomains
+    assert isinstance(counter, HyperLogLog)
+    assert count == 50
+    assert state.stats()["names"] == 0
+
+
+def test_worker_client_names_capped_between_flushes(recorder, monkeypatch):
+    monkeypatch.setattr(detect, "MAX_CLIENT_UNIQUE_NAMES", 8)
+    for number in range(30):
+        recorder.record("example.com", f"n{number}", f"n{number}.example.com", 1, "192.0.2.9", T0)
+    names = recorder.clients[(int(T0 // WINDOW_SIZE), "192.0.2.9")]
+    assert isinstance(names, HyperLogLog)
+    assert len(names) == 30
+
+    state = DetectorState()
+    assert state.merge_client(int(T0 // WINDOW_SIZE), "192.0.2.9", names) == 30
+
+
+def test_batch_errors_counted_in_queue_stats(monkeypatch, capsys):
+    def detect_anomalies(domain, query_type, client_address, timestamp=None):
+        if domain == "bad.example":
+            raise ValueError("boom")
+
+    monkeypatch.setattr(detect, "detect_anomalies", detect_anomalies)
+    queue = detect.DetectionQueue(batch_size=8)
+    for domain in ("a.example", "bad.example", "b.example", "bad.example"):
+        queue.submit(domain, 1, "192.0.2.1", timestamp=T0)
+    for _ in range(100):
+        if queue.stats()["processed"] == 4:
+            break
+        detect.time.sleep(0.01)
+    assert queue.stats()["errors"] == 2
+    assert "boom" in capsys.readouterr().out
+
+
+def test_first_error_of_batch_logged(monkeypatch, capsys):
+    def detect_anomalies(domain, query_type, client_address, timestamp=None):
+        raise ValueError(f"cannot analyse {domain}")
+
+    monkeypatch.setattr(detect, "detect_anomalies", detect_anomalies)
+    batch = [(T0, domain, 1, "192.0.2.1") for domain in ("a.example", "b.example", "c.example")]
+    assert detect.detect_batch(batch) == 3
+    assert capsys.readouterr().out == "Detection error : cannot analyse a.example\n"
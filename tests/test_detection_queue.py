@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import detect  # noqa: E402
+from detect import DetectionQueue  # noqa: E402
+
+
+@pytest.fixture
+def paused(monkeypatch):
+    """DetectionQueue dont le thread n'est pas démarré : la file ne se vide pas."""
+
+    def make(**kwargs):
+        detection = DetectionQueue(**kwargs)
+        monkeypatch.setattr(detection, "_start", lambda: None)
+        return detection
+
+    return make
+
+
+@pytest.mark.parametrize("policy, kept", [("drop-new", ["q0", "q1", "q2"]), ("drop-oldest", ["q2", "q3", "q4"])])
+def test_full_queue_policy(paused, policy, kept):
+    detection = paused(max_size=3, policy=policy)
+    results = [detection.submit(f"q{number}", 1, "192.0.2.1", timestamp=float(number)) for number in range(5)]
+    assert [domain for _timestamp, domain, _qtype, _client in detection.items] == kept
+    assert results == ([True] * 3 + [False] * 2 if policy == "drop-new" else [True] * 5)
+    assert detection.stats() == {"queued": 3, "submitted": 5, "dropped": 2, "processed": 0, "errors": 0}
+
+
+def test_batches_bounded_by_batch_size(paused):
+    detection = paused(batch_size=4)
+    for number in range(10):
+        detection.submit(f"q{number}", 1, "192.0.2.1")
+    assert [len(detection._take_batch()) for _ in range(4)] == [4, 4, 2, 0]
+
+
+def test_worker_thread_keeps_order_and_timestamps(monkeypatch):
+    analysed = []
+    done = threading.Event()
+
+    def detect_anomalies(domain, query_type, client_address, timestamp=None):
+        analysed.append((domain, query_type, client_address, timestamp))
+        if len(analysed) == 50:
+            done.set()
+
+    monkeypatch.setattr(detect, "detect_anomalies", detect_anomalies)
+    detection = DetectionQueue(batch_size=16)
+    for number in range(50):
+        detection.submit(f"n{number}.example.com", 16, "192.0.2.4", timestamp=1000.0 + number)
+    assert done.wait(2)
+    assert analysed == [(f"n{number}.example.com", 16, "192.0.2.4", 1000.0 + number) for number in range(50)]
+    for _ in range(100):  # le compteur est mis à jour après le lot
+        if detection.stats()["processed"] == 50:
+            break
+        detect.time.sleep(0.01)
+    assert detection.stats()["processed"] == 50
+
+
+def test_unknown_policy_rejected():
+    with pytest.raises(ValueError, match="Unknown detection queue policy"):
+        DetectionQueue(policy="block")
@@ -0,0 +1,104 @@
+import asyncio
+import struct
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import proxy  # noqa: E402
+
+
+def dns_query(name, transaction_id=0x2A2A):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    return struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0) + labels + b"\x00\x00\x01\x00\x01"
+
+
+class ManualUpstreams:
+    """Remplace l'UpstreamSet : chaque requête reçoit un Future résolu par le test."""
+
+    def __init__(self, answer=True):
+        self.answer = answer
+        self.futures = []
+
+    def submit(self, data, use_tcp=False):
+        future = Future()
+        self.futures.append((data, future))
+        if self.answer:
+            self.reply(future, data)
+        return future
+
+    @staticmethod
+    def reply(future, data):
+        future.set_result(data[:2] + b"\x81\x80" + data[4:])
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """Moteur asyncio sans cache, blocklist ni limitation ; les échanges journalisés sont relevés."""
+    reported = []
+    monkeypatch.setattr(proxy, "_upstreams", ManualUpstreams())
+    monkeypatch.setattr(proxy, "singleflight", proxy.SingleFlight())
+    monkeypatch.setattr(proxy, "response_cache", None)
+    monkeypatch.setattr(proxy, "blocklist", None)
+    monkeypatch.setattr(proxy, "rate_limiter", None)
+    monkeypatch.setattr(proxy, "query_capture", None)
+    monkeypatch.setattr(proxy, "report_exchange", lambda *args, **kwargs: reported.append(args))
+    engine = proxy.AsyncProxyEngine(max_inflight=4, log_workers=1)
+    engine.reported = reported
+    yield engine
+    engine.log_executor.shutdown(wait=True)
+
+
+def test_answers_and_hands_logging_to_executor(engine):
+    data = dns_query("www.example.com")
+    response = asyncio.run(engine.handle_dns_request(data, "192.0.2.1", "UDP"))
+    engine.log_executor.shutdown(wait=True)
+    assert response[:4] == b"\x2a\x2a\x81\x80"
+    ((logged, logged_response, query_data, error, source, client_ip),) = engine.reported
+    assert (logged, logged_response, source, client_ip) == (data, response, "UDP", "192.0.2.1")
+    assert query_data[0] == "www.example.com" and not error
+
+
+def test_upstream_failure_is_reported_without_answer(engine):
+    class Failing:
+        def submit(self, data, use_tcp=False):
+            future = Future()
+            future.set_exception(TimeoutError("upstream timeout"))
+            return future
+
+    proxy._upstreams = Failing()
+    response = asyncio.run(engine.handle_dns_request(dns_query("example.org"), "192.0.2.1", "UDP"))
+    engine.log_executor.shutdown(wait=True)
+    assert response is None
+    assert isinstance(engine.reported[0][3], TimeoutError)
+
+
+def test_datagrams_dropped_above_max_inflight(engine):
+    upstreams = proxy._upstreams
+    upstreams.answer = False
+    transport = FakeTransport()
+
+    async def scenario():
+        protocol = proxy.ProxyDatagramProtocol(engine)
+        protocol.connection_made(transport)
+        for number in range(6):
+            protocol.datagram_received(dns_query(f"n{number}.example.com", number), ("192.0.2.1", 5300 + number))
+        await asyncio.sleep(0)
+        assert (engine.inflight, engine.dropped) == (4, 2)
+        for data, future in upstreams.futures:
+            upstreams.reply(future, data)
+        await asyncio.wait(set(engine.tasks))
+
+    asyncio.run(scenario())
+    assert engine.inflight == 0
+    assert sorted(addr[1] for _data, addr in transport.sent) == [5300, 5301, 5302, 5303]
+    assert all(data[:2] == struct.pack("!H", addr[1] - 5300) for data, addr in transport.sent)
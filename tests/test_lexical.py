@@ -0,0 +1,93 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import lexical  # noqa: E402
+from lexical import LexicalScorer  # noqa: E402
+
+ORDINARY = ["www", "mail", "api", "login", "cdn", "images", "support", "shop"]
+ENCODED = [
+    "mfrggzdfmztwq2lknnwg23tpobyxe43uov3ho6dzpi.a1b2c3",
+    "4a6f686e20446f6520736563726574206b6579730a0b",
+    "nbswy3dpeb3w64tmmqqho2lunaqgk6dbnvygyzjoei9x7q",
+]
+T0 = 1_700_000_040.0  # début d'une fenêtre de 60 s
+
+
+@pytest.fixture(scope="module")
+def scorer():
+    """Scoreur partagé, modèle de bigrammes appris une fois sur le corpus par défaut."""
+    return LexicalScorer(batch_size=4, max_delay=60, alert_names=3)
+
+
+@pytest.fixture
+def fresh(scorer):
+    return LexicalScorer(model=scorer.model, batch_size=4, max_delay=60, alert_names=3)
+
+
+def test_features_of_known_name(scorer):
+    features = scorer.features(["ab12.c"])
+    assert features["length"].tolist() == [5]
+    assert features["max_label_length"].tolist() == [4]
+    assert features["digit_ratio"][0] == pytest.approx(2 / 5)
+    assert features["hex_ratio"][0] == pytest.approx(1.0)
+    assert features["entropy"][0] == pytest.approx(np.log2(5))
+
+
+def test_batch_matches_single_names(scorer):
+    names = ORDINARY + ENCODED
+    batch, _features = scorer.score_names(names)
+    single = [scorer.score_names([name])[0][0] for name in names]
+    assert batch.tolist() == pytest.approx(single)
+
+
+def test_encoded_names_score_higher(scorer):
+    ordinary = scorer.score_names(ORDINARY)[0]
+    encoded = scorer.score_names(ENCODED)[0]
+    assert ordinary.max() < lexical.LEXICAL_THRESHOLD <= encoded.min()
+
+
+def test_alert_after_enough_suspicious_names(fresh):
+    alerts = []
+    for number, name in enumerate(ENCODED * 2):
+        alerts += fresh.add("tunnel.example", name, f"192.0.2.{number}", now=0.0)
+    alerts += fresh.flush()
+    ((domain, client, alert),) = alerts
+    assert domain == "tunnel.example" and client == "192.0.2.3"
+    assert alert["unique_count"] == 4
+    assert fresh.summary("tunnel.example")["scored_names"] == 6
+
+
+def test_partial_batch_scored_after_max_delay(fresh):
+    assert fresh.add("example.com", "www", "192.0.2.1", now=0.0) == []
+    assert fresh.batches == 0
+    fresh.add("example.com", "mail", "192.0.2.1", now=61.0)
+    assert fresh.batches == 1 and fresh.pending == []
+
+
+def test_worker_exports_instead_of_alerting(fresh):
+    fresh.enable_export()
+    for name in ENCODED + ["www"]:
+        assert fresh.add("tunnel.example", name, "192.0.2.7", now=0.0, timestamp=T0) == []
+    exported = fresh.take_exported()
+    names, total, high, max_score, client, window_number = exported["tunnel.example"]
+    assert (names, high, client, window_number) == (4, 3, "192.0.2.7", T0 // 60)
+    assert fresh.take_exported() == {}
+    assert fresh.merge("tunnel.example", names, total, high, max_score, window_number)["unique_count"] == 3
+
+
+def test_suspicious_names_counted_per_window(fresh):
+    alerts = []
+    for window in range(3):
+        # Deux noms suspects par fenêtre : le seuil de 3 n'est jamais atteint dans une seule
+        for name in ENCODED[:2]:
+            alerts += fresh.add("tunnel.example", name, "192.0.2.8", now=0.0, timestamp=T0 + 60 * window)
+        alerts += fresh.flush()
+    assert alerts == []
+    assert fresh.summary("tunnel.example")["suspicious_names"] == 2
+
+
+def test_scores_of_replaced_window_ignored(fresh):
+    assert fresh.merge("tunnel.example", 2, 1.6, 2, 0.9, 101) is None
+    assert fresh.merge("tunnel.example", 5, 4.0, 5, 0.9, 100) is None
+    assert fresh.summary("tunnel.example")["suspicious_names"] == 2
@@ -0,0 +1,94 @@
+import threading
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+from logger import BulkSink, send_bulk  # noqa: E402
+
+
+class BulkClient:
+    """Client Elasticsearch réduit à bulk() ; refuse les documents dont "reject" est vrai."""
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def bulk(self, body):
+        with self.lock:
+            self.requests.append(body)
+        documents = body[1::2]
+        items = [{"index": {"error": "rejected"} if document.get("reject") else {}} for document in documents]
+        return {"errors": any(document.get("reject") for document in documents), "items": items}
+
+    def sizes(self):
+        return [len(body) // 2 for body in self.requests]
+
+
+@pytest.fixture
+def client():
+    return BulkClient()
+
+
+def test_documents_sent_in_bulk_batches(client):
+    sink = BulkSink(client, bulk_size=2, flush_interval=0.05)
+    for number in range(5):
+        sink.enqueue("proxy_logs", {"n": number})
+    assert sink.flush(timeout=2)
+    assert sum(client.sizes()) == 5 and max(client.sizes()) <= 2
+    assert sink.stats()["flushed"] == 5
+    assert [document["n"] for body in client.requests for document in body[1::2]] == list(range(5))
+
+
+def test_bulk_actions_carry_index_and_id(client):
+    assert send_bulk(client, [("proxy_logs_full", "abc", {"n": 1}), ("proxy_logs", None, {"n": 2})]) == 0
+    assert client.requests[0] == [
+        {"index": {"_index": "proxy_logs_full", "_id": "abc"}},
+        {"n": 1},
+        {"index": {"_index": "proxy_logs"}},
+        {"n": 2},
+    ]
+
+
+def test_rejected_documents_counted_as_failed(client):
+    sink = BulkSink(client, bulk_size=3, flush_interval=0.05)
+    for reject in (False, True, False):
+        sink.enqueue("proxy_logs", {"reject": reject})
+    assert sink.flush(timeout=2)
+    stats = sink.stats()
+    assert (stats["flushed"], stats["failed"], stats["bulk_requests"]) == (2, 1, 1)
+
+
+def test_deferred_documents_built_by_writer(client):
+    sink = BulkSink(client, bulk_size=10, flush_interval=0.05)
+    builder = threading.get_ident()
+    built_in = []
+
+    def build():
+        built_in.append(threading.get_ident())
+        return [("proxy_logs", None, {"n": 1}), ("proxy_logs_full", None, {"n": 1})]
+
+    def broken():
+        raise ValueError("bad record")
+
+    sink.enqueue_deferred(build)
+    sink.enqueue_deferred(broken)
+    assert sink.flush(timeout=2)
+    assert built_in and built_in[0] != builder
+    assert client.sizes() == [2]
+    assert sink.stats()["failed"] == 1
+
+
+@pytest.mark.parametrize("policy, kept", [("drop-new", [0, 1, 2]), ("drop-oldest", [2, 3, 4])])
+def test_overflow_policy_when_queue_is_full(client, policy, kept):
+    # Lots et délai assez grands pour que le thread d'écriture ne vide rien pendant le test
+    sink = BulkSink(client, max_queue=3, bulk_size=100, flush_interval=60, overflow_policy=policy)
+    for number in range(5):
+        sink.enqueue("proxy_logs", {"n": number})
+    assert [document["n"] for _index, _doc_id, document in sink.queue] == kept
+    assert sink.stats()["dropped"] == 2
+
+
+def test_unknown_overflow_policy_rejected(client):
+    with pytest.raises(ValueError, match="Unknown overflow policy"):
+        BulkSink(client, overflow_policy="drop-all")
@@ -0,0 +1,91 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import LatencyHistogram, MetricsRegistry, bucket_index, bucket_upper_bound
+
+
+@pytest.mark.parametrize("microseconds", [0, 1, 15, 16, 17, 100, 1_000, 123_456, 10_000_000])
+def test_bucket_bounds_contain_value(microseconds):
+    index = bucket_index(microseconds)
+    assert microseconds < bucket_upper_bound(index)
+    if index:
+        assert bucket_upper_bound(index - 1) <= microseconds
+
+
+def test_bucket_relative_precision():
+    for value in (1_000, 50_000, 2_000_000):
+        upper = bucket_upper_bound(bucket_index(value))
+        assert (upper - value) / value <= 1 / metrics.SUB_BUCKETS
+
+
+def test_quantiles_from_snapshot():
+    histogram = LatencyHistogram()
+    for _ in range(90):
+        histogram.record(0.001)
+    for _ in range(10):
+        histogram.record(0.1)
+    counts, count, total = histogram.snapshot()
+    assert count == 100 and total == pytest.approx(1.09)
+    assert LatencyHistogram.quantile(counts, count, 0.5) == pytest.approx(0.001, rel=0.07)
+    assert LatencyHistogram.quantile(counts, count, 0.99) == pytest.approx(0.1, rel=0.07)
+    assert LatencyHistogram.quantile([0] * metrics.BUCKET_COUNT, 0, 0.5) == 0.0
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+
+def test_render_histogram_is_cumulative(registry):
+    for seconds in (0.0002, 0.002, 0.02):
+        registry.observe("forward", "UDP", seconds)
+    text = registry.render()
+    labels = 'stage="forward",transport="UDP"'
+    assert f'dns_proxy_stage_latency_seconds_bucket{{{labels},le="0.00025"}} 1' in text
+    assert f'dns_proxy_stage_latency_seconds_bucket{{{labels},le="0.0025"}} 2' in text
+    assert f'dns_proxy_stage_latency_seconds_bucket{{{labels},le="+Inf"}} 3' in text
+    assert f"dns_proxy_stage_latency_seconds_count{{{labels}}} 3" in text
+
+
+def test_render_counters_and_collectors(registry, capsys):
+    registry.increment("dns_proxy_responses_total", (("rcode", 0),), help_text="Responses.")
+    registry.increment("dns_proxy_responses_total", (("rcode", 0),))
+    registry.register("dns_proxy_pool", "Pool sizes.", lambda: {(("kind", "udp"),): 4})
+    registry.register("dns_proxy_broken", "Broken.", lambda: 1 / 0)
+    text = registry.render()
+    assert "# HELP dns_proxy_responses_total Responses." in text
+    assert 'dns_proxy_responses_total{rcode="0"} 2' in text
+    assert 'dns_proxy_pool{kind="udp"} 4' in text
+    assert "dns_proxy_broken" not in text
+    assert "Metrics collector dns_proxy_broken failed" in capsys.readouterr().out
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(metrics, "endpoints", {})
+    server = metrics.start_metrics_server("127.0.0.1", 0)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_metrics_and_json_endpoints(server):
+    def echo(params):
+        if "bad" in params:
+            raise ValueError("bad parameter")
+        return params
+
+    metrics.register_endpoint("/echo", echo)
+    with urllib.request.urlopen(f"{server}/metrics", timeout=2) as reply:
+        assert reply.headers["Content-Type"].startswith("text/plain")
+        assert b"dns_proxy_start_time_seconds" in reply.read()
+    with urllib.request.urlopen(f"{server}/echo?table=qnames&k=5", timeout=2) as reply:
+        assert json.load(reply) == {"table": "qnames", "k": "5"}
+    for path, status in (("/echo?bad=1", 400), ("/missing", 404)):
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{server}{path}", timeout=2)
+        assert error.value.code == status
@@ -0,0 +1,162 @@
+import socket
+import struct
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import pcap_ingest  # noqa: E402
+from pcap_ingest import TCPReassembler, analyze, iter_packets, new_stats, open_capture, read_header  # noqa: E402
+
+
+def dns_query(name, transaction_id=1, qtype=1):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    return struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0) + labels + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+def ipv4(source, destination, protocol, payload):
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), 0, 0, 64, protocol, 0,
+                         socket.inet_aton(source), socket.inet_aton(destination))
+    return header + payload
+
+
+def udp(source_port, destination_port, payload):
+    return struct.pack("!HHHH", source_port, destination_port, 8 + len(payload), 0) + payload
+
+
+def tcp(source_port, destination_port, seq, payload, flags=0x18):
+    return struct.pack("!HHIIBBHHH", source_port, destination_port, seq, 0, 5 << 4, flags, 65535, 0, 0) + payload
+
+
+def ethernet(packet, vlan=None):
+    tag = struct.pack("!HH", 0x8100, vlan) if vlan is not None else b""
+    return b"\x02" * 6 + b"\x04" * 6 + tag + b"\x08\x00" + packet
+
+
+def query_frame(name, client="192.0.2.10", vlan=None):
+    return ethernet(ipv4(client, "198.51.100.53", 17, udp(40000, 53, dns_query(name))), vlan)
+
+
+def write_pcap(path, frames, start=1_700_000_000):
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        for number, frame in enumerate(frames):
+            f.write(struct.pack("<IIII", start + number, 500_000, len(frame), len(frame)) + frame)
+
+
+def pcapng_block(block_type, body):
+    body += b"\x00" * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def write_pcapng(path, frames, nanoseconds=1_700_000_000_250_000_000):
+    section = struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)
+    tsresol = struct.pack("<HHB", 9, 1, 9) + b"\x00" * 3 + struct.pack("<HH", 0, 0)
+    interface = struct.pack("<HHI", 1, 0, 65535) + tsresol
+    with open(path, "wb") as f:
+        f.write(pcapng_block(pcap_ingest.PCAPNG_SHB, section))
+        f.write(pcapng_block(pcap_ingest.PCAPNG_IDB, interface))
+        for number, frame in enumerate(frames):
+            stamp = nanoseconds + number * 1_000_000_000
+            header = struct.pack("<IIIII", 0, stamp >> 32, stamp & 0xFFFFFFFF, len(frame), len(frame))
+            f.write(pcapng_block(pcap_ingest.PCAPNG_EPB, header + frame))
+
+
+def read_all(path):
+    source = open_capture(path)
+    try:
+        return list(iter_packets(source, read_header(source)))
+    finally:
+        source.close()
+
+
+@pytest.fixture
+def detected(monkeypatch):
+    """Requêtes transmises au détecteur : (nom, type, client, horodatage)."""
+    seen = []
+    monkeypatch.setattr(
+        pcap_ingest.detect, "detect_anomalies",
+        lambda domain, query_type, client_address, timestamp=None: seen.append((domain, query_type, client_address, timestamp)),
+    )
+    return seen
+
+
+def test_pcap_queries_reach_detector_with_packet_time(tmp_path, detected):
+    path = str(tmp_path / "capture.pcap")
+    write_pcap(path, [query_frame("a.example.com"), query_frame("b.example.com", vlan=7), b"\x00" * 10])
+    stats = analyze(read_all(path), new_stats())
+    assert (stats["packets"], stats["udp"], stats["queries"], stats["decode_errors"]) == (3, 2, 2, 0)
+    assert detected == [
+        ("a.example.com", 1, "192.0.2.10", 1_700_000_000.5),
+        ("b.example.com", 1, "192.0.2.10", 1_700_000_001.5),
+    ]
+
+
+def test_pcapng_nanosecond_timestamps(tmp_path):
+    path = str(tmp_path / "capture.pcapng")
+    write_pcapng(path, [query_frame("a.example.com"), query_frame("b.example.com")])
+    packets = read_all(path)
+    assert [timestamp for timestamp, _linktype, _frame in packets] == pytest.approx(
+        [1_700_000_000.25, 1_700_000_001.25]
+    )
+    assert {linktype for _timestamp, linktype, _frame in packets} == {pcap_ingest.LINK_ETHERNET}
+
+
+@pytest.mark.parametrize("writer", [write_pcap, write_pcapng])
+def test_chunks_cover_every_packet_once(tmp_path, writer):
+    path = str(tmp_path / "capture")
+    frames = [query_frame(f"n{number}.example.com") for number in range(40)]
+    writer(path, frames)
+    chunks = pcap_ingest.split_capture(path, chunk_size=500)
+    assert len(chunks) > 2
+    source = open_capture(path)
+    try:
+        seen = []
+        for start, end, state in chunks:
+            source.seek(start)
+            seen += [frame for _timestamp, _linktype, frame in iter_packets(source, state, end)]
+    finally:
+        source.close()
+    assert seen == frames
+
+
+def test_not_a_capture_rejected(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"hello world")
+    with pytest.raises(ValueError, match="Not a pcap or pcapng file"):
+        read_all(str(path))
+
+
+def framed(message):
+    return len(message).to_bytes(2, "big") + message
+
+
+def test_tcp_message_split_across_segments():
+    reassembler = TCPReassembler()
+    key = ("192.0.2.10", 40001, "198.51.100.53", 53)
+    data = framed(dns_query("split.example.com")) + framed(dns_query("next.example.com"))
+    assert reassembler.segment(key, tcp(40001, 53, 1000, b"", flags=0x02)) == []
+    assert reassembler.segment(key, tcp(40001, 53, 1001, data[:20])) == []
+    messages = reassembler.segment(key, tcp(40001, 53, 1021, data[20:]))
+    assert messages == [dns_query("split.example.com"), dns_query("next.example.com")]
+
+
+def test_tcp_retransmission_ignored_and_gap_resynchronised():
+    reassembler = TCPReassembler()
+    key = ("192.0.2.10", 40002, "198.51.100.53", 53)
+    message = framed(dns_query("again.example.com"))
+    reassembler.segment(key, tcp(40002, 53, 1, b"", flags=0x02))
+    assert reassembler.segment(key, tcp(40002, 53, 2, message)) == [dns_query("again.example.com")]
+    assert reassembler.segment(key, tcp(40002, 53, 2, message)) == []  # retransmission complète
+    # Segment perdu : le tampon repart du segment suivant
+    reassembler.segment(key, tcp(40002, 53, 2 + len(message), message[:10]))
+    assert reassembler.segment(key, tcp(40002, 53, 2 + 3 * len(message), message)) == [dns_query("again.example.com")]
+    assert reassembler.resets == 1
+
+
+def test_tcp_flows_bounded():
+    reassembler = TCPReassembler(max_flows=2)
+    for port in (1, 2, 3):
+        reassembler.segment(("192.0.2.10", port, "198.51.100.53", 53), tcp(port, 53, 1, b"\x00"))
+    assert [key[1] for key in reassembler.flows] == [2, 3]
@@ -0,0 +1,94 @@
+import struct
+
+import pytest
+
+from policy import Blocklist, SuffixIndex, blocked_response, read_domains
+
+
+@pytest.fixture
+def auto_file(tmp_path):
+    return str(tmp_path / "auto-blocked.txt")
+
+
+def lines(path):
+    with open(path) as f:
+        return [line.split()[0] for line in f]
+
+
+def dns_query(name, qtype=1):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    return struct.pack("!6H", 0x1111, 0x0100, 1, 0, 0, 0) + labels + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+def test_suffix_index_matches_parents_only():
+    index = SuffixIndex(["example.com", "ads.example.net"])
+    assert index.match("www.Example.COM.") == "example.com"
+    assert index.match("x.ads.example.net") == "ads.example.net"
+    assert index.match("example.net") is None
+    assert index.match("notexample.com") is None
+
+
+def test_read_domains_accepts_hosts_format(tmp_path):
+    path = tmp_path / "list.txt"
+    path.write_text("# commentaire\n0.0.0.0 tracker.example\n*.wild.example\nplain.example # fin\nlocalhost\n")
+    assert list(read_domains(str(path))) == ["tracker.example", "wild.example", "plain.example"]
+
+
+def test_sinkhole_answer_for_a_query():
+    response = blocked_response(dns_query("x.example"), "sinkhole", ttl=30, sinkhole_v4="192.0.2.53")
+    assert struct.unpack("!6H", response[:12])[1] & 0x000F == 0
+    assert response.endswith(b"\x00\x04\xc0\x00\x02\x35")
+
+
+def test_auto_file_has_one_line_per_domain(auto_file):
+    blocklist = Blocklist(path="", auto_path=auto_file, auto_ttl=60)
+    for _ in range(3):
+        blocklist.add("Tunnel.Example.")
+    blocklist.add("other.example")
+    assert lines(auto_file) == ["other.example", "tunnel.example"]
+
+
+def test_auto_file_drops_expired_entries(auto_file, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("policy.time.time", lambda: now[0])
+    blocklist = Blocklist(path="", auto_path=auto_file, auto_ttl=60)
+    blocklist.add("old.example")
+    now[0] += 120
+    blocklist.add("new.example")
+    assert lines(auto_file) == ["new.example"]
+    assert blocklist.match("a.old.example") is None
+    assert blocklist.match("a.new.example") == "new.example"
+
+
+def test_auto_entries_bounded(auto_file, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("policy.time.time", lambda: now[0])
+    blocklist = Blocklist(path="", auto_path=auto_file, auto_ttl=60, auto_max=3)
+    for number in range(5):
+        now[0] += 1
+        blocklist.add(f"d{number}.example")
+    assert sorted(blocklist.auto) == ["d2.example", "d3.example", "d4.example"]
+    assert lines(auto_file) == ["d2.example", "d3.example", "d4.example"]
+
+
+def test_other_process_reloads_auto_file(auto_file):
+    writer = Blocklist(path="", auto_path=auto_file, auto_ttl=60)
+    writer.add("tunnel.example")
+    reader = Blocklist(path="", auto_path=auto_file, auto_ttl=60)
+    assert reader.match("x.tunnel.example") == "tunnel.example"
+
+
+def test_block_without_file_is_not_persisted(tmp_path):
+    blocklist = Blocklist(path="", auto_path="", auto_ttl=60)
+    blocklist.add("tunnel.example", persist=False)
+    assert blocklist.match("x.tunnel.example") == "tunnel.example"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_worker_applies_block_from_aggregator(monkeypatch):
+    proxy = pytest.importorskip("proxy")
+    blocklist = Blocklist(path="", auto_path="", auto_ttl=60)
+    monkeypatch.setattr(proxy, "blocklist", blocklist)
+    monkeypatch.setattr(proxy, "BLOCKLIST_AUTO", True)
+    proxy.apply_aggregator_alert("tunnel.example")
+    assert proxy.blocked_answer(dns_query("x.tunnel.example"), ("x.tunnel.example", 1, 1), "UDP") is not None
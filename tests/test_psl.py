@@ -0,0 +1,71 @@
+import pytest
+
+import psl
+from psl import PublicSuffixTrie
+
+RULES = """\
+// ===BEGIN ICANN DOMAINS===
+com
+uk
+co.uk
+
+// règles génériques et exceptions
+ck
+*.ck
+!www.ck
+公司.cn
+cn
+"""
+
+
+@pytest.fixture(scope="module")
+def trie(tmp_path_factory):
+    path = tmp_path_factory.mktemp("psl") / "public_suffix_list.dat"
+    path.write_text(RULES, encoding="utf-8")
+    return PublicSuffixTrie.from_file(str(path))
+
+
+def test_comments_and_blank_lines_skipped(trie):
+    assert trie.rules == 8
+
+
+@pytest.mark.parametrize(
+    "name, registrable",
+    [
+        ("www.example.com", "example.com"),
+        ("a.b.c.example.co.uk", "example.co.uk"),
+        ("example.uk", "example.uk"),
+        ("tunnel.example.org", "example.org"),  # TLD inconnu : règle par défaut "*"
+        ("a.b.foo.ck", "b.foo.ck"),  # *.ck
+        ("a.www.ck", "www.ck"),  # !www.ck
+        ("x.example.xn--55qx5d.cn", "example.xn--55qx5d.cn"),  # règle Unicode comparée en punycode
+        ("WWW.Example.COM.", "example.com"),
+    ],
+)
+def test_registrable_domain(trie, name, registrable):
+    assert trie.registrable_domain(name) == registrable
+
+
+@pytest.mark.parametrize("name", ["co.uk", "com", "foo.ck"])
+def test_public_suffix_is_its_own_domain(trie, name):
+    assert trie.registrable_domain(name) == name
+
+
+def test_cached_lookup_falls_back_to_two_labels(monkeypatch):
+    monkeypatch.setattr(psl, "suffix_trie", None)
+    psl.registrable_domain.cache_clear()
+    try:
+        assert psl.registrable_domain("a.example.co.uk") == "co.uk"
+    finally:
+        psl.registrable_domain.cache_clear()
+
+
+def test_cached_lookup_uses_trie(trie, monkeypatch):
+    monkeypatch.setattr(psl, "suffix_trie", trie)
+    psl.registrable_domain.cache_clear()
+    try:
+        assert psl.registrable_domain("a.example.co.uk") == "example.co.uk"
+        psl.registrable_domain("a.example.co.uk")
+        assert psl.registrable_domain.cache_info().hits == 1
+    finally:
+        psl.registrable_domain.cache_clear()
@@ -0,0 +1,83 @@
+import struct
+
+import pytest
+
+from ratelimit import FLAG_TC, RCODE_REFUSED, RateLimiter, client_key, create_rate_limiter, limited_response
+
+QUERY = struct.pack("!6H", 0x3333, 0x0100, 1, 0, 0, 0) + b"\x07example\x03com\x00\x00\x01\x00\x01"
+
+
+def allowed_at(limiter, client, times):
+    return [limiter.allow(client, now=now) for now in times]
+
+
+def test_burst_then_steady_rate():
+    limiter = RateLimiter(qps=10, burst=5)
+    assert allowed_at(limiter, "192.0.2.1", [0.0] * 7) == [True] * 5 + [False] * 2
+    # Un jeton revient toutes les 100 ms
+    assert allowed_at(limiter, "192.0.2.1", [0.1, 0.1, 0.2]) == [True, False, True]
+    assert limiter.stats()["limited"] == 3
+
+
+def test_default_burst_is_two_seconds():
+    limiter = RateLimiter(qps=4, burst=0)
+    assert sum(allowed_at(limiter, "192.0.2.1", [0.0] * 20)) == 8
+
+
+def test_clients_have_separate_buckets():
+    limiter = RateLimiter(qps=1, burst=1)
+    assert allowed_at(limiter, "192.0.2.1", [0.0, 0.0]) == [True, False]
+    assert limiter.allow("192.0.2.2", now=0.0)
+
+
+def test_prefix_shares_one_bucket():
+    limiter = RateLimiter(qps=1, burst=1, prefix_v4=24, prefix_v6=56)
+    assert limiter.allow("192.0.2.1", now=0.0)
+    assert not limiter.allow("192.0.2.200", now=0.0)
+    assert limiter.allow("198.51.100.1", now=0.0)
+    assert limiter.allow("2001:db8:0:100::1", now=0.0)
+    assert not limiter.allow("2001:db8:0:1ff::2", now=0.0)
+
+
+def test_ipv6_keys_do_not_collide_with_ipv4():
+    assert client_key("::c000:201") != client_key("192.0.2.1")
+
+
+def test_least_recent_client_evicted():
+    limiter = RateLimiter(qps=1, burst=1, max_clients=2)
+    for client in ("192.0.2.1", "192.0.2.2", "192.0.2.3"):
+        limiter.allow(client, now=0.0)
+    assert limiter.stats() == {"clients": 2, "allowed": 3, "limited": 0, "evictions": 1}
+    assert limiter.allow("192.0.2.1", now=0.0)  # oublié : nouveau seau plein
+
+
+def test_unparsable_address_is_not_limited():
+    limiter = RateLimiter(qps=1, burst=1)
+    assert all(allowed_at(limiter, "not-an-address", [0.0] * 5))
+
+
+@pytest.mark.parametrize(
+    "action, use_tcp, flags",
+    [("refused", False, 0x8100 | RCODE_REFUSED), ("truncate", False, 0x8100 | FLAG_TC), ("truncate", True, 0x8100 | RCODE_REFUSED)],
+)
+def test_limited_responses(action, use_tcp, flags):
+    response = limited_response(QUERY, action, use_tcp)
+    assert struct.unpack("!6H", response[:12]) == (0x3333, flags, 1, 0, 0, 0)
+    assert response[12:] == QUERY[12:]
+
+
+def test_drop_and_malformed_get_no_response():
+    assert limited_response(QUERY, "drop") is None
+    assert limited_response(QUERY[:14], "refused") is None
+
+
+def test_truncate_does_not_limit_tcp():
+    limiter = RateLimiter(qps=1, action="truncate")
+    assert not limiter.applies_to(use_tcp=True)
+    assert limiter.applies_to(use_tcp=False)
+
+
+def test_configuration():
+    assert create_rate_limiter(qps=0) is None
+    with pytest.raises(ValueError, match="Unknown rate limit action"):
+        RateLimiter(qps=1, action="slow")
@@ -0,0 +1,85 @@
+import asyncio
+import socket
+import struct
+import threading
+
+import pytest
+
+from benchmarks.replay_capture import run_client
+from capture import MAGIC, encode_record, read_capture
+
+BASE = 1_700_000_000.0
+
+
+def query(transaction_id, name="replay.example.com"):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    return struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0) + labels + b"\x00\x00\x01\x00\x01"
+
+
+def write_capture(path, records):
+    """records : (décalage en secondes, client, tcp, requête)."""
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        for offset, client, tcp, data in records:
+            f.write(encode_record(data, client, tcp=tcp, timestamp=BASE + offset))
+    return str(path)
+
+
+@pytest.fixture
+def echo_target():
+    """Serveur UDP local qui renvoie chaque datagramme ; retourne (adresse, datagrammes reçus)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    received = []
+
+    def serve():
+        while True:
+            try:
+                data, address = sock.recvfrom(4096)
+            except OSError:
+                return
+            received.append(data)
+            sock.sendto(data, address)
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield sock.getsockname(), received
+    sock.close()
+
+
+def test_capture_round_trip(tmp_path):
+    records = [(0.0, "192.0.2.1", False, query(1)), (0.25, "2001:db8::7", True, query(2)), (0.5, "bogus", False, query(3))]
+    path = write_capture(tmp_path / "queries.qcap", records)
+    assert list(read_capture(path)) == [
+        (BASE, "192.0.2.1", False, query(1)),
+        (BASE + 0.25, "2001:db8::7", True, query(2)),
+        (BASE + 0.5, "0.0.0.0", False, query(3)),
+    ]
+
+
+def test_max_speed_replay_answers_every_query(tmp_path, echo_target):
+    target, received = echo_target
+    records = [(number * 0.01, "192.0.2.1", False, query(7)) for number in range(20)]  # même identifiant
+    path = write_capture(tmp_path / "queries.qcap", records)
+    report = asyncio.run(run_client(target, [path], 0, 0, 0, 1, 4, 0.2, None))
+    assert report["sent"] == 20 and report["errors"] == 0
+    assert len(report["latencies"]) == 20
+    # Identifiants en double réécrits pour que chaque réponse retrouve sa requête
+    assert {data[:2] for data in received} == {struct.pack("!H", number) for number in range(7, 12)}
+
+
+def test_paced_replay_follows_capture_times(tmp_path, echo_target):
+    target, _received = echo_target
+    records = [(number * 0.5, "192.0.2.1", False, query(number)) for number in range(5)]
+    path = write_capture(tmp_path / "queries.qcap", records)
+    report = asyncio.run(run_client(target, [path], 10, 0, 0, 1, 1, 0.1, None))
+    assert report["send_duration"] == pytest.approx(0.2, abs=0.1)  # 2 s de capture à la vitesse x10
+    assert (report["first"], report["last"]) == (BASE, BASE + 2.0)
+
+
+def test_clients_split_records_and_limit(tmp_path, echo_target):
+    target, _received = echo_target
+    records = [(0.0, "192.0.2.1", number == 2, query(number)) for number in range(10)]
+    path = write_capture(tmp_path / "queries.qcap", records)
+    reports = [asyncio.run(run_client(target, [path], 0, 0, client, 2, 2, 0.1, 8)) for client in (0, 1)]
+    assert [report["sent"] for report in reports] == [4, 4]
+    assert reports[0]["sent_tcp"] == 1  # requête reçue en TCP, rejouée en TCP
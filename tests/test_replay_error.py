@@ -0,0 +1,152 @@
+import base64
+import struct
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import replay_error  # noqa: E402
+from replay_error import classify, error_filter, raw_query, replay_all, stream_errors  # noqa: E402
+
+QUERY = struct.pack("!6H", 0x0909, 0x0100, 1, 0, 0, 0) + b"\x07example\x03com\x00\x00\x01\x00\x01"
+
+
+def answered(query, rcode=0):
+    record = struct.pack("!HHHIH", 0xC00C, 1, 1, 60, 4) + b"\xc0\x00\x02\x07" if rcode == 0 else b""
+    return query[:2] + struct.pack("!5H", 0x8180 | rcode, 1, 1 if record else 0, 0, 0) + query[12:] + record
+
+
+def error_document(query=QUERY, message="Expected 1 question", transport="UDP"):
+    return {
+        "error_message": message,
+        "type": transport,
+        "query_data_raw": base64.b64encode(query).decode(),
+        "query_data_encoding": "base64",
+    }
+
+
+@pytest.mark.parametrize(
+    "document",
+    [
+        error_document(),
+        {"query_data_raw": repr(QUERY)},
+        {"query_data_raw": repr(bytearray(QUERY))},
+    ],
+)
+def test_raw_query_formats(document):
+    assert raw_query(document) == QUERY
+
+
+@pytest.mark.parametrize(
+    "document, reason",
+    [
+        ({}, "missing"),
+        ({"query_data_raw": "No query data"}, "not a query"),
+        ({"query_data_raw": "!!", "query_data_encoding": "base64"}, "invalid base64"),
+        ({"query_data_raw": "b'unterminated"}, "invalid query_data_raw"),
+    ],
+)
+def test_raw_query_rejects_unusable_documents(document, reason):
+    with pytest.raises(ValueError, match=reason):
+        raw_query(document)
+
+
+def test_error_filter():
+    assert error_filter() == {"match_all": {}}
+    assert error_filter(since="now-1h", error="timeout", transport="TCP") == {
+        "bool": {
+            "filter": [
+                {"range": {"timestamp": {"gte": "now-1h"}}},
+                {"match_phrase": {"error_message": "timeout"}},
+                {"term": {"type": "TCP"}},
+            ]
+        }
+    }
+
+
+class ScrollingClient:
+    """Index proxy_errors en pages de `page` documents, parcouru par l'API scroll."""
+
+    def __init__(self, count, page):
+        self.pages = [
+            [{"_id": f"e{number}", "_source": {"n": number}} for number in range(start, min(start + page, count))]
+            for start in range(0, count, page)
+        ] + [[]]
+        self.cleared = []
+
+    def search(self, **kwargs):
+        return {"_scroll_id": "s1", "hits": {"hits": self.pages.pop(0)}}
+
+    def scroll(self, scroll_id, scroll):
+        return {"_scroll_id": scroll_id, "hits": {"hits": self.pages.pop(0)}}
+
+    def clear_scroll(self, scroll_id):
+        self.cleared.append(scroll_id)
+
+
+@pytest.mark.parametrize("limit, expected", [(None, 7), (4, 4)])
+def test_stream_errors_pages_and_clears_scroll(limit, expected):
+    client = ScrollingClient(count=7, page=3)
+    documents = list(stream_errors(client, {"match_all": {}}, page_size=3, limit=limit))
+    assert [error_id for error_id, _document in documents] == [f"e{number}" for number in range(expected)]
+    assert client.cleared == ["s1"]
+
+
+@pytest.mark.parametrize(
+    "response, outcome",
+    [(answered(QUERY), "NOERROR"), (answered(QUERY, rcode=3), "NXDOMAIN (no answer)"), (b"\x00", None)],
+)
+def test_classify(response, outcome):
+    result = classify(QUERY, response)
+    if outcome is None:
+        assert result.startswith("decode error")
+    else:
+        assert result == outcome
+
+
+class ImmediateUpstreams:
+    def __init__(self):
+        self.transports = []
+
+    def submit(self, data, use_tcp=False):
+        self.transports.append(use_tcp)
+        future = Future()
+        if b"nx" in data:
+            future.set_exception(TimeoutError())
+        else:
+            future.set_result(answered(data))
+        return future
+
+    def query(self, data, use_tcp=False):
+        return self.submit(data, use_tcp).result()
+
+
+def test_replay_all_groups_outcomes_by_error():
+    nx_query = QUERY[:12] + b"\x02nx\x07example\x03com\x00\x00\x01\x00\x01"
+    documents = [
+        ("e1", error_document()),
+        ("e2", error_document(transport="TCP")),
+        ("e3", error_document(query=nx_query, message="timeout")),
+        ("e4", {"error_message": "timeout", "query_data_raw": "No query data"}),
+    ]
+    upstreams = ImmediateUpstreams()
+    report = replay_all(documents, upstreams, concurrency=2)
+    assert (report["replayed"], report["skipped"]) == (3, 1)
+    assert upstreams.transports == [False, True, False]
+    groups = {group["error_message"]: group for group in report["errors"]}
+    assert groups["Expected 1 question"]["outcomes"] == {"NOERROR": {"count": 2, "examples": ["e1", "e2"]}}
+    assert set(groups["timeout"]["outcomes"]) == {"upstream error: TimeoutError", "invalid query: query_data_raw is not a query: No query data"}
+
+
+def test_single_replay_uses_default_upstream(monkeypatch):
+    monkeypatch.setattr(replay_error, "DEFAULT_UPSTREAM", "[::1]:5353")
+    created = []
+    monkeypatch.setattr(replay_error, "UpstreamSet", lambda servers: created.append(servers) or ImmediateUpstreams())
+
+    class Client:
+        def get(self, index, id):
+            return {"_source": error_document()}
+
+    assert replay_error.replay_error("e1", client=Client()) == answered(QUERY)
+    assert created == [[("::1", 5353)]]
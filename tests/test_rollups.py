@@ -0,0 +1,109 @@
+import queue
+import struct
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import detect  # noqa: E402
+import logger  # noqa: E402
+import proxy  # noqa: E402
+from decoder import parse_dns_message  # noqa: E402
+from logger import RollupAggregator  # noqa: E402
+
+QUESTION = b"\x03www\x07example\x03com\x00\x00\x01\x00\x01"
+
+
+def response(rcode=0, answers=0):
+    record = struct.pack("!HHHIH", 0xC00C, 1, 1, 60, 4) + b"\xc0\x00\x02\x01"
+    return struct.pack("!6H", 0x1234, 0x8180 | rcode, 1, answers, 0, 0) + QUESTION + record * answers
+
+
+class RecordingSink:
+    def __init__(self):
+        self.deferred = []
+
+    def enqueue(self, index, document, doc_id=None):
+        pass
+
+    def enqueue_deferred(self, build_documents):
+        self.deferred.append(build_documents)
+
+    def documents(self):
+        return [document for build in self.deferred for document in build()]
+
+
+@pytest.fixture
+def rollup_mode(monkeypatch):
+    aggregator = RollupAggregator(interval=3600, sample_rate=0)
+    sink = RecordingSink()
+    monkeypatch.setattr(logger, "rollups", aggregator)
+    monkeypatch.setattr(logger, "sink", sink)
+    return aggregator, sink
+
+
+def counted(aggregator):
+    return {(key[1], key[3]): value[0] for key, value in aggregator.counters.items()}
+
+
+@pytest.mark.parametrize("rcode", [0, 2, 3])
+def test_answerless_responses_are_counted(rollup_mode, rcode):
+    aggregator, _sink = rollup_mode
+    data = response(rcode=rcode)
+    proxy.log_exchange(b"", data, ("www.example.com", 1, 1), "UDP", "192.0.2.1")
+    assert counted(aggregator) == {("www.example.com", rcode): 1}
+
+
+def test_full_mode_still_skips_answerless_responses(monkeypatch):
+    monkeypatch.setattr(logger, "rollups", None)
+    with pytest.raises(AssertionError):
+        proxy.log_exchange(b"", response(rcode=3), ("www.example.com", 1, 1), "UDP", "192.0.2.1")
+
+
+def test_unsampled_response_is_not_decoded(rollup_mode):
+    aggregator, sink = rollup_mode
+    logger.log_response(parse_dns_message(response(answers=1)), ("www.example.com", 1, 1), "UDP", "192.0.2.1", b"")
+    assert aggregator.queries == 1
+    assert sink.deferred == []
+
+
+def test_error_rcode_written_in_full(rollup_mode):
+    _aggregator, sink = rollup_mode
+    logger.log_response(parse_dns_message(response(rcode=3)), ("www.example.com", 1, 1), "UDP", "192.0.2.1", b"")
+    assert [index for index, _doc_id, _document in sink.documents()] == ["proxy_logs_full", "proxy_logs"]
+
+
+def test_suspicious_domain_written_in_full(rollup_mode):
+    aggregator, sink = rollup_mode
+    logger.mark_suspicious("Example.COM.")
+    assert aggregator.is_suspicious("a.b.www.example.com")
+    assert not aggregator.is_suspicious("example.org")
+    logger.log_response(parse_dns_message(response(answers=1)), ("www.example.com", 1, 1), "UDP", "192.0.2.1", b"")
+    assert len(sink.documents()) == 2
+
+
+def test_suspicious_mark_expires(monkeypatch):
+    aggregator = RollupAggregator(suspicious_ttl=10)
+    now = [50.0]
+    monkeypatch.setattr(logger.time, "monotonic", lambda: now[0])
+    aggregator.mark_suspicious("example.com")
+    now[0] += 11
+    assert not aggregator.is_suspicious("www.example.com")
+    assert aggregator.suspicious == {}
+
+
+def test_aggregator_alerts_reach_workers(monkeypatch):
+    raised = []
+    monkeypatch.setattr(detect, "alert_handler", lambda **alert: raised.append(alert["public_suffix"]))
+    worker_queues = [queue.Queue(), queue.Queue(maxsize=1)]
+    worker_queues[1].put("already-full.example")
+    detect.broadcast_alerts(worker_queues)
+
+    detect.alert_handler(public_suffix="tunnel.example", client_address="192.0.2.1", unique_count=60)
+    assert raised == ["tunnel.example"]
+    assert worker_queues[0].get_nowait() == "tunnel.example"
+    assert worker_queues[1].qsize() == 1  # file pleine : l'alerte est perdue pour ce worker
+
+    received = queue.Queue()
+    detect.receive_alerts(worker_queues[1], received.put)
+    assert received.get(timeout=2) == "already-full.example"
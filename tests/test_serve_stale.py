@@ -0,0 +1,88 @@
+import struct
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import cache  # noqa: E402
+import proxy  # noqa: E402
+from cache import STALE_ANSWER_TTL, DNSCache  # noqa: E402
+
+QUESTION = b"\x03www\x07example\x03com\x00\x00\x01\x00\x01"
+
+
+def request(transaction_id=0x0A0A):
+    return struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0) + QUESTION
+
+
+def reply(query, ttl=60, rcode=0):
+    answers = struct.pack("!HHHIH", 0xC00C, 1, 1, ttl, 4) + b"\xc0\x00\x02\x05" if rcode == 0 else b""
+    return query[:2] + struct.pack("!5H", 0x8180 | rcode, 1, 1 if answers else 0, 0, 0) + QUESTION + answers
+
+
+def answer_ttl(response):
+    return struct.unpack_from("!I", response, 12 + len(QUESTION) + 6)[0]
+
+
+@pytest.fixture
+def expired(monkeypatch):
+    """Cache du proxy contenant une réponse expirée depuis 100 s ; now[0] pilote l'horloge."""
+    now = [5000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    response_cache = DNSCache(stale_max=3600)
+    response_cache.put(request(), reply(request()))
+    now[0] += 160
+    monkeypatch.setattr(proxy, "response_cache", response_cache)
+    return now
+
+
+def upstream(monkeypatch, behaviour):
+    monkeypatch.setattr(proxy, "forward_to_resolver", lambda data, use_tcp=False: behaviour(data))
+
+
+def test_stale_answer_when_upstream_fails(expired, monkeypatch):
+    def fail(data):
+        raise TimeoutError("upstream timeout")
+
+    upstream(monkeypatch, fail)
+    response = proxy.resolve(request(0x0B0B))
+    assert response[:2] == b"\x0b\x0b"
+    assert answer_ttl(response) == STALE_ANSWER_TTL
+    # Pendant STALE_REFRESH_TIME, la réponse expirée est servie sans interroger l'amont
+    upstream(monkeypatch, lambda data: pytest.fail("upstream queried again"))
+    assert proxy.resolve(request(0x0C0C))[:2] == b"\x0c\x0c"
+
+
+def test_stale_answer_replaces_servfail(expired, monkeypatch):
+    upstream(monkeypatch, lambda data: reply(data, rcode=2))
+    response = proxy.resolve(request())
+    assert response[3] & 0x0F == 0 and answer_ttl(response) == STALE_ANSWER_TTL
+
+
+def test_fresh_answer_replaces_stale_entry(expired, monkeypatch):
+    upstream(monkeypatch, lambda data: reply(data, ttl=300))
+    assert answer_ttl(proxy.resolve(request())) == 300
+    assert answer_ttl(proxy.response_cache.get(request())) == 300
+
+
+def test_error_raised_without_stale_entry(expired, monkeypatch):
+    expired[0] += 3600
+
+    def fail(data):
+        raise ConnectionError("refused")
+
+    upstream(monkeypatch, fail)
+    with pytest.raises(ConnectionError):
+        proxy.resolve(request())
+
+
+def test_prefetch_refresh_stores_new_answer(expired, monkeypatch):
+    def submit(data, use_tcp):
+        future = Future()
+        future.set_result(reply(data, ttl=120))
+        return future, None
+
+    monkeypatch.setattr(proxy, "submit_to_resolver", submit)
+    proxy.refresh_cache_entry(cache.build_query(cache.parse_question(request())[0]))
+    assert answer_ttl(proxy.response_cache.get(request())) == 120
@@ -0,0 +1,81 @@
+import struct
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+from proxy import SingleFlight  # noqa: E402
+
+
+def packet(name, transaction_id, qtype=1, do_bit=None):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    additional = b""
+    if do_bit is not None:
+        additional = b"\x00" + struct.pack("!HHIH", 41, 1232, 0x8000 if do_bit else 0, 0)
+    header = struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 1 if additional else 0)
+    return header + labels + b"\x00" + struct.pack("!HH", qtype, 1) + additional
+
+
+@pytest.fixture
+def flights():
+    """SingleFlight dont chaque requête amont lancée est gardée dans started."""
+    singleflight = SingleFlight()
+    singleflight.started = []
+
+    def start():
+        future = Future()
+        singleflight.started.append(future)
+        return future
+
+    singleflight.start = start
+    return singleflight
+
+
+def test_identical_questions_share_one_upstream_query(flights):
+    first, first_end = flights.submit(packet("www.example.com", 1), False, flights.start)
+    second, second_end = flights.submit(packet("WWW.Example.com", 2), False, flights.start)
+    assert first is second and first_end == second_end
+    assert (flights.upstream_queries, flights.saved) == (1, 1)
+
+
+def test_shared_answer_gets_each_client_id_and_case(flights):
+    query = packet("WWW.Example.com", 0x0202)
+    future, qend = flights.submit(query, False, flights.start)
+    upstream_query = packet("www.example.com", 0x0101)
+    response = upstream_query[:2] + b"\x81\x80" + upstream_query[4:6] + b"\x00\x01" + upstream_query[8:] + b"rr"
+    answer = SingleFlight.answer_for(query, response, qend)
+    assert answer[:2] == b"\x02\x02"
+    assert answer[12:qend] == query[12:qend]
+    assert answer[qend:] == b"rr"
+
+
+@pytest.mark.parametrize(
+    "other, use_tcp",
+    [
+        (packet("www.example.com", 2, qtype=28), False),
+        (packet("www.example.com", 2, do_bit=True), False),
+        (packet("www.example.com", 2), True),
+        (packet("mail.example.com", 2), False),
+    ],
+)
+def test_different_questions_not_coalesced(flights, other, use_tcp):
+    first, _ = flights.submit(packet("www.example.com", 1), False, flights.start)
+    second, _ = flights.submit(other, use_tcp, flights.start)
+    assert first is not second
+    assert flights.upstream_queries == 2
+
+
+def test_completed_question_starts_new_query(flights):
+    first, _ = flights.submit(packet("www.example.com", 1), False, flights.start)
+    first.set_result(b"response")
+    assert flights.calls == {}
+    second, _ = flights.submit(packet("www.example.com", 2), False, flights.start)
+    assert second is not first
+
+
+def test_unparsable_query_bypasses_coalescing(flights):
+    _future, qend = flights.submit(b"\x00\x01garbage", False, flights.start)
+    assert qend is None
+    assert SingleFlight.answer_for(b"\x00\x01garbage", b"raw", qend) == b"raw"
+    assert flights.calls == {}
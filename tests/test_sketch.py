@@ -0,0 +1,62 @@
+import pytest
+
+from sketch import HyperLogLog, hash64, precision_for_error
+
+
+def names(count, start=0, domain="example.com"):
+    return [f"n{number}.{domain}" for number in range(start, start + count)]
+
+
+@pytest.mark.parametrize("error, precision", [(0.04, 10), (0.01, 14), (0.5, 4), (0.001, 16)])
+def test_precision_for_error(error, precision):
+    assert precision_for_error(error) == precision
+
+
+def test_hash_is_stable_across_types():
+    assert hash64("www.example.com") == hash64(b"www.example.com")
+    assert hash64("www.example.com") != hash64("www.example.org")
+
+
+def test_small_sets_stay_exact():
+    sketch = HyperLogLog(precision=10)
+    for name in names(60) + names(60):
+        sketch.add(name)
+    assert sketch.registers is None
+    assert len(sketch) == 60
+
+
+@pytest.mark.parametrize("count", [1_000, 20_000])
+def test_estimate_within_expected_error(count):
+    sketch = HyperLogLog(error=0.04)
+    for name in names(count):
+        sketch.add(name)
+    assert sketch.registers is not None
+    # Trois écarts types : le test reste déterministe (hash stable) et n'est pas fragile
+    assert abs(len(sketch) - count) <= 3 * 0.04 * count
+
+
+def test_merge_is_union():
+    left, right = HyperLogLog(), HyperLogLog()
+    for name in names(3000):
+        left.add(name)
+    for name in names(3000, start=2000):
+        right.add(name)
+    left.merge(right)
+    assert abs(len(left) - 5000) <= 3 * 0.04 * 5000
+
+
+def test_merge_sparse_into_sparse_densifies_past_limit():
+    precision = 8  # 16 hashes au plus en mode creux
+    left, right = HyperLogLog(precision=precision), HyperLogLog(precision=precision)
+    for name in names(10):
+        left.add(name)
+    for name in names(10, start=10):
+        right.add(name)
+    left.merge(right)
+    assert left.registers is not None and left.sparse is None
+    assert abs(len(left) - 20) <= 3
+
+
+def test_merge_rejects_other_precision():
+    with pytest.raises(ValueError, match="different precisions"):
+        HyperLogLog(precision=10).merge(HyperLogLog(precision=12))
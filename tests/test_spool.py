@@ -0,0 +1,139 @@
+import os
+import threading
+
+import pytest
+
+from spool import Spool
+
+
+def documents(count, start=0, size=40):
+    return [("proxy_logs", None, {"n": start + number, "pad": "x" * size}) for number in range(count)]
+
+
+@pytest.fixture
+def spool_dir(tmp_path):
+    return str(tmp_path / "spool")
+
+
+@pytest.fixture
+def open_spool(spool_dir):
+    spools = []
+
+    def factory(**kwargs):
+        kwargs.setdefault("fsync", "never")
+        spool = Spool(spool_dir, **kwargs)
+        spools.append(spool)
+        return spool
+
+    yield factory
+    for spool in spools:
+        spool.close()
+
+
+def numbers(batch):
+    return [document["n"] for _index, _doc_id, document in batch]
+
+
+def test_read_commit_and_resume_after_restart(open_spool):
+    spool = open_spool()
+    spool.append(documents(5))
+    batch, position = spool.read(3)
+    assert numbers(batch) == [0, 1, 2]
+    spool.commit(position, len(batch))
+    spool.close()
+
+    reopened = open_spool()
+    assert reopened.recovered == 2
+    batch, _position = reopened.read(10)
+    assert numbers(batch) == [3, 4]
+
+
+def test_incomplete_tail_ignored_on_recovery(open_spool, spool_dir):
+    spool = open_spool()
+    spool.append(documents(2))
+    path = spool.segments[-1].path
+    spool.close()
+    with open(path, "ab") as f:
+        f.write(b"\x40\x00\x00\x00\x01\x02")  # en-tête d'un enregistrement jamais terminé
+    reopened = open_spool()
+    assert numbers(reopened.read(10)[0]) == [0, 1]
+
+
+def test_eviction_moves_cursor_to_live_segment(open_spool):
+    spool = open_spool(segment_size=512, max_size=0)  # plafond relevé à deux segments
+    for start in range(0, 40, 4):
+        spool.append(documents(4, start))
+    assert spool.evicted > 0
+    assert spool.cursor == (spool.segments[0].number, 0)
+    batch, _position = spool.read(100)
+    assert batch and numbers(batch) == sorted(numbers(batch))
+    assert numbers(batch)[-1] == 39
+
+
+def test_stale_commit_after_eviction_keeps_live_cursor(open_spool):
+    spool = open_spool(segment_size=512, max_size=0)
+    spool.append(documents(4))
+    batch, position = spool.read(2)
+    for start in range(4, 40, 4):
+        spool.append(documents(4, start))
+    spool.commit(position, len(batch))
+    assert spool.cursor[0] == spool.segments[0].number
+    assert numbers(spool.read(100)[0])[-1] == 39
+
+
+def test_segment_removed_during_read_is_skipped(open_spool, monkeypatch):
+    spool = open_spool(segment_size=512)
+    for start in range(0, 12, 4):
+        spool.append(documents(4, start))
+    assert len(spool.segments) > 1
+    first = spool.segments[0]
+    original = spool._read_segment
+
+    def read_segment(segment, offset):
+        if segment is first:
+            os.unlink(segment.path)  # évincé entre l'instantané et la lecture
+            raise FileNotFoundError(segment.path)
+        return original(segment, offset)
+
+    monkeypatch.setattr(spool, "_read_segment", read_segment)
+    batch, position = spool.read(100)
+    assert batch and numbers(batch)[0] > 0
+    assert position[0] == spool.segments[-1].number
+
+
+class FlakySpool:
+    """Spool dont la première lecture échoue (disque plein, segment illisible...)."""
+
+    def __init__(self):
+        self.reads = 0
+        self.committed = threading.Event()
+
+    def sync_if_due(self):
+        pass
+
+    def read(self, max_records, timeout=None):
+        self.reads += 1
+        if self.reads == 1:
+            raise OSError("read error")
+        if self.reads == 2:
+            return documents(2), (1, 100)
+        self.committed.wait(timeout)
+        return [], (1, 100)
+
+    def commit(self, position, count):
+        self.committed.set()
+
+    def stats(self):
+        return {}
+
+
+def test_shipper_retries_failed_read(monkeypatch):
+    logger = pytest.importorskip("logger")
+    sent = []
+    monkeypatch.setattr(logger, "SPOOL_RETRY_MIN", 0.01)
+    monkeypatch.setattr(logger, "send_bulk", lambda client, batch: sent.append(len(batch)) or 0)
+    spool = FlakySpool()
+    shipper = logger.SpoolShipper(client=None, spool=spool)
+    assert spool.committed.wait(2)
+    assert sent == [2]
+    assert shipper.stats()["shipper_read_failures"] == 1
@@ -0,0 +1,165 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from upstream import TCPUpstreamPool, recv_exact
+
+
+def framed(message):
+    return len(message).to_bytes(2, byteorder="big") + message
+
+
+def read_frame(sock):
+    return recv_exact(sock, int.from_bytes(recv_exact(sock, 2), byteorder="big"))
+
+
+def question(name, transaction_id):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    return struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0) + labels + b"\x00\x00\x01\x00\x01"
+
+
+def answer(query):
+    return query[:2] + b"\x81\x80" + query[4:]
+
+
+class PipelineServer:
+    """
+    Résolveur TCP local. Chaque connexion est servie par `behaviour(connexion, numéro)` ;
+    par défaut, lit `batch` requêtes puis y répond dans l'ordre inverse.
+    """
+
+    def __init__(self, batch=1, behaviour=None):
+        self.batch = batch
+        self.behaviour = behaviour or self.reverse
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.connections = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _address = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(connection, self.connections), daemon=True).start()
+
+    def _serve(self, connection, number):
+        with connection:
+            try:
+                self.behaviour(connection, number)
+            except (ConnectionError, OSError):
+                pass
+
+    def reverse(self, connection, _number):
+        while True:
+            queries = [read_frame(connection) for _ in range(self.batch)]
+            connection.sendall(b"".join(framed(answer(query)) for query in reversed(queries)))
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def tcp_pool():
+    pools = []
+
+    def factory(server, **kwargs):
+        kwargs.setdefault("size", 1)
+        kwargs.setdefault("timeout", 1.0)
+        pool = TCPUpstreamPool("127.0.0.1", server.port, **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield factory
+    for pool in pools:
+        pool.close()
+
+
+def test_pipelined_queries_answered_out_of_order(tcp_pool):
+    server = PipelineServer(batch=3)
+    pool = tcp_pool(server)
+    names = ["a.example.com", "b.example.com", "c.example.com"]
+    futures = [pool.submit(question(name, number)) for number, name in enumerate(names)]
+    for number, (name, future) in enumerate(zip(names, futures)):
+        response = future.result(timeout=2)
+        assert response[:2] == struct.pack("!H", number)
+        assert name.split(".")[0].encode() in response
+    assert pool.connects == 1 and server.connections == 1
+    server.close()
+
+
+def test_query_resent_on_new_connection_after_close(tcp_pool):
+    def close_first(connection, number):
+        query = read_frame(connection)
+        if number == 1:
+            return  # coupure de l'amont avec une requête en cours
+        connection.sendall(framed(answer(query)))
+        read_frame(connection)
+
+    server = PipelineServer(behaviour=close_first)
+    pool = tcp_pool(server, retries=1)
+    response = pool.query(question("retry.example.com", 0x0707))
+    assert response[:2] == b"\x07\x07"
+    assert pool.connects == 2 and pool.retransmissions == 1
+    server.close()
+
+
+def test_idle_connection_released(tcp_pool):
+    server = PipelineServer()
+    pool = tcp_pool(server, idle_timeout=0.1)
+    pool.query(question("idle.example.com", 1))
+    connection = pool.sockets[0]
+    deadline = time.perf_counter() + 2
+    while connection.sock is not None and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert connection.sock is None
+    pool.query(question("idle.example.com", 2))
+    assert pool.connects == 2
+    server.close()
+
+
+@pytest.fixture
+def client_connection(monkeypatch):
+    """Connexion cliente servie par handle_dns_request_tcp ; l'amont est remplacé par resolve()."""
+    pytest.importorskip("elasticsearch")
+    import proxy
+
+    delays = {"slow.example.com": 0.2}
+
+    def resolve(data, use_tcp=False):
+        name = proxy.decode_dns_query(data)[2][0]
+        time.sleep(delays.get(name, 0))
+        return answer(data)
+
+    monkeypatch.setattr(proxy, "resolve", resolve)
+    monkeypatch.setattr(proxy, "log_exchange", lambda *args: None)
+    monkeypatch.setattr(proxy, "submit_detection", lambda *args: None)
+    monkeypatch.setattr(proxy, "blocklist", None)
+    monkeypatch.setattr(proxy, "rate_limiter", None)
+    monkeypatch.setattr(proxy, "query_capture", None)
+    client, served = socket.socketpair()
+    client.settimeout(2)
+    handler = threading.Thread(target=proxy.handle_dns_request_tcp, args=(served, ("192.0.2.1", 40000)))
+    handler.start()
+    yield client
+    client.close()
+    handler.join(timeout=2)
+
+
+def test_client_pipeline_answered_as_resolved(client_connection):
+    client_connection.sendall(framed(question("slow.example.com", 1)) + framed(question("fast.example.com", 2)))
+    first, second = read_frame(client_connection), read_frame(client_connection)
+    assert (first[:2], second[:2]) == (b"\x00\x02", b"\x00\x01")
+
+
+def test_client_connection_kept_open_between_queries(client_connection):
+    for number in range(3):
+        client_connection.sendall(framed(question("fast.example.com", number)))
+        assert read_frame(client_connection)[:2] == struct.pack("!H", number)
+    client_connection.shutdown(socket.SHUT_WR)
+    assert client_connection.recv(1) == b""  # fermée par le proxy une fois le client parti
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+import topk
+from sketch import SpaceSaving
+from topk import HeavyHitters, SlidingTopK
+
+NOW = 1_700_000_000.0
+
+
+def zipf_stream(count, items=200, seed=3):
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, items + 1)]
+    return rng.choices([f"item{rank}" for rank in range(1, items + 1)], weights=weights, k=count)
+
+
+def test_space_saving_bounds_true_counts():
+    stream = zipf_stream(5000)
+    table = SpaceSaving(capacity=20)
+    for item in stream:
+        table.add(item)
+    assert len(table.counters) == 20 and table.total == 5000
+    for item, count, error in table.top(5):
+        true = stream.count(item)
+        assert count - error <= true <= count
+    assert [item for item, _count, _error in table.top(3)] == ["item1", "item2", "item3"]
+
+
+def test_space_saving_tracks_every_frequent_item():
+    stream = zipf_stream(5000, seed=11)
+    capacity = 25
+    table = SpaceSaving(capacity)
+    for item in stream:
+        table.add(item)
+    frequent = {item for item in set(stream) if stream.count(item) > len(stream) / capacity}
+    assert frequent <= set(table.counters)
+
+
+def test_space_saving_merge_adds_counts():
+    left, right = SpaceSaving(4), SpaceSaving(4)
+    for item in "aab":
+        left.add(item)
+    for item in "abcc":
+        right.add(item)
+    left.merge(right)
+    assert left.total == 7
+    assert left.top(3) == [("a", 3, 0), ("b", 2, 0), ("c", 2, 0)]
+
+
+def test_window_only_merges_recent_slots():
+    table = SlidingTopK(capacity=10, slot=10, history=60)
+    table.add("old", NOW - 50)
+    table.add("recent", NOW - 5)
+    table.add("recent", NOW)
+    assert [item for item, _count, _error in table.window(20, NOW).top(5)] == ["recent"]
+    assert table.window(60, NOW).total == 3
+
+
+def test_expired_slots_dropped():
+    table = SlidingTopK(capacity=10, slot=10, history=30)
+    for offset in range(0, 100, 10):
+        table.add("name", NOW + offset)
+    assert len(table.ring) == 3
+
+
+@pytest.fixture
+def hitters():
+    tracker = HeavyHitters(capacity=50, slot=10, history=300)
+    for number in range(30):
+        client = "192.0.2.1" if number % 3 else "192.0.2.2"
+        tracker.record(f"n{number % 4}.example.com", "example.com", client, 16 if number % 2 else 1, NOW)
+    return tracker
+
+
+def test_query_tables(hitters):
+    clients = hitters.query("clients", window=60, k=1, now=NOW)
+    assert clients["total"] == 30
+    assert clients["top"] == [{"key": "192.0.2.1", "count": 20, "error": 0}]
+    qtypes = hitters.query("client_qtypes", k=10, now=NOW)
+    assert {entry["key"] for entry in qtypes["top"]} == {"192.0.2.1 1", "192.0.2.1 16", "192.0.2.2 1", "192.0.2.2 16"}
+    assert hitters.query("parents", window=10_000, now=NOW)["window"] == 300
+
+
+def test_endpoint_parameters(hitters, monkeypatch):
+    monkeypatch.setattr(topk.time, "time", lambda: NOW)
+    handle = topk.endpoint(hitters)
+    result = handle({"table": "qnames", "window": "60", "k": "2"})
+    assert len(result["top"]) == 2
+    with pytest.raises(ValueError, match="Unknown top-k table"):
+        handle({"table": "servers"})
+    with pytest.raises(ValueError, match="disabled"):
+        topk.endpoint(None)({})
+
+
+def test_combine_sums_workers():
+    first = {"table": "clients", "window": 60, "total": 10, "top": [{"key": "a", "count": 6, "error": 0}]}
+    second = {"table": "clients", "window": 60, "total": 8,
+              "top": [{"key": "b", "count": 5, "error": 1}, {"key": "a", "count": 3, "error": 0}]}
+    combined = topk.combine([first, second], k=2)
+    assert combined["total"] == 18
+    assert combined["top"] == [{"key": "a", "count": 9, "error": 0}, {"key": "b", "count": 5, "error": 1}]
@@ -0,0 +1,216 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import upstream
+from upstream import UpstreamPool
+
+
+def make_query(name, transaction_id):
+    labels = b"".join(bytes([len(label)]) + label.encode() for label in name.split("."))
+    return struct.pack("!6H", transaction_id, 0x0100, 1, 0, 0, 0) + labels + b"\x00\x00\x01\x00\x01"
+
+
+class Responder:
+    """Résolveur UDP local : renvoie chaque requête avec QR positionné, sauf si silent."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        self.silent = False
+        self.tamper = None  # fonction appliquée à la réponse avant envoi
+        self.queries = []  # (port source, identifiant amont)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            self.queries.append((address[1], int.from_bytes(data[:2], "big")))
+            if self.silent:
+                continue
+            response = data[:2] + b"\x81\x80" + data[4:]
+            if self.tamper is not None:
+                response = self.tamper(response)
+            self.sock.sendto(response, address)
+
+    def wait(self, count, timeout=2.0):
+        deadline = time.perf_counter() + timeout  # monotonic est figé par certains tests
+        while len(self.queries) < count and time.perf_counter() < deadline:
+            time.sleep(0.005)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def responder():
+    server = Responder()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def make_pool(responder):
+    pools = []
+
+    def factory(**kwargs):
+        kwargs.setdefault("size", 1)
+        kwargs.setdefault("timeout", 0.2)
+        pool = UpstreamPool("127.0.0.1", responder.port, **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield factory
+    for pool in pools:
+        pool.close()
+
+
+def test_restores_original_transaction_id(make_pool, responder):
+    pool = make_pool()
+    response = pool.query(make_query("example.com", 0xBEEF))
+    assert response[:2] == b"\xbe\xef"
+    assert response[2:4] == b"\x81\x80"
+
+
+def test_upstream_ids_come_from_secrets(make_pool, responder, monkeypatch):
+    drawn = []
+
+    def randbits(bits):
+        drawn.append(bits)
+        return 0x4242
+
+    monkeypatch.setattr(upstream.secrets, "randbits", randbits)
+    monkeypatch.setattr(upstream.random, "getrandbits", lambda bits: pytest.fail("random used for IDs"))
+    pool = make_pool()
+    pool.query(make_query("example.com", 1))
+    assert drawn == [16]
+    assert responder.queries[0][1] == 0x4242
+
+
+def test_rejects_answer_to_another_question(make_pool, responder):
+    responder.tamper = lambda response: response.replace(b"\x07example", b"\x07exbmple")
+    pool = make_pool(retries=0)
+    with pytest.raises(TimeoutError):
+        pool.query(make_query("example.com", 7))
+
+
+def test_retransmits_then_times_out(make_pool, responder):
+    responder.silent = True
+    pool = make_pool(timeout=0.05, retries=2)
+    with pytest.raises(TimeoutError):
+        pool.query(make_query("example.com", 9))
+    assert len(responder.queries) == 3
+    assert pool.retransmissions == 2
+    assert pool.timeouts == 1
+    assert not pool.pending
+
+
+def test_socket_renewal_changes_source_port(make_pool, responder, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    pool = make_pool(socket_lifetime=10.0)
+    first = pool.sockets[0]
+    pool.query(make_query("example.com", 1))
+    now[0] += 20.0
+    pool.query(make_query("example.com", 2))
+    assert pool.renewals == 1
+    assert pool.sockets[0] is not first
+    assert responder.queries[0][0] != responder.queries[1][0]
+
+
+def test_renewal_releases_old_socket_thread(make_pool, responder, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    pool = make_pool(socket_lifetime=10.0, timeout=0.01, retries=0)
+    pool.query(make_query("example.com", 1))
+    baseline = threading.active_count()
+    for transaction_id in range(2, 12):
+        now[0] += 20.0
+        pool.query(make_query("example.com", transaction_id))
+    assert pool.renewals == 10
+    deadline = time.perf_counter() + 2
+    while threading.active_count() > baseline and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert threading.active_count() == baseline
+
+
+def test_late_answer_accepted_only_on_its_own_socket(make_pool, responder, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    responder.silent = True
+    pool = make_pool(socket_lifetime=10.0)
+    future = pool.submit(make_query("example.com", 0x0101))
+    old = pool.sockets[0]
+    now[0] += 20.0
+    pool.submit(make_query("example.org", 0x0202))
+    new = pool.sockets[0]
+    assert new is not old
+    responder.wait(2)
+
+    _port, upstream_id = responder.queries[0]
+    request = make_query("example.com", upstream_id)
+    reply = request[:2] + b"\x81\x80" + request[4:]
+    # Même index et même identifiant, mais reçue sur la nouvelle socket : ignorée
+    responder.sock.sendto(reply, new.getsockname())
+    time.sleep(0.1)
+    assert not future.done()
+    # Réponse tardive sur l'ancienne socket, pas encore fermée : acceptée
+    responder.sock.sendto(reply, old.getsockname())
+    assert future.result(timeout=2)[:2] == b"\x01\x01"
+
+
+def test_tcp_pool_never_renews():
+    pool = upstream.TCPUpstreamPool("127.0.0.1", 9, size=1)
+    try:
+        assert pool.renew_at == [float("inf")]
+    finally:
+        pool.close()
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("8.8.8.8", ("8.8.8.8", 53)),
+        ("127.0.0.1:5353", ("127.0.0.1", 5353)),
+        ("dns.example:853", ("dns.example", 853)),
+        ("[::1]:53", ("::1", 53)),
+        ("[2001:db8::53]", ("2001:db8::53", 53)),
+        ("2001:db8::53", ("2001:db8::53", 53)),
+        (" 192.0.2.1:54 ", ("192.0.2.1", 54)),
+    ],
+)
+def test_parse_address(value, expected):
+    assert upstream.parse_address(value) == expected
+
+
+@pytest.mark.parametrize("value", ["[::1", "[::1]53", "host:port"])
+def test_parse_address_rejects_malformed(value):
+    with pytest.raises(ValueError):
+        upstream.parse_address(value)
+
+
+def test_pool_reaches_ipv6_upstream():
+    try:
+        server = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        server.bind(("::1", 0))
+    except OSError:
+        pytest.skip("no IPv6 loopback")
+    server.settimeout(2)
+    host, port = upstream.parse_address(f"[::1]:{server.getsockname()[1]}")
+    pool = UpstreamPool(host, port, size=1, timeout=1.0)
+    try:
+        future = pool.submit(make_query("example.com", 0x0606))
+        data, address = server.recvfrom(512)
+        server.sendto(data[:2] + b"\x81\x80" + data[4:], address)
+        assert future.result(timeout=2)[:2] == b"\x06\x06"
+    finally:
+        pool.close()
+        server.close()
@@ -0,0 +1,152 @@
+from concurrent.futures import Future
+
+import pytest
+
+import upstream
+from upstream import UpstreamSet
+
+
+class ScriptedPool:
+    """Pool amont dont les requêtes restent en attente jusqu'à answer() ou fail()."""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, data):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def answer(self, response=b"answer"):
+        self.futures.pop(0).set_result(response)
+
+    def fail(self, error=TimeoutError("no answer")):
+        self.futures.pop(0).set_exception(error)
+
+
+@pytest.fixture
+def resolvers():
+    """Trois résolveurs aux pools scriptés, sans copie différée par défaut."""
+    upstreams = UpstreamSet([("192.0.2.1", 53), ("192.0.2.2", 53), ("192.0.2.3", 53)], hedge_budget=0)
+    for server in upstreams.upstreams:
+        server.udp = ScriptedPool()
+    return upstreams
+
+
+def pools(upstreams):
+    return [server.udp for server in upstreams.upstreams]
+
+
+def test_fastest_resolver_chosen(resolvers):
+    for server, srtt in zip(resolvers.upstreams, (0.030, 0.005, 0.050)):
+        server.srtt = srtt
+    future = resolvers.submit(b"query")
+    first, second, third = pools(resolvers)
+    assert (len(first.futures), len(second.futures), len(third.futures)) == (0, 1, 0)
+    second.answer()
+    assert future.result(timeout=1) == b"answer"
+    assert resolvers.upstreams[1].queries == 1
+
+
+def test_failure_moves_to_next_resolver(resolvers):
+    resolvers.upstreams[0].srtt = 0.001
+    resolvers.upstreams[1].srtt = 0.002
+    resolvers.upstreams[2].srtt = 0.003
+    future = resolvers.submit(b"query")
+    first, second, _third = pools(resolvers)
+    first.fail()
+    assert not future.done()
+    second.answer(b"from second")
+    assert future.result(timeout=1) == b"from second"
+    assert resolvers.upstreams[0].failures == 1 and resolvers.upstreams[0].failure_rate > 0
+
+
+def test_error_raised_when_every_resolver_fails(resolvers):
+    future = resolvers.submit(b"query")
+    for pool in pools(resolvers):
+        pool.fail(ConnectionError("refused"))
+    with pytest.raises(ConnectionError):
+        future.result(timeout=1)
+
+
+def test_circuit_opens_then_allows_one_probe():
+    server = upstream.Upstream("192.0.2.9", 53)
+    for _ in range(upstream.CIRCUIT_FAILURES):
+        server.record_failure(now=100.0)
+    assert server.circuit_open(100.0)
+    reopened = 100.0 + upstream.CIRCUIT_OPEN_TIME
+    assert not server.circuit_open(reopened)
+    server.probing = True  # requête de test en cours : les autres restent à l'écart
+    assert server.circuit_open(reopened)
+    server.record_success(0.01)
+    assert not server.circuit_open(reopened) and server.consecutive_failures == 0
+
+
+def test_open_circuit_skipped_in_ranking(resolvers, monkeypatch):
+    monkeypatch.setattr(upstream, "CIRCUIT_FAILURES", 2)
+    broken = resolvers.upstreams[0]
+    broken.srtt = 0.001
+    for _ in range(2):
+        broken.record_failure(upstream.time.monotonic())
+    assert broken not in resolvers.ranked(upstream.time.monotonic())
+    resolvers.submit(b"query")
+    assert pools(resolvers)[0].futures == []
+
+
+def test_srtt_is_smoothed():
+    server = upstream.Upstream("192.0.2.9", 53)
+    server.record_success(0.100)
+    server.record_success(0.020)
+    assert server.srtt == pytest.approx(0.100 + upstream.RTT_ALPHA * (0.020 - 0.100))
+    assert server.p95 == 0.100
+
+
+def test_slow_answer_hedged_to_second_resolver(resolvers):
+    resolvers.hedge_budget = 1.0
+    primary = resolvers.upstreams[0]
+    primary.srtt, primary.p95 = 0.001, 0.001  # copie différée après HEDGE_MIN_DELAY
+    resolvers.upstreams[1].srtt = 0.002
+    resolvers.upstreams[2].srtt = 0.003
+    future = resolvers.submit(b"query")
+    first, second, _third = pools(resolvers)
+    deadline = upstream.time.monotonic() + 2
+    while not second.futures and upstream.time.monotonic() < deadline:
+        upstream.time.sleep(0.005)
+    second.answer(b"hedged")
+    assert future.result(timeout=1) == b"hedged"
+    first.answer(b"late")
+    assert future.result() == b"hedged"
+    assert (resolvers.hedges, resolvers.upstreams[1].hedge_wins) == (1, 1)
+
+
+def test_p95_recomputed_every_interval(monkeypatch):
+    server = upstream.Upstream("192.0.2.9", 53)
+    for _ in range(upstream.RTT_SAMPLES):
+        server.record_success(0.010)
+    sorts = []
+    monkeypatch.setattr(upstream, "sorted", lambda values: sorts.append(1) or sorted(values), raising=False)
+    for _ in range(2 * upstream.P95_INTERVAL):
+        server.record_success(0.500)
+    assert len(sorts) == 2
+    assert server.p95 == 0.500
+
+
+def test_hedge_budget_refilled_per_query_up_to_burst():
+    single = UpstreamSet([("192.0.2.1", 53)], hedge_budget=0.1)
+    single.upstreams[0].udp = ScriptedPool()
+    for _ in range(5):
+        single.submit(b"query")
+    assert single.hedge_tokens == pytest.approx(0.5)
+    for _ in range(1000):
+        single.submit(b"query")
+    assert single.hedge_tokens == upstream.HEDGE_BURST
+
+
+def test_hedge_spends_one_token(resolvers):
+    query = upstream.HedgedQuery(b"query", False, list(resolvers.upstreams))
+    resolvers._launch(query)
+    resolvers.hedge_tokens = 1.5
+    resolvers._hedge(query)
+    assert (resolvers.hedges, resolvers.hedge_tokens, query.launched) == (1, 0.5, 2)
+    resolvers._hedge(query)
+    assert (resolvers.hedges, query.launched) == (1, 2)
@@ -0,0 +1,96 @@
+import atexit
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+import pytest
+
+pytest.importorskip("elasticsearch")
+
+import detect  # noqa: E402
+import proxy  # noqa: E402
+
+WINDOW_START = 1_700_000_040.0  # début d'une fenêtre de 60 s
+
+
+@pytest.fixture
+def aggregator(monkeypatch):
+    """Vue fusionnée vide, sans score lexical ; les alertes levées sont relevées."""
+    alerts = []
+    monkeypatch.setattr(detect, "detector_state", detect.DetectorState())
+    monkeypatch.setattr(detect, "lexical_scorer", None)
+    monkeypatch.setattr(detect, "alert_handler", lambda **alert: alerts.append(alert))
+    return alerts
+
+
+def worker(batches, names, client="192.0.2.10", domain="tunnel.example"):
+    """Un worker qui a vu `names` sous `domain` et envoie son lot dans `batches`."""
+    recorder = detect.DeltaRecorder(batches, interval=3600)
+    for name in names:
+        recorder.record(domain, name, f"{name}.{domain}", 1, client, WINDOW_START)
+    recorder.flush()
+    return recorder
+
+
+def test_alert_raised_only_on_merged_view(aggregator):
+    batches = queue.Queue()
+    worker(batches, [f"a{number}" for number in range(30)])
+    worker(batches, [f"b{number}" for number in range(30)], client="192.0.2.11")
+
+    detect.merge_deltas(*batches.get_nowait())
+    assert aggregator == []  # 30 noms : sous le seuil dans chaque worker
+    detect.merge_deltas(*batches.get_nowait())
+    (alert,) = aggregator
+    assert alert["public_suffix"] == "tunnel.example"
+    assert alert["unique_count"] == 60
+    assert alert["client_address"] == "192.0.2.11"
+    assert alert["additional_info"]["client_unique_names"] == 30
+
+
+def test_names_seen_by_several_workers_counted_once(aggregator):
+    batches = queue.Queue()
+    shared = [f"s{number}" for number in range(40)]
+    worker(batches, shared)
+    worker(batches, shared)
+    while not batches.empty():
+        detect.merge_deltas(*batches.get_nowait())
+    assert aggregator == []
+    shard = detect.detector_state.shard("tunnel.example")
+    stats = shard.window(int(WINDOW_START // detect.WINDOW_SIZE)).stats["tunnel.example"]
+    assert (stats.count, len(stats.unique_subdomains)) == (80, 40)
+
+
+def test_flush_resets_worker_counters(aggregator):
+    batches = queue.Queue()
+    recorder = worker(batches, ["a", "b"])
+    assert recorder.domains == {} and recorder.clients == {}
+    recorder.flush()
+    assert batches.qsize() == 1  # rien de nouveau : pas de lot vide
+
+
+def test_full_aggregation_queue_drops_batch(aggregator):
+    batches = queue.Queue(maxsize=1)
+    worker(batches, ["a"])
+    recorder = worker(batches, ["b"])
+    assert recorder.dropped_batches == 1
+
+
+def test_worker_flushes_on_sigterm(tmp_path, monkeypatch):
+    monkeypatch.setattr(proxy, "METRICS_PORT", 0)
+    monkeypatch.setattr(proxy, "response_cache", None)
+    marker = tmp_path / "flushed"
+
+    def serve():
+        # Un handler atexit enregistré par le worker, comme le vidage des logs ou du cache
+        atexit.register(marker.write_text, "flushed")
+        os.kill(os.getpid(), signal.SIGTERM)
+        time.sleep(5)
+
+    context = multiprocessing.get_context("fork")
+    process = context.Process(target=proxy.run_worker, args=(0, context.Queue(), context.Queue(), serve))
+    process.start()
+    process.join(timeout=10)
+    assert process.exitcode == 0
+    assert marker.read_text() == "flushed"
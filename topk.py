@@ -0,0 +1,191 @@
+"""
+Tables top-k glissantes des noms, domaines parents, clients et couples
+(client, type de requête) les plus actifs, tenues par detect.py.
+
+Chaque table est un anneau de tranches de TOPK_SLOT secondes, chacune étant
+une esquisse Space-Saving de TOPK_CAPACITY entrées (sketch.py) : la mémoire
+est bornée quel que soit le trafic. Une requête sur les N dernières secondes
+fusionne les tranches concernées ; les comptes sont des majorants, avec leur
+erreur maximale.
+
+Les tables sont servies en JSON par l'endpoint de métriques :
+
+    GET /topk?table=clients&window=60&k=20
+
+et affichées par ce module en ligne de commande (plusieurs --url pour
+additionner les workers du mode --workers, qui ont chacun leurs tables) :
+
+    python3 topk.py --url http://127.0.0.1:9153 --table qnames --window 300
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from sketch import SpaceSaving
+
+TOPK = os.getenv("TOPK", "on") == "on"
+TOPK_CAPACITY = int(
+    os.getenv("TOPK_CAPACITY", "1000")
+)  # entrées suivies par table et par tranche
+TOPK_SLOT = int(os.getenv("TOPK_SLOT", "10"))  # durée d'une tranche (s)
+TOPK_HISTORY = int(
+    os.getenv("TOPK_HISTORY", "900")
+)  # fenêtre maximale interrogeable (s)
+
+TABLES = ("qnames", "parents", "clients", "client_qtypes")
+DEFAULT_WINDOW = 60
+DEFAULT_K = 20
+
+
+class SlidingTopK:
+    """Space-Saving sur une fenêtre glissante, par tranches de slot secondes."""
+
+    def __init__(self, capacity=TOPK_CAPACITY, slot=TOPK_SLOT, history=TOPK_HISTORY):
+        self.capacity = capacity
+        self.slot = slot
+        self.slots = max(1, -(-history // slot))
+        self.ring = {}  # numéro de tranche -> SpaceSaving
+
+    def add(self, item, timestamp):
+        number = int(timestamp // self.slot)
+        table = self.ring.get(number)
+        if table is None:
+            table = self.ring[number] = SpaceSaving(self.capacity)
+            for old in [old for old in self.ring if old <= number - self.slots]:
+                del self.ring[old]
+        table.add(item)
+
+    def window(self, seconds, now):
+        """Fusion des tranches couvrant les `seconds` dernières secondes."""
+        last = int(now // self.slot)
+        first = last - max(1, -(-seconds // self.slot)) + 1
+        merged = SpaceSaving(self.capacity)
+        for number, table in self.ring.items():
+            if first <= number <= last:
+                merged.merge(table)
+        return merged
+
+
+class HeavyHitters:
+    def __init__(self, capacity=TOPK_CAPACITY, slot=TOPK_SLOT, history=TOPK_HISTORY):
+        self.lock = threading.Lock()
+        self.history = history
+        self.tables = {name: SlidingTopK(capacity, slot, history) for name in TABLES}
+
+    def record(self, qname, parent_domain, client_address, query_type, timestamp):
+        client = str(client_address)
+        with self.lock:
+            self.tables["qnames"].add(qname, timestamp)
+            self.tables["parents"].add(parent_domain, timestamp)
+            self.tables["clients"].add(client, timestamp)
+            self.tables["client_qtypes"].add(f"{client} {query_type}", timestamp)
+
+    def query(self, table, window=DEFAULT_WINDOW, k=DEFAULT_K, now=None):
+        if table not in self.tables:
+            raise ValueError(
+                f"Unknown top-k table {table!r}, expected one of {', '.join(TABLES)}"
+            )
+        window = min(window, self.history)
+        now = time.time() if now is None else now
+        with self.lock:
+            merged = self.tables[table].window(window, now)
+        return {
+            "table": table,
+            "window": window,
+            "total": merged.total,
+            "top": [
+                {"key": key, "count": count, "error": error}
+                for key, count, error in merged.top(k)
+            ],
+        }
+
+
+def create_heavy_hitters():
+    """HeavyHitters configuré par l'environnement, ou None si TOPK=off."""
+    return HeavyHitters() if TOPK else None
+
+
+def endpoint(tracker):
+    """Gestionnaire de GET /topk pour metrics.register_endpoint."""
+
+    def handle(params):
+        if tracker is None:
+            raise ValueError("Top-k tables are disabled (TOPK=off)")
+        return tracker.query(
+            params.get("table", "clients"),
+            window=int(params.get("window", DEFAULT_WINDOW)),
+            k=int(params.get("k", DEFAULT_K)),
+        )
+
+    return handle
+
+
+def fetch(url, table, window, k):
+    query = urllib.parse.urlencode({"table": table, "window": window, "k": k})
+    with urllib.request.urlopen(
+        f"{url.rstrip('/')}/topk?{query}", timeout=5
+    ) as response:
+        return json.load(response)
+
+
+def combine(results, k):
+    """Additionne les tables de plusieurs processus."""
+    counts = {}
+    for result in results:
+        for entry in result["top"]:
+            count, error = counts.get(entry["key"], (0, 0))
+            counts[entry["key"]] = (count + entry["count"], error + entry["error"])
+    top = sorted(counts.items(), key=lambda item: item[1][0], reverse=True)[:k]
+    return {
+        "table": results[0]["table"],
+        "window": results[0]["window"],
+        "total": sum(result["total"] for result in results),
+        "top": [
+            {"key": key, "count": count, "error": error} for key, (count, error) in top
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--url",
+        action="append",
+        help="endpoint de métriques (répétable), défaut http://127.0.0.1:9153",
+    )
+    parser.add_argument("--table", choices=TABLES, default="clients")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="secondes")
+    parser.add_argument("-k", type=int, default=DEFAULT_K)
+    parser.add_argument("--json", action="store_true", help="sortie JSON brute")
+    args = parser.parse_args()
+
+    # Chaque processus ne renvoie que son top k : on en demande plus pour la somme
+    fetch_k = args.k * 4 if args.url and len(args.url) > 1 else args.k
+    result = combine(
+        [
+            fetch(url, args.table, args.window, fetch_k)
+            for url in args.url or ["http://127.0.0.1:9153"]
+        ],
+        args.k,
+    )
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    print(
+        f"Top {args.k} {result['table']} over {result['window']}s ({result['total']} queries)"
+    )
+    for entry in result["top"]:
+        share = entry["count"] / result["total"] if result["total"] else 0
+        bound = f" (±{entry['error']})" if entry["error"] else ""
+        print(f"{entry['count']:>10}{bound:>10}  {share:6.1%}  {entry['key']}")
+
+
+if __name__ == "__main__":
+    main()
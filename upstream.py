@@ -0,0 +1,731 @@
+"""
+Pool de sockets UDP persistants vers le résolveur amont.
+
+Chaque socket est connectée au résolveur et partagée par toutes les requêtes en
+cours : l'identifiant de transaction est réécrit à l'envoi puis restauré à la
+réception, ce qui permet de retrouver la requête d'origine. Un thread de
+réception par socket et un thread de minuterie gèrent les délais d'attente et
+les retransmissions.
+
+TCPUpstreamPool applique le même principe à quelques connexions TCP
+persistantes (RFC 7766) : les requêtes y sont pipelinées et les réponses
+peuvent revenir dans n'importe quel ordre.
+
+UpstreamSet répartit les requêtes entre plusieurs résolveurs : chacun a son
+RTT lissé, son taux d'échec et un disjoncteur. La requête part vers le plus
+rapide des résolveurs sains, et une copie est envoyée au suivant si la réponse
+tarde plus que le p95 de ses RTT (dans la limite de HEDGE_BUDGET et HEDGE_BURST).
+"""
+
+import heapq
+import itertools
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+
+BUFFER_SIZE = 4096
+POOL_SIZE = os.cpu_count() or 1  # une socket par coeur
+QUERY_TIMEOUT = 1.0  # délai par tentative, en secondes
+QUERY_RETRIES = 2  # retransmissions avant d'abandonner
+# Durée de vie moyenne d'une socket UDP : elle est ensuite remplacée pour changer de
+# port source, qui s'ajoute aux 16 bits d'identifiant contre l'empoisonnement du cache.
+SOCKET_LIFETIME = 60.0
+TCP_POOL_SIZE = 2  # connexions TCP persistantes vers l'amont
+TCP_QUERY_TIMEOUT = 5.0
+TCP_QUERY_RETRIES = (
+    1  # nouvel envoi (sur une nouvelle connexion si besoin) avant d'abandonner
+)
+TCP_IDLE_TIMEOUT = 30.0  # fermeture d'une connexion amont inactive, en secondes
+
+# Sélection entre plusieurs résolveurs
+RTT_ALPHA = 0.125  # lissage du RTT (RFC 6298)
+FAILURE_ALPHA = 0.05  # lissage du taux d'échec
+FAILURE_PENALTY = 10  # un taux d'échec de 10 % double le score d'un résolveur
+RTT_SAMPLES = 64  # derniers RTT conservés pour le p95
+P95_INTERVAL = 16  # réponses entre deux recalculs du p95
+HEDGE_DEFAULT_DELAY = 0.1  # avant d'avoir assez d'échantillons, en secondes
+HEDGE_MIN_DELAY = 0.005
+HEDGE_MAX_DELAY = 1.0
+HEDGE_BUDGET = 0.1  # part maximale des requêtes dupliquées vers un second résolveur
+# Le budget est un seau de jetons rechargé de HEDGE_BUDGET par requête : pas plus
+# de HEDGE_BURST copies d'affilée, même après une longue période sans copie.
+HEDGE_BURST = 10
+CIRCUIT_FAILURES = 5  # échecs consécutifs avant d'ouvrir le disjoncteur
+CIRCUIT_OPEN_TIME = 10.0  # secondes avant une requête de test
+
+
+def parse_address(value, default_port=53):
+    """
+    Adresse HOST, HOST:PORT, [IPV6] ou [IPV6]:PORT -> (hôte, port). Une adresse
+    IPv6 sans crochets (::1) garde default_port.
+    """
+    value = value.strip()
+    if value.startswith("["):
+        host, bracket, rest = value[1:].partition("]")
+        if not bracket or (rest and not rest.startswith(":")):
+            raise ValueError(f"Invalid address {value!r}")
+        return host, int(rest[1:]) if rest else default_port
+    if value.count(":") == 1:
+        host, _, port = value.partition(":")
+        return host, int(port)
+    return value, default_port
+
+
+def recv_exact(sock, length):
+    """Lit exactement length octets ; ConnectionError si la connexion se ferme avant."""
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError(
+                f"Connection closed after {received} of {length} bytes"
+            )
+        received += count
+    return bytes(buffer)
+
+
+def question_end(data):
+    """Retourne l'index de fin de la section question (ou None si illisible)."""
+    index = 12
+    try:
+        while data[index] != 0:
+            if data[index] & 0xC0:
+                return None
+            index += data[index] + 1
+    except IndexError:
+        return None
+    return index + 5
+
+
+class PendingQuery:
+    __slots__ = ("original_id", "packet", "question", "future", "attempt", "sock")
+
+    def __init__(self, original_id, packet, question, future, sock):
+        self.original_id = original_id
+        self.packet = packet
+        self.question = question
+        self.future = future
+        self.attempt = 0
+        self.sock = sock
+
+
+class UpstreamPool:
+    """
+    Multiplexe les requêtes DNS sur un petit nombre de sockets UDP persistantes.
+
+    Les identifiants de transaction amont sont tirés par secrets, et chaque socket
+    est remplacée au bout de SOCKET_LIFETIME secondes environ (port source
+    différent) ; l'ancienne reçoit encore les réponses en retard puis est fermée.
+
+    submit() retourne un concurrent.futures.Future, utilisable aussi bien depuis
+    un thread (future.result()) que depuis asyncio (asyncio.wrap_future()).
+    """
+
+    def __init__(
+        self,
+        server,
+        port,
+        size=POOL_SIZE,
+        timeout=QUERY_TIMEOUT,
+        retries=QUERY_RETRIES,
+        socket_lifetime=SOCKET_LIFETIME,
+    ):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.socket_lifetime = socket_lifetime
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = {}  # (index de socket, id de transaction amont) -> PendingQuery
+        self.deadlines = []  # tas de (échéance, numéro, clé, tentative)
+        self.sequence = itertools.count()
+        self.next_socket = itertools.count()
+        self.closed = False
+        self.timeouts = 0
+        self.retransmissions = 0
+        self.renewals = 0
+
+        self.sockets = [self._open(index) for index in range(max(1, size))]
+        now = time.monotonic()
+        self.renew_at = [self._next_renewal(now) for _ in self.sockets]
+        threading.Thread(
+            target=self._timer_loop, daemon=True, name="upstream-timer"
+        ).start()
+
+    def _open(self, index):
+        sock = socket.socket(
+            socket.AF_INET6 if ":" in self.server else socket.AF_INET, socket.SOCK_DGRAM
+        )
+        sock.connect((self.server, self.port))
+        threading.Thread(
+            target=self._receive_loop,
+            args=(index, sock),
+            daemon=True,
+            name=f"upstream-recv-{index}",
+        ).start()
+        return sock
+
+    def _next_renewal(self, now):
+        if not self.socket_lifetime:
+            return float("inf")
+        # Échéances étalées pour ne pas remplacer toutes les sockets en même temps
+        return now + self.socket_lifetime * random.uniform(0.5, 1.5)
+
+    def _renew(self, index, now):
+        """Remplace la socket index par une nouvelle (nouveau port source) et retourne celle-ci."""
+        with self.lock:
+            if self.closed or self.renew_at[index] > now:
+                return self.sockets[index]  # déjà remplacée par un autre thread
+            self.renew_at[index] = self._next_renewal(now)
+        sock = self._open(index)
+        with self.lock:
+            old, self.sockets[index] = self.sockets[index], sock
+            self.renewals += 1
+        # Fermée une fois que les requêtes envoyées dessus ne peuvent plus recevoir de réponse
+        timer = threading.Timer(self.timeout * (self.retries + 1), self._retire, (old,))
+        timer.daemon = True
+        timer.start()
+        return sock
+
+    def _retire(self, sock):
+        # close() seul ne réveille pas le thread bloqué dans recv() : shutdown() d'abord
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _transmit(self, entry):
+        entry.sock.send(entry.packet)
+
+    def _allocate_id(self, index):
+        # Appelé sous self.lock
+        while True:
+            upstream_id = secrets.randbits(16)
+            if (index, upstream_id) not in self.pending:
+                return upstream_id
+
+    def submit(self, data):
+        """Envoie la requête et retourne un Future résolu avec la réponse (id d'origine restauré)."""
+        future = Future()
+        index = next(self.next_socket) % len(self.sockets)
+        now = time.monotonic()
+        sock = (
+            self.sockets[index]
+            if now < self.renew_at[index]
+            else self._renew(index, now)
+        )
+        qend = question_end(data)
+        question = data[12:qend] if qend else None
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("upstream pool is closed")
+            upstream_id = self._allocate_id(index)
+            packet = upstream_id.to_bytes(2, byteorder="big") + data[2:]
+            key = (index, upstream_id)
+            entry = PendingQuery(
+                int.from_bytes(data[:2], byteorder="big"),
+                packet,
+                question,
+                future,
+                sock,
+            )
+            self.pending[key] = entry
+            self._schedule(now, key, entry)
+
+        try:
+            self._transmit(entry)
+        except OSError:
+            # La minuterie se chargera de retransmettre.
+            pass
+        return future
+
+    def query(self, data):
+        """Version bloquante de submit()."""
+        return self.submit(data).result(timeout=self.timeout * (self.retries + 1) + 1)
+
+    def _schedule(self, now, key, entry):
+        # Appelé sous self.lock
+        heapq.heappush(
+            self.deadlines,
+            (now + self.timeout, next(self.sequence), key, entry.attempt),
+        )
+        self.wakeup.notify()
+
+    def _receive_loop(self, index, sock):
+        while not self.closed:
+            try:
+                response = sock.recv(BUFFER_SIZE)
+            except OSError:
+                if self.closed or sock.fileno() == -1:
+                    return  # pool fermé ou socket remplacée puis fermée
+                continue
+            if not response and sock is not self.sockets[index]:
+                return  # socket remplacée, réveillée par _retire()
+            self._deliver(index, response, sock)
+
+    def _deliver(self, index, response, sock):
+        if len(response) < 12:
+            return
+        key = (index, int.from_bytes(response[:2], byteorder="big"))
+        with self.lock:
+            entry = self.pending.get(key)
+            # La socket et la question doivent correspondre, sinon il s'agit d'une réponse tardive ou forgée.
+            if (
+                entry is None
+                or entry.sock is not sock
+                or (
+                    entry.question is not None
+                    and response[12 : 12 + len(entry.question)] != entry.question
+                )
+            ):
+                return
+            del self.pending[key]
+        if not entry.future.done():
+            entry.future.set_result(
+                entry.original_id.to_bytes(2, byteorder="big") + response[2:]
+            )
+
+    def _timer_loop(self):
+        while True:
+            resend = []
+            expired = []
+            with self.lock:
+                while not self.closed and not resend and not expired:
+                    if not self.deadlines:
+                        self.wakeup.wait()
+                        continue
+                    now = time.monotonic()
+                    # Traite toutes les échéances dépassées avant de renvoyer hors du verrou
+                    while self.deadlines and self.deadlines[0][0] <= now:
+                        _deadline, _seq, key, attempt = heapq.heappop(self.deadlines)
+                        entry = self.pending.get(key)
+                        if entry is None or entry.attempt != attempt:
+                            continue
+                        if entry.attempt >= self.retries:
+                            del self.pending[key]
+                            self.timeouts += 1
+                            expired.append(entry)
+                            continue
+                        entry.attempt += 1
+                        self.retransmissions += 1
+                        self._schedule(now, key, entry)
+                        resend.append(entry)
+                    if not resend and not expired and self.deadlines:
+                        self.wakeup.wait(self.deadlines[0][0] - now)
+                if self.closed:
+                    return
+            # Futures résolus hors du verrou : leurs callbacks peuvent soumettre à un autre pool
+            for entry in expired:
+                if not entry.future.done():
+                    entry.future.set_exception(
+                        TimeoutError(
+                            f"No answer from {self.server}:{self.port} after {entry.attempt + 1} attempts"
+                        )
+                    )
+            for entry in resend:
+                try:
+                    self._transmit(entry)
+                except OSError:
+                    pass
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify_all()
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for sock in self.sockets:
+            self._retire(sock)
+        for entry in pending:
+            if not entry.future.done():
+                entry.future.set_exception(RuntimeError("upstream pool closed"))
+
+
+class TCPConnection:
+    """Connexion TCP amont ouverte à la demande et rouverte après une coupure."""
+
+    __slots__ = ("index", "lock", "sock")
+
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.Lock()  # sérialise connexion et écritures
+        self.sock = None
+
+    def close(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+
+class TCPUpstreamPool(UpstreamPool):
+    """
+    Requêtes pipelinées sur quelques connexions TCP persistantes (RFC 7766).
+
+    Chaque message est préfixé par sa longueur sur deux octets ; un thread de
+    réception par connexion relit les réponses, dans l'ordre où l'amont les
+    envoie, et les rattache aux requêtes par identifiant de transaction.
+    """
+
+    def __init__(
+        self,
+        server,
+        port,
+        size=TCP_POOL_SIZE,
+        timeout=TCP_QUERY_TIMEOUT,
+        retries=TCP_QUERY_RETRIES,
+        idle_timeout=TCP_IDLE_TIMEOUT,
+    ):
+        self.idle_timeout = idle_timeout
+        self.connects = 0
+        # Les connexions inactives sont déjà refermées : pas de remplacement périodique
+        super().__init__(server, port, size, timeout, retries, socket_lifetime=0)
+
+    def _open(self, index):
+        # La connexion n'est établie qu'au premier envoi.
+        return TCPConnection(index)
+
+    def _retire(self, connection):
+        connection.close()
+
+    def _connect(self, connection):
+        # Appelé sous connection.lock
+        sock = socket.create_connection((self.server, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.idle_timeout)
+        connection.sock = sock
+        self.connects += 1
+        threading.Thread(
+            target=self._receive_loop,
+            args=(connection, sock),
+            daemon=True,
+            name=f"upstream-tcp-recv-{connection.index}",
+        ).start()
+        return sock
+
+    def _transmit(self, entry):
+        connection = entry.sock
+        frame = len(entry.packet).to_bytes(2, byteorder="big") + entry.packet
+        with connection.lock:
+            sock = connection.sock or self._connect(connection)
+            try:
+                sock.sendall(frame)
+            except OSError:
+                connection.close()
+                raise
+
+    def _receive_loop(self, connection, sock):
+        index = connection.index
+        try:
+            while not self.closed:
+                try:
+                    length = int.from_bytes(recv_exact(sock, 2), byteorder="big")
+                except socket.timeout:
+                    with self.lock:
+                        busy = any(key[0] == index for key in self.pending)
+                    if busy:
+                        continue
+                    # Connexion inactive : on la rend, la prochaine requête en rouvrira une.
+                    break
+                self._deliver(index, recv_exact(sock, length), connection)
+        except OSError:
+            pass
+        with connection.lock:
+            if connection.sock is sock:
+                connection.close()
+        if not self.closed:
+            self._connection_lost(index)
+
+    def _connection_lost(self, index):
+        """Renvoie les requêtes en cours de la connexion perdue, ou les fait échouer."""
+        now = time.monotonic()
+        resend = []
+        failed = []
+        with self.lock:
+            for key, entry in list(self.pending.items()):
+                if key[0] != index:
+                    continue
+                if entry.attempt >= self.retries:
+                    del self.pending[key]
+                    failed.append(entry)
+                    continue
+                entry.attempt += 1
+                self.retransmissions += 1
+                self._schedule(now, key, entry)
+                resend.append(entry)
+        for entry in failed:
+            if not entry.future.done():
+                entry.future.set_exception(
+                    ConnectionError(f"Connection to {self.server}:{self.port} lost")
+                )
+        for entry in resend:
+            try:
+                self._transmit(entry)
+            except OSError:
+                pass
+
+
+class Scheduler:
+    """Un thread qui exécute des fonctions après un délai (tas d'échéances)."""
+
+    def __init__(self, name="upstream-scheduler"):
+        self.condition = threading.Condition()
+        self.calls = []  # tas de (échéance, numéro, fonction, arguments)
+        self.sequence = itertools.count()
+        threading.Thread(target=self._run, daemon=True, name=name).start()
+
+    def call_later(self, delay, function, *args):
+        with self.condition:
+            heapq.heappush(
+                self.calls,
+                (time.monotonic() + delay, next(self.sequence), function, args),
+            )
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.calls or self.calls[0][0] > time.monotonic():
+                    self.condition.wait(
+                        self.calls[0][0] - time.monotonic() if self.calls else None
+                    )
+                _deadline, _seq, function, args = heapq.heappop(self.calls)
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"Upstream scheduler error : {e}")
+
+
+class Upstream:
+    """Un résolveur amont, ses pools UDP/TCP et ses statistiques de santé."""
+
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self.name = f"{server}:{port}"
+        self.udp = None
+        self.tcp = None
+        self.srtt = None
+        self.failure_rate = 0.0
+        self.samples = deque(maxlen=RTT_SAMPLES)
+        self.p95 = None  # recalculé toutes les P95_INTERVAL réponses
+        self.successes = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0  # disjoncteur ouvert jusqu'à cette date (monotonic)
+        self.probing = False
+        self.outstanding = 0
+        self.last_progress = (
+            0.0  # dernier envoi sur résolveur inactif ou dernière réponse
+        )
+        self.queries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def pool(self, use_tcp):
+        # Appelé sous UpstreamSet.lock
+        if use_tcp:
+            if self.tcp is None:
+                self.tcp = TCPUpstreamPool(self.server, self.port)
+            return self.tcp
+        if self.udp is None:
+            self.udp = UpstreamPool(self.server, self.port)
+        return self.udp
+
+    def score(self, now):
+        # Un résolveur jamais mesuré passe en premier pour obtenir un RTT ; un résolveur
+        # qui ne répond plus voit son score croître avec l'âge de ses requêtes en attente.
+        rtt = self.srtt or 0.0
+        if self.outstanding:
+            rtt = max(rtt, now - self.last_progress)
+        return rtt * (1 + FAILURE_PENALTY * self.failure_rate)
+
+    def hedge_delay(self):
+        if self.p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, self.p95))
+
+    def circuit_open(self, now):
+        return self.consecutive_failures >= CIRCUIT_FAILURES and (
+            now < self.open_until or self.probing
+        )
+
+    def record_success(self, rtt):
+        self.srtt = (
+            rtt if self.srtt is None else self.srtt + RTT_ALPHA * (rtt - self.srtt)
+        )
+        self.failure_rate -= FAILURE_ALPHA * self.failure_rate
+        self.consecutive_failures = 0
+        self.probing = False
+        self.samples.append(rtt)
+        self.successes += 1
+        if self.p95 is None or self.successes % P95_INTERVAL == 0:
+            ordered = sorted(self.samples)
+            self.p95 = ordered[int(0.95 * (len(ordered) - 1))]
+
+    def record_failure(self, now):
+        self.failures += 1
+        self.failure_rate += FAILURE_ALPHA * (1 - self.failure_rate)
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.consecutive_failures >= CIRCUIT_FAILURES:
+            self.open_until = now + CIRCUIT_OPEN_TIME
+
+    def stats(self):
+        return {
+            "srtt": self.srtt or 0.0,
+            "p95": self.p95 or 0.0,
+            "failure_rate": self.failure_rate,
+            "circuit_open": int(self.circuit_open(time.monotonic())),
+            "queries": self.queries,
+            "failures": self.failures,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+class HedgedQuery:
+    __slots__ = (
+        "data",
+        "use_tcp",
+        "future",
+        "candidates",
+        "launched",
+        "outstanding",
+        "hedged",
+    )
+
+    def __init__(self, data, use_tcp, candidates):
+        self.data = data
+        self.use_tcp = use_tcp
+        self.future = Future()
+        self.candidates = candidates
+        self.launched = 0
+        self.outstanding = 0
+        self.hedged = None
+
+
+class UpstreamSet:
+    """
+    Envoie chaque requête au résolveur sain le plus rapide, avec une copie
+    différée vers le second et bascule immédiate en cas d'échec.
+    """
+
+    def __init__(self, servers, hedge_budget=HEDGE_BUDGET):
+        self.upstreams = [Upstream(server, port) for server, port in servers]
+        self.hedge_budget = hedge_budget
+        self.lock = threading.Lock()
+        self.scheduler = Scheduler()
+        self.queries = 0
+        self.hedges = 0
+        self.hedge_tokens = 0.0
+
+    def ranked(self, now):
+        """Résolveurs utilisables, du meilleur au moins bon."""
+        # Appelé sous self.lock
+        healthy = []
+        for upstream in self.upstreams:
+            if not upstream.circuit_open(now):
+                healthy.append(upstream)
+        if not healthy:
+            # Tous en panne : on tente celui dont le disjoncteur se referme le plus tôt
+            return sorted(self.upstreams, key=lambda upstream: upstream.open_until)
+        healthy.sort(key=lambda upstream: upstream.score(now))
+        return healthy
+
+    def submit(self, data, use_tcp=False):
+        """Retourne un Future résolu avec la première réponse obtenue."""
+        with self.lock:
+            self.queries += 1
+            self.hedge_tokens = min(HEDGE_BURST, self.hedge_tokens + self.hedge_budget)
+            query = HedgedQuery(data, use_tcp, self.ranked(time.monotonic()))
+            primary = query.candidates[0]
+            hedge = len(query.candidates) > 1 and self.hedge_tokens >= 1
+        self._launch(query)
+        if hedge and not query.future.done():
+            self.scheduler.call_later(primary.hedge_delay(), self._hedge, query)
+        return query.future
+
+    def query(self, data, use_tcp=False):
+        """Version bloquante de submit()."""
+        return self.submit(data, use_tcp).result()
+
+    def _launch(self, query):
+        with self.lock:
+            if query.launched >= len(query.candidates):
+                return False
+            upstream = query.candidates[query.launched]
+            query.launched += 1
+            query.outstanding += 1
+            upstream.queries += 1
+            if not upstream.outstanding:
+                upstream.last_progress = time.monotonic()
+            upstream.outstanding += 1
+            if upstream.consecutive_failures >= CIRCUIT_FAILURES:
+                upstream.probing = (
+                    True  # demi-ouvert : une seule requête de test à la fois
+                )
+            pool = upstream.pool(query.use_tcp)
+        start = time.monotonic()
+        try:
+            future = pool.submit(query.data)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        future.add_done_callback(
+            lambda done: self._completed(query, upstream, start, done)
+        )
+        return True
+
+    def _hedge(self, query):
+        if query.future.done():
+            return
+        with self.lock:
+            if query.launched >= len(query.candidates) or self.hedge_tokens < 1:
+                return
+            self.hedge_tokens -= 1
+            self.hedges += 1
+            query.hedged = query.candidates[query.launched]
+            query.hedged.hedges += 1
+        self._launch(query)
+
+    def _completed(self, query, upstream, start, done):
+        now = time.monotonic()
+        error = done.exception()
+        with self.lock:
+            query.outstanding -= 1
+            upstream.outstanding -= 1
+            upstream.last_progress = now
+            if error is None:
+                upstream.record_success(now - start)
+                if upstream is query.hedged and not query.future.done():
+                    upstream.hedge_wins += 1
+            else:
+                upstream.record_failure(now)
+            failover = (
+                error is not None and not query.future.done() and query.outstanding == 0
+            )
+        try:
+            if error is None:
+                query.future.set_result(done.result())
+            # Échec sans autre requête en cours : on passe tout de suite au résolveur suivant
+            elif failover and not self._launch(query):
+                query.future.set_exception(error)
+        except InvalidStateError:
+            pass  # l'autre requête a répondu la première
+
+    def stats(self):
+        with self.lock:
+            return {upstream.name: upstream.stats() for upstream in self.upstreams}